@@ -0,0 +1,32 @@
+"""Stands in for `python -m azure.cli` by asking a running fake_azure server to answer the command
+
+The server address comes from FAKE_AZURE_URL. Set FAKE_AZ_STARTUP_MS to add the cold start of a real az process.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+from urllib.request import Request, urlopen
+
+
+def main(args):
+    startup = float(os.environ.get("FAKE_AZ_STARTUP_MS") or 0)
+    if startup:
+        time.sleep(startup / 1000.0)
+
+    request = Request(
+        os.environ["FAKE_AZURE_URL"] + "/_az",
+        data=json.dumps({"args": args}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlopen(request) as response:
+        exit_code = int(response.headers.get("X-Az-Exit-Code", "0"))
+        out = sys.stdout if exit_code == 0 else sys.stderr
+        shutil.copyfileobj(response, out.buffer)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
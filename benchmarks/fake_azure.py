@@ -0,0 +1,1366 @@
+"""A local stand-in for management.azure.com (Resource Graph included), graph.windows.net, login.microsoftonline.com
+and *.azurewebsites.net
+
+It also answers the nested `az` commands the extension runs (see fake_az.py), so the whole extension can be driven
+without a subscription. Run it on its own to poke at it:
+
+    python benchmarks/fake_azure.py --port 8080 --size 1000
+
+The data set is synthetic: `size` storage accounts spread over resource groups of 100, `size` DevTestLab shutdown
+schedules, and a handful of named resources in `bench-rg` that the benchmark scenarios act on. Every 10th storage
+account is armed for a sweeper and already expired.
+Synthetic resources are generated on demand, so a 100k data set costs almost nothing until it's listed.
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import jmespath
+
+import fake_resource_graph
+
+SUBSCRIPTION_ID = "00000000-0000-0000-0000-0000000b3c40"
+TENANT_ID = "00000000-0000-0000-0000-0000000070e4"
+SUBSCRIPTION = "/subscriptions/{}".format(SUBSCRIPTION_ID)
+# More subscriptions the account can see, for --subscriptions fan-out. They're empty
+OTHER_SUBSCRIPTION_IDS = [
+    "00000000-0000-0000-0000-00000000{:04d}".format(i) for i in range(1, 8)
+]
+BENCH_GROUP = "bench-rg"
+LOCATION = "westus2"
+
+PAGE_SIZE = 1000
+RESOURCES_PER_GROUP = 100
+
+# Newest first, like ARM. Preview versions are mixed in so api-version selection has something to skip
+PROVIDERS = {
+    "Microsoft.Compute": {
+        "disks": ["2019-07-01", "2019-03-01"],
+        "virtualMachines": ["2019-12-01", "2019-07-01"],
+    },
+    "Microsoft.ContainerRegistry": {
+        "registries": ["2019-12-01-preview", "2019-05-01", "2017-10-01"]
+    },
+    "Microsoft.ContainerService": {"managedClusters": ["2020-01-01", "2019-11-01"]},
+    "Microsoft.DevTestLab": {
+        "labs": ["2018-09-15", "2016-05-15"],
+        "schedules": ["2018-09-15", "2016-05-15"],
+    },
+    "Microsoft.KeyVault": {
+        "vaults": ["2019-09-01", "2018-02-14"],
+        "vaults/secrets": ["2019-09-01", "2018-02-14"],
+    },
+    "Microsoft.Logic": {"workflows": ["2019-05-01", "2018-07-01-preview"]},
+    "Microsoft.Network": {
+        "networkInterfaces": ["2019-11-01", "2019-09-01"],
+        "networkSecurityGroups": ["2019-11-01", "2019-09-01"],
+        "publicIPAddresses": ["2019-11-01", "2019-09-01"],
+        "virtualNetworks": ["2019-11-01", "2019-09-01"],
+    },
+    "Microsoft.Storage": {"storageAccounts": ["2019-06-01", "2019-04-01"]},
+    "Microsoft.Web": {
+        "sites": ["2019-08-01", "2018-11-01"],
+        "sites/functions": ["2019-08-01", "2018-11-01"],
+    },
+}
+
+ROLE_DEFINITIONS = {
+    "Contributor": "b24988ac-6180-42a0-ab88-20f7382dd24c",
+    "Owner": "8e3af657-a8ff-443c-a75c-2fe8c4bcb635",
+    "Reader": "acdd72a7-3385-48ef-bd42-f606fba81ae7",
+}
+
+# What the permissions API shows for Contributor, which `az ad sp create-for-rbac` assigns
+CONTRIBUTOR_PERMISSIONS = {
+    "actions": ["*"],
+    "notActions": [
+        "Microsoft.Authorization/*/Delete",
+        "Microsoft.Authorization/*/Write",
+        "Microsoft.Authorization/elevateAccess/Action",
+        "Microsoft.Blueprint/blueprintAssignments/write",
+        "Microsoft.Blueprint/blueprintAssignments/delete",
+        "Microsoft.Compute/galleries/share/action",
+    ],
+}
+
+GROUP_RE = re.compile(r"^/subscriptions/[^/]+/resourcegroups/(?P<group>[^/]+)$")
+STORAGE_RE = re.compile(
+    r"^/subscriptions/[^/]+/resourcegroups/rg-(?P<group>\d+)/providers/microsoft\.storage/storageaccounts/bench(?P<index>\d+)$"
+)
+SCHEDULE_RE = re.compile(
+    r"^/subscriptions/[^/]+/resourcegroups/rg-(?P<group>\d+)/providers/microsoft\.devtestlab/schedules/shutdown-computevm-vm(?P<index>\d+)$"
+)
+# How many resources the bulk arm scenario arms at once
+BULK_TARGETS = 200
+
+DEPLOYMENT_PATH_RE = re.compile(
+    r"^/subscriptions/[^/]+/resourcegroups/[^/]+/providers/microsoft\.resources/deployments/[^/]+$",
+    re.IGNORECASE,
+)
+FILTER_RE = re.compile(r"(\w+) eq '([^']*)'")
+
+# (method, pattern on the lowercased path, handler name)
+ARM_ROUTES = [
+    ("POST", r"^/providers/microsoft\.resourcegraph/resources$", "query_graph"),
+    ("GET", r"^/subscriptions$", "list_subscriptions"),
+    ("GET", r"^/subscriptions/[^/]+/providers$", "list_providers"),
+    ("GET", r"^/subscriptions/[^/]+/providers/(?P<namespace>[^/]+)$", "show_provider"),
+    ("GET", r"^/subscriptions/[^/]+/resources$", "list_resources"),
+    ("GET", r"^/subscriptions/[^/]+/resourcegroups$", "list_groups"),
+    (
+        "GET",
+        r"^/subscriptions/[^/]+/resourcegroups/(?P<group>[^/]+)/resources$",
+        "list_resources",
+    ),
+    (
+        "GET",
+        r"^/subscriptions/(?P<subscription>[^/]+)/providers/microsoft\.devtestlab/schedules$",
+        "list_schedules",
+    ),
+    (
+        "PATCH",
+        r"^(?P<scope>.+)/providers/microsoft\.resources/tags/default$",
+        "update_tags",
+    ),
+    (
+        "GET",
+        r"^/subscriptions/[^/]+/resourcegroups/(?P<group>[^/]+)/providers/microsoft\.resources/deployments$",
+        "list_deployments",
+    ),
+    (
+        "PUT",
+        r"^/subscriptions/[^/]+/resourcegroups/(?P<group>[^/]+)/providers/microsoft\.resources/deployments/(?P<name>[^/]+)$",
+        "create_deployment",
+    ),
+    (
+        "GET",
+        r"^(?P<scope>.*)/providers/microsoft\.authorization/roledefinitions$",
+        "list_role_definitions",
+    ),
+    (
+        "GET",
+        r"^(?P<scope>.+)/providers/microsoft\.authorization/roleassignments$",
+        "list_role_assignments",
+    ),
+    (
+        "PUT",
+        r"^(?P<scope>.+)/providers/microsoft\.authorization/roleassignments/(?P<name>[^/]+)$",
+        "create_role_assignment",
+    ),
+    (
+        "GET",
+        r"^(?P<scope>.+)/providers/microsoft\.authorization/permissions$",
+        "list_permissions",
+    ),
+    (
+        "POST",
+        r"^.+/providers/microsoft\.web/sites/(?P<site>[^/]+)/config/appsettings/list$",
+        "list_appsettings",
+    ),
+    (
+        "GET",
+        r"^.+/providers/microsoft\.web/sites/(?P<site>[^/]+)/functions/admin/token$",
+        "get_function_token",
+    ),
+    (
+        "GET",
+        r"^.+/providers/microsoft\.web/sites/(?P<site>[^/]+)/hostruntime/admin/(?P<path>.+)$",
+        "host_runtime",
+    ),
+]
+ARM_ROUTES = [(m, re.compile(p), h) for (m, p, h) in ARM_ROUTES]
+
+
+def utc(delta=timedelta()):
+    return (datetime.utcnow() + delta).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def error(status, code, message):
+    return status, {"error": {"code": code, "message": message}}
+
+
+def get_resource_type(resource_id):
+    parts = resource_id.strip("/").split("/")
+    if len(parts) == 4:
+        return "Microsoft.Resources/resourceGroups"
+    # .../providers/<namespace>/<type>/<name>[/<child type>/<child name>]
+    provider = parts.index("providers")
+    namespace, rest = parts[provider + 1], parts[provider + 2 :]
+    return "/".join([namespace] + rest[::2])
+
+
+def get_resource_group(resource_id):
+    return resource_id.split("/")[4]
+
+
+class FakeAzure(object):
+    def __init__(self, size=10):
+        self.lock = threading.RLock()
+        self.stats = {}
+        self.load(size)
+
+    def load(self, size):
+        with self.lock:
+            self.size = size
+            self.group_count = max(1, size // RESOURCES_PER_GROUP)
+            self.reset()
+
+    def reset(self):
+        """Put the named resources back the way they started, and drop anything the extension created"""
+        with self.lock:
+            self.resources = {}
+            self.deleted = set()
+            # (timestamp, resource id, changeType) for Resource Graph's resourcechanges tables
+            self.changes = []
+            self.role_assignments = []
+            self.secrets = {}
+
+            self.add_resource(
+                SUBSCRIPTION + "/resourceGroups/" + BENCH_GROUP, {"properties": {}}
+            )
+            self.add_resource(
+                self.get_bench_id("Microsoft.Storage/storageAccounts", "benchtarget"),
+                {"kind": "StorageV2"},
+            )
+            self.add_resource(
+                self.get_bench_id("Microsoft.ContainerRegistry/registries", "benchacr"),
+                {"sku": {"name": "Basic"}},
+            )
+            self.add_resource(
+                self.get_bench_id("Microsoft.KeyVault/vaults", "bench-kv"), {}
+            )
+
+            self.service_principals = {}
+            for name in ("bench-aks-sp", "bench-ralph-sp"):
+                app_id = str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+                self.service_principals[app_id] = {
+                    "appId": app_id,
+                    "id": str(uuid.uuid5(uuid.NAMESPACE_DNS, name)),
+                    "displayName": name,
+                    "objectType": "ServicePrincipal",
+                }
+            self.add_resource(
+                self.get_bench_id(
+                    "Microsoft.ContainerService/managedClusters", "bench-aks"
+                ),
+                {
+                    "properties": {
+                        "servicePrincipalProfile": {
+                            "clientId": self.get_app_id("bench-aks-sp")
+                        }
+                    }
+                },
+            )
+
+            # Functions v1 serves keys from the app itself, v2+ through ARM's hostruntime proxy
+            self.function_apps = {"bench-func-v1": "~1", "bench-func-v2": "~3"}
+            for name in self.function_apps:
+                self.add_resource(
+                    self.get_bench_id("Microsoft.Web/sites", name),
+                    {"kind": "functionapp"},
+                )
+
+            self.secrets[("bench-kv", "bench-ralph-sp")] = {
+                "id": "https://bench-kv.vault.azure.net/secrets/bench-ralph-sp/1",
+                "value": "bench-password",
+                "attributes": {"enabled": True, "updated": utc(timedelta(hours=-1))},
+                "tags": {"sp": ""},
+            }
+            self.add_created_vm()
+
+    def add_created_vm(self):
+        """What `az vm create -n bench-vm` leaves behind: a VM and its disk, and the deployment that made the rest"""
+        names = {
+            "Microsoft.Network/virtualNetworks": "bench-vmVNET",
+            "Microsoft.Network/networkSecurityGroups": "bench-vmNSG",
+            "Microsoft.Network/publicIPAddresses": "bench-vmPublicIP",
+            "Microsoft.Network/networkInterfaces": "bench-vmVMNic",
+            "Microsoft.Compute/virtualMachines": "bench-vm",
+        }
+        ids = {t: self.get_bench_id(t, n) for (t, n) in names.items()}
+        vm_id = ids.pop("Microsoft.Compute/virtualMachines")
+        disk_id = self.get_bench_id("Microsoft.Compute/disks", "bench-vm_OsDisk_1")
+        for resource_id in ids.values():
+            self.add_resource(resource_id, {"properties": {}})
+        self.add_resource(disk_id, {"properties": {"diskState": "Attached"}})
+        self.add_resource(
+            vm_id,
+            {
+                "properties": {
+                    "storageProfile": {
+                        "osDisk": {
+                            "createOption": "FromImage",
+                            "managedDisk": {"id": disk_id},
+                        },
+                        "dataDisks": [],
+                    }
+                }
+            },
+        )
+        self.add_resource(
+            "{}/resourceGroups/{}/providers/Microsoft.Resources/deployments/vm_deploy_bench".format(
+                SUBSCRIPTION, BENCH_GROUP
+            ),
+            {
+                "properties": {
+                    "provisioningState": "Succeeded",
+                    "timestamp": utc(),
+                    "outputResources": [
+                        {"id": i} for i in [vm_id] + list(ids.values())
+                    ],
+                }
+            },
+        )
+
+    def get_bench_id(self, resource_type, name):
+        namespace, type_name = resource_type.split("/", 1)
+        return "{}/resourceGroups/{}/providers/{}/{}/{}".format(
+            SUBSCRIPTION, BENCH_GROUP, namespace, type_name, name
+        )
+
+    def get_app_id(self, display_name):
+        return next(
+            sp["appId"]
+            for sp in self.service_principals.values()
+            if sp["displayName"] == display_name
+        )
+
+    def get_targets(self):
+        """The names and ids that the benchmark scenarios work with"""
+        last = self.size - 1
+        secret = self.secrets[("bench-kv", "bench-ralph-sp")]
+        return {
+            "subscription": SUBSCRIPTION_ID,
+            "tenant": TENANT_ID,
+            "size": self.size,
+            "group": BENCH_GROUP,
+            "storage": self.get_bench_id(
+                "Microsoft.Storage/storageAccounts", "benchtarget"
+            ),
+            # Spread over as many resource groups as the data set has
+            "bulk": [
+                self.get_synthetic_resource(i)["id"]
+                for i in range(min(self.size, BULK_TARGETS))
+            ],
+            # What `az vm create` returns
+            "vm_create": {
+                "id": self.get_bench_id(
+                    "Microsoft.Compute/virtualMachines", "bench-vm"
+                ),
+                "resourceGroup": BENCH_GROUP,
+                "powerState": "VM running",
+                "publicIpAddress": "203.0.113.10",
+                "privateIpAddress": "10.0.0.4",
+            },
+            "aks": "bench-aks",
+            "registry": "benchacr",
+            "functionapps": sorted(self.function_apps),
+            "keyvault": "bench-kv",
+            "sp": self.get_app_id("bench-ralph-sp"),
+            # The last schedule is the worst case for a scan
+            "vm": {
+                "name": "vm{:06d}".format(last),
+                "group": "rg-{:05d}".format(last % self.group_count),
+            },
+            "credentials": [
+                {
+                    "keyId": str(uuid.uuid4()),
+                    "startDate": secret["attributes"]["updated"],
+                    "endDate": utc(timedelta(days=365)),
+                },
+                {
+                    "keyId": str(uuid.uuid4()),
+                    "startDate": utc(timedelta(days=-30)),
+                    "endDate": utc(timedelta(days=335)),
+                },
+            ],
+        }
+
+    # Resources
+
+    def add_resource(self, resource_id, resource):
+        resource = dict(resource)
+        resource.update(
+            {
+                "id": resource_id,
+                "name": resource_id.split("/")[-1],
+                "type": get_resource_type(resource_id),
+                "location": resource.get("location", LOCATION),
+                "tags": resource.get("tags") or {},
+            }
+        )
+        with self.lock:
+            existed = self.get_resource(resource_id) is not None
+            self.resources[resource_id.lower()] = resource
+            self.deleted.discard(resource_id.lower())
+            self.record_change(resource_id, "Update" if existed else "Create")
+        return resource
+
+    def get_resource(self, resource_id):
+        key = resource_id.rstrip("/").lower()
+        with self.lock:
+            if key in self.deleted:
+                return None
+            if key in self.resources:
+                return self.resources[key]
+
+        match = GROUP_RE.match(key)
+        if match and match.group("group").startswith("rg-"):
+            index = int(match.group("group")[3:])
+            return self.get_synthetic_group(index) if index < self.group_count else None
+
+        match = STORAGE_RE.match(key)
+        if match:
+            index = int(match.group("index"))
+            if index < self.size and index % self.group_count == int(
+                match.group("group")
+            ):
+                return self.get_synthetic_resource(index)
+
+        match = SCHEDULE_RE.match(key)
+        if match:
+            index = int(match.group("index"))
+            if index < self.size and index % self.group_count == int(
+                match.group("group")
+            ):
+                return self.get_synthetic_schedule(index)
+        return None
+
+    def materialize(self, resource_id):
+        """Copy a (possibly synthetic) resource into the writable store"""
+        resource = self.get_resource(resource_id)
+        if resource is None:
+            return None
+        with self.lock:
+            key = resource_id.rstrip("/").lower()
+            if key not in self.resources:
+                self.resources[key] = json.loads(json.dumps(resource))
+            return self.resources[key]
+
+    def delete_resource(self, resource_id):
+        key = resource_id.rstrip("/").lower()
+        with self.lock:
+            if self.get_resource(key) is None:
+                return False
+            self.resources.pop(key, None)
+            self.deleted.add(key)
+            self.record_change(resource_id, "Delete")
+            return True
+
+    def record_change(self, resource_id, change_type):
+        with self.lock:
+            self.changes.append((utc(), resource_id.rstrip("/"), change_type))
+
+    def get_synthetic_group(self, index):
+        tags = {}
+        if index % 3 == 0:
+            tags = {
+                "self-destruct": "",
+                "self-destruct-date": str(
+                    datetime(2030, 1, 1) + timedelta(minutes=index)
+                ),
+            }
+        return {
+            "id": "{}/resourceGroups/rg-{:05d}".format(SUBSCRIPTION, index),
+            "name": "rg-{:05d}".format(index),
+            "type": "Microsoft.Resources/resourceGroups",
+            "location": LOCATION,
+            "tags": tags,
+            "properties": {"provisioningState": "Succeeded"},
+        }
+
+    def get_synthetic_resource(self, index):
+        group = "rg-{:05d}".format(index % self.group_count)
+        tags = {}
+        if index % 10 == 0:
+            # Armed for a sweeper, and already expired
+            tags = {
+                "self-destruct": "",
+                "self-destruct-date": str(
+                    datetime(2020, 1, 1) + timedelta(minutes=index)
+                ),
+                "self-destruct-api-version": "2019-06-01",
+            }
+        elif index % 2 == 0:
+            tags = {
+                "self-destruct": "",
+                "self-destruct-date": str(
+                    datetime(2030, 1, 1) + timedelta(minutes=index)
+                ),
+            }
+        return {
+            "id": "{}/resourceGroups/{}/providers/Microsoft.Storage/storageAccounts/bench{:06d}".format(
+                SUBSCRIPTION, group, index
+            ),
+            "name": "bench{:06d}".format(index),
+            "type": "Microsoft.Storage/storageAccounts",
+            "kind": "StorageV2",
+            "location": LOCATION,
+            "tags": tags,
+        }
+
+    def get_synthetic_schedule(self, index):
+        group_id = "{}/resourceGroups/rg-{:05d}".format(
+            SUBSCRIPTION, index % self.group_count
+        )
+        return {
+            "id": "{}/providers/Microsoft.DevTestLab/schedules/shutdown-computevm-vm{:06d}".format(
+                group_id, index
+            ),
+            "name": "shutdown-computevm-vm{:06d}".format(index),
+            "type": "Microsoft.DevTestLab/schedules",
+            "location": LOCATION,
+            "properties": {
+                "status": "Enabled",
+                "taskType": "ComputeVmShutdownTask",
+                "dailyRecurrence": {"time": "1900"},
+                "timeZoneId": "UTC",
+                "targetResourceId": "{}/providers/Microsoft.Compute/virtualMachines/vm{:06d}".format(
+                    group_id, index
+                ),
+            },
+        }
+
+    def iter_stored(
+        self,
+        resource_type=None,
+        exclude_types=(
+            "Microsoft.Resources/resourceGroups",
+            "Microsoft.Resources/deployments",
+        ),
+    ):
+        with self.lock:
+            resources = sorted(self.resources.values(), key=lambda r: r["id"].lower())
+        for resource in resources:
+            if resource_type and resource["type"].lower() != resource_type.lower():
+                continue
+            if not resource_type and resource["type"] in exclude_types:
+                continue
+            yield resource
+
+    def iter_positions(self, stored, get_item, count, start=0):
+        """Yield (position, resource) for stored resources followed by synthetic ones, starting at a position
+
+        Positions are what skip tokens hold, so a page can pick up where the last one stopped without generating
+        everything in front of it.
+        """
+        stored = list(stored)
+        for position in range(start, len(stored)):
+            yield position, stored[position]
+        for index in range(max(0, start - len(stored)), count):
+            item = get_item(index)
+            key = item["id"].lower()
+            # Updated copies are listed with the stored resources
+            if key not in self.deleted and key not in self.resources:
+                yield len(stored) + index, item
+
+    def iter_groups(self, start=0):
+        stored = self.iter_stored("Microsoft.Resources/resourceGroups")
+        return self.iter_positions(
+            stored, self.get_synthetic_group, self.group_count, start
+        )
+
+    def iter_resources(self, start=0):
+        return self.iter_positions(
+            self.iter_stored(), self.get_synthetic_resource, self.size, start
+        )
+
+    def iter_changes(self, containers, start=0):
+        with self.lock:
+            changes = list(self.changes)
+        for position in range(start, len(changes)):
+            timestamp, resource_id, change_type = changes[position]
+            if (len(resource_id.strip("/").split("/")) == 4) != containers:
+                continue
+            yield position, {
+                "id": "{}/providers/Microsoft.Resources/changes/{}".format(
+                    resource_id, position
+                ),
+                "type": "Microsoft.Resources/changes",
+                "properties": {
+                    "targetResourceId": resource_id,
+                    "changeType": change_type,
+                    "changeAttributes": {"timestamp": timestamp},
+                },
+            }
+
+    def iter_schedules(self, start=0):
+        stored = self.iter_stored("Microsoft.DevTestLab/schedules")
+        return self.iter_positions(
+            stored, self.get_synthetic_schedule, self.size, start
+        )
+
+    # Request dispatch
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def handle(self, method, host, path, query, body, if_none_match=None):
+        """Returns (status, payload[, headers]). Payloads are JSON-able, or bytes to send as is"""
+        if path.startswith("/_admin/"):
+            return self.handle_admin(method, path[len("/_admin/") :], body)
+        if path == "/_az":
+            self.count("az")
+            return self.run_az(body["args"])
+
+        if host.endswith(".azurewebsites.net"):
+            self.count("azurewebsites")
+            return self.handle_function_host(host.split(".")[0], path)
+        if host == "graph.windows.net":
+            self.count("graph")
+            return self.handle_graph(path, query)
+        if host == "login.microsoftonline.com":
+            self.count("login")
+            return 200, {
+                "token_type": "Bearer",
+                "access_token": "fake-token",
+                "expires_in": 3599,
+            }
+        if path.lower().startswith("/providers/microsoft.resourcegraph/"):
+            self.count("resourcegraph")
+        else:
+            self.count("arm")
+        return self.handle_arm(method, path, query, body, if_none_match)
+
+    def handle_admin(self, method, command, body):
+        if command == "load":
+            self.load(int(body["size"]))
+        elif command == "reset":
+            self.reset()
+        elif command == "stats" and method == "GET":
+            with self.lock:
+                return 200, dict(self.stats)
+        elif command == "stats/reset":
+            with self.lock:
+                self.stats = {}
+        elif command == "targets":
+            return 200, self.get_targets()
+        else:
+            return error(404, "NotFound", command)
+        return 200, {}
+
+    def handle_arm(self, method, path, query, body, if_none_match=None):
+        path = path.rstrip("/")
+        lower = path.lower()
+        for route_method, pattern, handler in ARM_ROUTES:
+            if route_method != method:
+                continue
+            match = pattern.match(lower)
+            if match:
+                params = {
+                    k: path[match.start(k) : match.end(k)] for k in match.groupdict()
+                }
+                return getattr(self, handler)(query=query, body=body, **params)
+
+        if method == "GET":
+            resource = self.get_resource(path)
+            if resource is None:
+                return error(
+                    404,
+                    "ResourceNotFound",
+                    "The resource '{}' was not found".format(path),
+                )
+            # Every GET carries an ETag, and a matching If-None-Match gets an empty 304
+            etag = '"{}"'.format(
+                hashlib.md5(json.dumps(resource, sort_keys=True).encode()).hexdigest()
+            )
+            if if_none_match == etag:
+                self.count("arm-304")
+                return 304, None, {"ETag": etag}
+            return 200, resource, {"ETag": etag}
+        if method == "PUT":
+            body = body or {}
+            if "/providers/microsoft.logic/workflows/" in path.lower():
+                body.setdefault("properties", {})["changedTime"] = utc()
+            return 200, self.add_resource(path, body)
+        if method == "DELETE":
+            return (200 if self.delete_resource(path) else 204), None
+        return error(405, "MethodNotAllowed", "{} {}".format(method, path))
+
+    def page(self, iter_items, query, path, predicate=None):
+        """ARM style paging: up to PAGE_SIZE items per response, with a nextLink carrying a skip token"""
+        value = []
+        for position, item in iter_items(int(query.get("$skiptoken", 0))):
+            if predicate and not predicate(item):
+                continue
+            if len(value) == PAGE_SIZE:
+                next_query = dict(query)
+                next_query["$skiptoken"] = position
+                return 200, {
+                    "value": value,
+                    "nextLink": "https://management.azure.com{}?{}".format(
+                        path, urlencode(next_query)
+                    ),
+                }
+            value.append(item)
+        return 200, {"value": value}
+
+    # ARM handlers
+
+    def get_provider(self, namespace):
+        resource_types = PROVIDERS[namespace]
+        return {
+            "id": "{}/providers/{}".format(SUBSCRIPTION, namespace),
+            "namespace": namespace,
+            "registrationState": "Registered",
+            "resourceTypes": [
+                {"resourceType": t, "locations": [LOCATION], "apiVersions": v}
+                for (t, v) in sorted(resource_types.items())
+            ],
+        }
+
+    def list_providers(self, query, **_):
+        return 200, {"value": [self.get_provider(ns) for ns in sorted(PROVIDERS)]}
+
+    def show_provider(self, namespace, **_):
+        for known in PROVIDERS:
+            if known.lower() == namespace.lower():
+                return 200, self.get_provider(known)
+        return error(
+            404,
+            "InvalidResourceNamespace",
+            "The resource namespace '{}' is invalid".format(namespace),
+        )
+
+    def list_resources(self, query, group=None, **_):
+        filters = {
+            k.lower(): v.lower()
+            for (k, v) in FILTER_RE.findall(query.get("$filter", ""))
+        }
+        if "resourcetype" in filters and "name" in filters:
+            # Point lookups go straight to the resource instead of a scan
+            resources = [
+                r
+                for r in self.iter_stored(filters["resourcetype"])
+                if r["name"].lower() == filters["name"]
+            ]
+            match = re.match(r"^bench(\d+)$", filters["name"])
+            if (
+                not resources
+                and match
+                and filters["resourcetype"] == "microsoft.storage/storageaccounts"
+            ):
+                index = int(match.group(1))
+                resource = (
+                    self.get_resource(self.get_synthetic_resource(index)["id"])
+                    if index < self.size
+                    else None
+                )
+                resources = [resource] if resource else []
+            return 200, {"value": resources}
+
+        path = SUBSCRIPTION + "/resources"
+        if group is not None:
+            path = "{}/resourceGroups/{}/resources".format(SUBSCRIPTION, group)
+        group_id = "/resourcegroups/{}/".format(group)
+
+        def predicate(resource):
+            if group is not None and group_id not in resource["id"].lower():
+                return False
+            if "resourcetype" in filters:
+                return resource["type"].lower() == filters["resourcetype"]
+            if "tagname" in filters:
+                tags = {k.lower(): v.lower() for (k, v) in resource["tags"].items()}
+                if "tagvalue" in filters:
+                    return tags.get(filters["tagname"]) == filters["tagvalue"]
+                return filters["tagname"] in tags
+            return True
+
+        return self.page(self.iter_resources, query, path, predicate)
+
+    def query_graph(self, body, **_):
+        """Resource Graph. Skip tokens are `table:position`, like ARM's, so paging never starts over"""
+        try:
+            graph_query = fake_resource_graph.Query(body["query"])
+        except fake_resource_graph.QueryError as ex:
+            return error(400, "BadRequest", str(ex))
+        options = body.get("options") or {}
+        top = min(int(options.get("$top", 100)), 1000)
+        skip_token = options.get("$skipToken")
+        now = datetime.utcnow()
+        tables = {
+            "resources": self.iter_resources,
+            "resourcecontainers": self.iter_groups,
+            "resourcechanges": partial(self.iter_changes, False),
+            "resourcecontainerchanges": partial(self.iter_changes, True),
+        }
+        sources = [tables[table] for table in graph_query.tables]
+        if SUBSCRIPTION_ID not in [s.lower() for s in body.get("subscriptions", [])]:
+            # Everything lives in the one subscription
+            sources = []
+
+        def iter_rows(start_table, start_position):
+            for (table, iter_items) in enumerate(sources):
+                if table < start_table:
+                    continue
+                start = start_position if table == start_table else 0
+                for (position, item) in iter_items(start):
+                    row = fake_resource_graph.to_row(item)
+                    if graph_query.matches(row, now):
+                        yield "{}:{}".format(table, position), row
+
+        try:
+            if graph_query.order or graph_query.limit is not None:
+                # Sorting needs everything, so these pages are offsets into the full result
+                rows = [row for (_, row) in iter_rows(0, 0)]
+                if graph_query.order:
+                    column, descending = graph_query.order
+                    rows.sort(key=lambda r: r.get(column) or "", reverse=descending)
+                if graph_query.limit is not None:
+                    rows = rows[: graph_query.limit]
+                offset = int(skip_token[2:]) if skip_token else 0
+                data = rows[offset : offset + top]
+                next_token = (
+                    "o:{}".format(offset + top) if offset + top < len(rows) else None
+                )
+            else:
+                start_table, start_position = 0, 0
+                if skip_token:
+                    start_table, start_position = [
+                        int(x) for x in skip_token.split(":")
+                    ]
+                data, next_token = [], None
+                for (token, row) in iter_rows(start_table, start_position):
+                    if len(data) == top:
+                        next_token = token
+                        break
+                    data.append(row)
+            data = [graph_query.project(row, now) for row in data]
+        except fake_resource_graph.QueryError as ex:
+            return error(400, "BadRequest", str(ex))
+
+        result = {
+            "count": len(data),
+            "data": data,
+            "facets": [],
+            "resultTruncated": "false",
+        }
+        if next_token:
+            result["$skipToken"] = next_token
+        return 200, result
+
+    def list_groups(self, query, **_):
+        return self.page(self.iter_groups, query, SUBSCRIPTION + "/resourcegroups")
+
+    def list_subscriptions(self, **_):
+        return 200, {
+            "value": [
+                {
+                    "id": "/subscriptions/{}".format(s),
+                    "subscriptionId": s,
+                    "displayName": "bench-{}".format(s[-4:]),
+                    "state": "Enabled",
+                    "tenantId": TENANT_ID,
+                }
+                for s in [SUBSCRIPTION_ID] + OTHER_SUBSCRIPTION_IDS
+            ]
+        }
+
+    def list_schedules(self, query, subscription, **_):
+        if subscription.lower() != SUBSCRIPTION_ID:
+            return 200, {"value": []}
+        return self.page(
+            self.iter_schedules,
+            query,
+            SUBSCRIPTION + "/providers/Microsoft.DevTestLab/schedules",
+        )
+
+    def update_tags(self, scope, body, **_):
+        with self.lock:
+            resource = self.materialize(scope)
+            if resource is None:
+                return error(
+                    404,
+                    "ResourceNotFound",
+                    "The resource '{}' was not found".format(scope),
+                )
+            tags = body["properties"]["tags"]
+            operation = body.get("operation", "Merge")
+            if operation == "Replace":
+                resource["tags"] = dict(tags)
+            elif operation == "Delete":
+                resource["tags"] = {
+                    k: v for (k, v) in resource["tags"].items() if k not in tags
+                }
+            else:
+                resource["tags"].update(tags)
+            self.record_change(scope, "Update")
+            return 200, {
+                "id": scope + "/providers/Microsoft.Resources/tags/default",
+                "properties": {"tags": resource["tags"]},
+            }
+
+    def list_deployments(self, group, query, **_):
+        path = "{}/resourceGroups/{}/providers/Microsoft.Resources/deployments".format(
+            SUBSCRIPTION, group
+        )
+        stored = [
+            d
+            for d in self.iter_stored("Microsoft.Resources/deployments")
+            if d["id"].lower().startswith(path.lower() + "/")
+        ]
+        return self.page(
+            lambda start: self.iter_positions(stored, None, 0, start), query, path
+        )
+
+    def create_deployment(self, group, name, body, **_):
+        if (
+            self.get_resource("{}/resourceGroups/{}".format(SUBSCRIPTION, group))
+            is None
+        ):
+            return error(
+                404,
+                "ResourceGroupNotFound",
+                "Resource group '{}' could not be found".format(group),
+            )
+
+        # Template expressions aren't evaluated. The self-destruct templates create one Logic App per target,
+        # and the sweeper template one named after its name parameter
+        properties = body["properties"]
+        parameters = {
+            k: v.get("value") for (k, v) in properties.get("parameters", {}).items()
+        }
+        output_resources = []
+        for resource in properties["template"].get("resources", []):
+            if resource["type"].lower() != "microsoft.logic/workflows":
+                continue
+            if "targets" not in parameters:
+                workflow_id = "{}/resourceGroups/{}/providers/Microsoft.Logic/workflows/{}".format(
+                    SUBSCRIPTION, group, parameters["name"]
+                )
+                self.add_resource(
+                    workflow_id,
+                    {
+                        "tags": {"self-destruct-sweeper": parameters["scope"]},
+                        "identity": {
+                            "type": "SystemAssigned",
+                            "principalId": str(uuid.uuid4()),
+                            "tenantId": TENANT_ID,
+                        },
+                        "properties": {"state": "Enabled", "parameters": parameters},
+                    },
+                )
+                output_resources.append({"id": workflow_id})
+                continue
+            for target in parameters["targets"]:
+                workflow_id = "{}/resourceGroups/{}/providers/Microsoft.Logic/workflows/{}".format(
+                    SUBSCRIPTION, group, target["name"]
+                )
+                self.add_resource(
+                    workflow_id,
+                    {
+                        "tags": {"self-destruct-time": target["utcTime"]},
+                        "identity": {
+                            "type": "SystemAssigned",
+                            "principalId": str(uuid.uuid4()),
+                            "tenantId": TENANT_ID,
+                        },
+                        "properties": {
+                            "state": "Enabled",
+                            "changedTime": utc(),
+                            "parameters": target,
+                            "definition": {
+                                "triggers": {
+                                    "Recurrence": {
+                                        "type": "Recurrence",
+                                        "recurrence": {
+                                            "frequency": "Month",
+                                            "interval": 16,
+                                            "startTime": target["utcTime"],
+                                            "timeZone": "UTC",
+                                        },
+                                    }
+                                },
+                                "actions": {
+                                    "DeleteResource": {
+                                        "inputs": {"uri": target["resourceUri"]}
+                                    }
+                                },
+                            },
+                        },
+                    },
+                )
+                output_resources.append({"id": workflow_id})
+
+        deployment_id = (
+            "{}/resourceGroups/{}/providers/Microsoft.Resources/deployments/{}".format(
+                SUBSCRIPTION, group, name
+            )
+        )
+        deployment = self.add_resource(
+            deployment_id,
+            {
+                "properties": {
+                    "provisioningState": "Succeeded",
+                    "mode": properties.get("mode", "Incremental"),
+                    "timestamp": utc(),
+                    "outputResources": output_resources,
+                }
+            },
+        )
+        return 201, deployment
+
+    def get_role_definition(self, role_name):
+        return {
+            "id": "{}/providers/Microsoft.Authorization/roleDefinitions/{}".format(
+                SUBSCRIPTION, ROLE_DEFINITIONS[role_name]
+            ),
+            "name": ROLE_DEFINITIONS[role_name],
+            "type": "Microsoft.Authorization/roleDefinitions",
+            "properties": {
+                "roleName": role_name,
+                "type": "BuiltInRole",
+                "permissions": [{"actions": ["*"], "notActions": []}],
+            },
+        }
+
+    def list_role_definitions(self, query, **_):
+        filters = dict(FILTER_RE.findall(query.get("$filter", "")))
+        names = [
+            n
+            for n in sorted(ROLE_DEFINITIONS)
+            if n.lower() == filters.get("roleName", n).lower()
+        ]
+        return 200, {"value": [self.get_role_definition(n) for n in names]}
+
+    def list_role_assignments(self, scope, query, **_):
+        filters = dict(FILTER_RE.findall(query.get("$filter", "")))
+        scope = scope.lower()
+        with self.lock:
+            assignments = [
+                a
+                for a in self.role_assignments
+                if (scope + "/").startswith(a["properties"]["scope"].lower() + "/")
+                and a["properties"]["principalId"]
+                == filters.get("principalId", a["properties"]["principalId"])
+            ]
+        return 200, {"value": assignments}
+
+    def create_role_assignment(self, scope, name, body, **_):
+        properties = dict(body["properties"])
+        with self.lock:
+            for assignment in self.role_assignments:
+                existing = assignment["properties"]
+                if (
+                    existing["scope"].lower() == scope.lower()
+                    and existing["principalId"] == properties["principalId"]
+                    and existing["roleDefinitionId"].split("/")[-1]
+                    == properties["roleDefinitionId"].split("/")[-1]
+                ):
+                    return error(
+                        409,
+                        "RoleAssignmentExists",
+                        "The role assignment already exists.",
+                    )
+            properties["scope"] = scope
+            assignment = {
+                "id": "{}/providers/Microsoft.Authorization/roleAssignments/{}".format(
+                    scope, name
+                ),
+                "name": name,
+                "type": "Microsoft.Authorization/roleAssignments",
+                "properties": properties,
+            }
+            self.role_assignments.append(assignment)
+        return 201, assignment
+
+    def list_permissions(self, **_):
+        return 200, {"value": [CONTRIBUTOR_PERMISSIONS]}
+
+    def list_appsettings(self, site, **_):
+        if site.lower() not in self.function_apps:
+            return error(
+                404, "ResourceNotFound", "The resource '{}' was not found".format(site)
+            )
+        return 200, {
+            "properties": {
+                "FUNCTIONS_EXTENSION_VERSION": self.function_apps[site.lower()],
+                "FUNCTIONS_WORKER_RUNTIME": "python",
+            }
+        }
+
+    def get_function_token(self, site, **_):
+        return 200, "token-for-" + site.lower()
+
+    def host_runtime(self, site, path, **_):
+        return self.get_function_keys(site.lower(), path)
+
+    # Other hosts
+
+    def get_function_keys(self, site, path):
+        if site not in self.function_apps:
+            return error(404, "NotFound", site)
+        if path == "host/keys":
+            return 200, {"keys": [{"name": "default", "value": site + "-host-default"}]}
+        if path == "host/systemkeys":
+            return 200, {
+                "keys": [{"name": "durabletask_extension", "value": site + "-durable"}]
+            }
+        if path == "host/systemkeys/_master":
+            return 200, {"name": "_master", "value": site + "-master", "links": []}
+        match = re.match(r"^functions/([^/]+)/keys$", path)
+        if match:
+            return 200, {
+                "keys": [
+                    {
+                        "name": "default",
+                        "value": "{}-{}-default".format(site, match.group(1)),
+                    }
+                ]
+            }
+        return error(404, "NotFound", path)
+
+    def handle_function_host(self, site, path):
+        if not path.startswith("/admin/"):
+            return error(404, "NotFound", path)
+        return self.get_function_keys(site, path[len("/admin/") :])
+
+    def handle_graph(self, path, query):
+        if path.rstrip("/") == "/{}/me/ownedObjects".format(TENANT_ID):
+            skip = int(query.get("$skiptoken", 0))
+            objects = sorted(
+                self.service_principals.values(), key=lambda sp: sp["displayName"]
+            )
+            result = {"value": objects[skip : skip + 100]}
+            if skip + 100 < len(objects):
+                result["odata.nextLink"] = "me/ownedObjects?$skiptoken={}".format(
+                    skip + 100
+                )
+            return 200, result
+        return 404, {
+            "odata.error": {
+                "code": "Request_ResourceNotFound",
+                "message": {"value": path},
+            }
+        }
+
+    # Nested az commands
+
+    def run_az(self, args):
+        words = []
+        options = {}
+        option = None
+        for arg in args:
+            if arg.startswith("-"):
+                option = arg
+                options[option] = True
+            elif option is None:
+                words.append(arg)
+            else:
+                options[option] = arg
+        command = " ".join(words)
+
+        try:
+            result = self.get_az_result(command, options)
+        except KeyError as ex:
+            return 200, "ERROR: {}\n".format(ex).encode(), {"X-Az-Exit-Code": "3"}
+        except NotImplementedError:
+            return (
+                200,
+                "ERROR: fake az doesn't know '{}'\n".format(command).encode(),
+                {"X-Az-Exit-Code": "2"},
+            )
+
+        query = options.get("--query")
+        if query and query.startswith("[].") and isinstance(result, list):
+            # Apply projections item by item, like JMESPath would, so huge lists aren't copied first
+            expression = jmespath.compile(query[3:])
+            result = [
+                x for x in (expression.search(item) for item in result) if x is not None
+            ]
+        elif query:
+            result = jmespath.search(query, result)
+
+        if options.get("--output", options.get("-o")) == "tsv":
+            output = format_tsv(result)
+        else:
+            output = json.dumps(result, indent=2) + "\n" if result is not None else ""
+        return 200, output.encode(), {"X-Az-Exit-Code": "0"}
+
+    def get_az_result(self, command, options):
+        tag = options.get("--tag")
+        if command == "group list":
+            return [
+                g
+                for (_, g) in self.iter_groups()
+                if not tag or tag.split("=")[0] in g["tags"]
+            ]
+        if command == "resource list":
+            resources = []
+            for _, resource in self.iter_resources():
+                if not tag or tag.split("=")[0] in resource["tags"]:
+                    resource = dict(resource)
+                    resource["resourceGroup"] = get_resource_group(resource["id"])
+                    resources.append(resource)
+            return resources
+        if command == "ad sp show":
+            for sp in self.service_principals.values():
+                if options["--id"] in (sp["appId"], sp["id"]):
+                    return sp
+            raise KeyError(
+                "Service principal '{}' doesn't exist".format(options["--id"])
+            )
+        if command == "keyvault secret show":
+            return self.secrets[
+                (options["--vault-name"], options.get("--name", options.get("-n")))
+            ]
+        if command == "keyvault secret set":
+            secret = {
+                "value": options["--value"],
+                "attributes": {"enabled": True, "updated": utc()},
+            }
+            self.secrets[
+                (options["--vault-name"], options.get("--name", options.get("-n")))
+            ] = secret
+            return secret
+        if command == "account show":
+            return {
+                "id": SUBSCRIPTION_ID,
+                "tenantId": TENANT_ID,
+                "name": "bench",
+                "isDefault": True,
+            }
+        if command == "account get-access-token":
+            return {
+                "accessToken": "fake-token",
+                "tenant": TENANT_ID,
+                "subscription": SUBSCRIPTION_ID,
+                "tokenType": "Bearer",
+            }
+        raise NotImplementedError(command)
+
+
+def format_tsv(result):
+    if result is None:
+        return ""
+    if not isinstance(result, list):
+        result = [result]
+    lines = []
+    for item in result:
+        values = item.values() if isinstance(item, dict) else [item]
+        lines.append("\t".join("" if v is None else str(v) for v in values))
+    return "\n".join(lines) + "\n"
+
+
+class FakeAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes - without this, delayed ACKs add ~40ms to every keep-alive request
+    disable_nagle_algorithm = True
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else None
+        if body and "json" in (self.headers.get("Content-Type") or ""):
+            body = json.loads(body)
+        query = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+        # The benchmark adapter keeps the real host in a header, since everything arrives here
+        host = (
+            (self.headers.get("X-Fake-Host") or self.headers.get("Host") or "")
+            .split(":")[0]
+            .lower()
+        )
+
+        if self.server.latency and not url.path.startswith("/_admin/"):
+            time.sleep(self.server.latency)
+        if method == "PUT" and DEPLOYMENT_PATH_RE.match(url.path):
+            time.sleep(self.server.deployment_time)
+
+        response = self.server.azure.handle(
+            method,
+            host,
+            url.path,
+            query,
+            body,
+            if_none_match=self.headers.get("If-None-Match"),
+        )
+        status, payload = response[:2]
+        headers = response[2] if len(response) > 2 else {}
+        if payload is None:
+            data = b""
+        elif isinstance(payload, bytes):
+            data = payload
+        else:
+            data = json.dumps(payload).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):
+        pass
+
+
+class FakeAzureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, azure, latency=0, deployment_time=0):
+        HTTPServer.__init__(self, address, FakeAzureHandler)
+        self.azure = azure
+        self.latency = latency
+        self.deployment_time = deployment_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="Delay added to every request"
+    )
+    parser.add_argument(
+        "--deployment-ms",
+        type=float,
+        default=0,
+        help="How long template deployments take, on top of --latency-ms",
+    )
+    args = parser.parse_args()
+
+    server = FakeAzureServer(
+        ("127.0.0.1", args.port),
+        FakeAzure(args.size),
+        latency=args.latency_ms / 1000.0,
+        deployment_time=args.deployment_ms / 1000.0,
+    )
+    # The harness reads the address from the first line of output
+    sys.stdout.write("http://127.0.0.1:{}\n".format(server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Just enough Resource Graph (KQL) for the queries the extension sends, evaluated over fake_azure.py's data
+
+Supported, in any order after the table:
+
+    resources | union resourcecontainers
+    resourcechanges | union resourcecontainerchanges
+    | where <condition> [and <condition> ...]
+    | project a, b = tostring(tags['x'])
+    | order by a [asc|desc]
+    | limit 10
+
+Conditions compare a column, a path into one (properties.x.y), tags['x'], todatetime(...) or tolower(...) with a
+'string', now(), datetime(...) or a ('tuple') using ==, !=, =~, !~, in~, startswith, <, <=, >, >=. isnotempty(...),
+isempty(...), isnotnull(...) and isnull(...) work too. Missing tags and properties are null. Anything else is an error,
+so a query the fake doesn't understand fails loudly instead of quietly matching nothing.
+"""
+
+import re
+from datetime import datetime
+
+CONDITION_RE = re.compile(
+    r"^(?P<lhs>.+?)\s+(?P<op>==|!=|=~|!~|in~|<=|>=|<|>|startswith)\s+(?P<rhs>.+)$"
+)
+FUNCTION_RE = re.compile(r"^(?P<name>\w+)\((?P<arg>.*)\)$")
+TAG_RE = re.compile(r"^tags\[\s*'(?P<name>[^']*)'\s*\]$")
+TABLES = (
+    "resources",
+    "resourcecontainers",
+    "resourcechanges",
+    "resourcecontainerchanges",
+)
+DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S.%f+00:00",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d",
+)
+
+
+class QueryError(Exception):
+    pass
+
+
+def split_top_level(text, separator):
+    """Split on separator, except inside quotes or parentheses"""
+    parts, depth, quoted, start = [], 0, False, 0
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and text.startswith(separator, index):
+            parts.append(text[start:index].strip())
+            index += len(separator)
+            start = index
+            continue
+        index += 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class Query(object):
+    def __init__(self, text):
+        clauses = split_top_level(" ".join(text.split()), "|")
+        self.tables = [clauses[0].lower()]
+        self.filters = []
+        self.projection = None
+        self.order = None
+        self.limit = None
+        # Lowercased ('tuple') literals, parsed once rather than once per row
+        self.tuples = {}
+
+        for clause in clauses[1:]:
+            keyword, _, rest = clause.partition(" ")
+            keyword = keyword.lower()
+            if keyword == "union":
+                self.tables.append(rest.strip().lower())
+            elif keyword == "where":
+                self.filters.extend(split_top_level(rest, " and "))
+            elif keyword == "project":
+                self.projection = []
+                for column in split_top_level(rest, ","):
+                    name, _, expression = column.partition("=")
+                    if not expression:
+                        name, expression = column, column
+                    self.projection.append((name.strip(), expression.strip()))
+            elif keyword in ("order", "sort"):
+                by = rest.split()
+                if not by or by[0].lower() != "by":
+                    raise QueryError("Expected `order by`: {}".format(clause))
+                descending = len(by) < 3 or by[2].lower() != "asc"
+                self.order = (by[1], descending)
+            elif keyword in ("limit", "take"):
+                self.limit = int(rest)
+            else:
+                raise QueryError("Unsupported clause: {}".format(clause))
+
+        for table in self.tables:
+            if table not in TABLES:
+                raise QueryError("Unsupported table: {}".format(table))
+
+    def evaluate(self, expression, row, now):
+        expression = expression.strip()
+        if expression.startswith("'") and expression.endswith("'"):
+            return expression[1:-1]
+        if expression.startswith("(") and expression.endswith(")"):
+            return [
+                self.evaluate(item, row, now)
+                for item in split_top_level(expression[1:-1], ",")
+            ]
+
+        tag = TAG_RE.match(expression)
+        if tag:
+            return (row.get("tags") or {}).get(tag.group("name"))
+
+        function = FUNCTION_RE.match(expression)
+        if function:
+            name, arg = function.group("name").lower(), function.group("arg")
+            if name == "now" and not arg:
+                return now
+            if name == "datetime":
+                return parse_date(arg.strip().strip("'"))
+            value = self.evaluate(arg, row, now)
+            if name == "todatetime":
+                return parse_date(value)
+            if name == "tostring":
+                return "" if value is None else str(value)
+            if name == "tolower":
+                return None if value is None else str(value).lower()
+            if name == "isnotempty":
+                return value not in (None, "")
+            if name == "isempty":
+                return value in (None, "")
+            if name == "isnotnull":
+                return value is not None
+            if name == "isnull":
+                return value is None
+            raise QueryError("Unsupported function: {}".format(name))
+
+        if expression in row:
+            return row[expression]
+        column, dot, path = expression.partition(".")
+        if dot and column in row:
+            # Missing properties are null, like tags
+            value = row[column]
+            for name in path.split("."):
+                value = value.get(name) if isinstance(value, dict) else None
+            return value
+        raise QueryError("Unknown column or expression: {}".format(expression))
+
+    def get_tuple(self, expression, row, now):
+        """The lowercased values of an in~ tuple. A tuple of literals is only parsed once"""
+        if expression in self.tuples:
+            return self.tuples[expression]
+        values = {str(v).lower() for v in self.evaluate(expression, row, now)}
+        items = split_top_level(expression.strip()[1:-1], ",")
+        if all(i.startswith("'") for i in items):
+            self.tuples[expression] = values
+        return values
+
+    def matches(self, row, now):
+        for condition in self.filters:
+            match = CONDITION_RE.match(condition)
+            if not match:
+                if not self.evaluate(condition, row, now):
+                    return False
+                continue
+
+            lhs = self.evaluate(match.group("lhs"), row, now)
+            op = match.group("op")
+            if op == "in~":
+                rhs = self.get_tuple(match.group("rhs"), row, now)
+            else:
+                rhs = self.evaluate(match.group("rhs"), row, now)
+            if op in ("=~", "!~", "in~", "startswith"):
+                lhs = "" if lhs is None else str(lhs).lower()
+            if op in ("=~", "!~", "startswith"):
+                rhs = str(rhs).lower()
+            if op in ("<", "<=", ">", ">=") and (lhs is None or rhs is None):
+                # Missing or unparseable dates never compare true, like KQL's nulls
+                return False
+            result = {
+                "==": lambda: lhs == rhs,
+                "=~": lambda: lhs == rhs,
+                "!=": lambda: lhs != rhs,
+                "!~": lambda: lhs != rhs,
+                "in~": lambda: lhs in rhs,
+                "startswith": lambda: lhs.startswith(rhs),
+                "<": lambda: lhs < rhs,
+                "<=": lambda: lhs <= rhs,
+                ">": lambda: lhs > rhs,
+                ">=": lambda: lhs >= rhs,
+            }[op]()
+            if not result:
+                return False
+        return True
+
+    def project(self, row, now):
+        if self.projection is None:
+            return row
+        projected = {}
+        for (name, expression) in self.projection:
+            value = self.evaluate(expression, row, now)
+            if isinstance(value, datetime):
+                value = value.strftime("%Y-%m-%dT%H:%M:%SZ")
+            projected[name] = value
+        return projected
+
+
+def to_row(resource):
+    """A resource as Resource Graph shows it"""
+    parts = resource["id"].split("/")
+    lower = [p.lower() for p in parts]
+    resource_group = ""
+    if "resourcegroups" in lower:
+        resource_group = parts[lower.index("resourcegroups") + 1]
+    resource_type = resource["type"].lower()
+    if resource_type == "microsoft.resources/resourcegroups":
+        resource_type = "microsoft.resources/subscriptions/resourcegroups"
+    row = dict(resource)
+    row.update(
+        {
+            "type": resource_type,
+            "resourceGroup": resource_group,
+            "subscriptionId": parts[2],
+            "tags": resource.get("tags") or {},
+        }
+    )
+    return row
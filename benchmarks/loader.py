@@ -0,0 +1,117 @@
+"""How much the extension adds to every `az` invocation, before any command runs
+
+Each sample is a fresh interpreter that loads azure-cli, then times importing the extension, creating its command
+loader and loading its command table for one argv - the work azure-cli does for every command while the extension is
+installed. It also counts the event handlers the extension leaves registered, which run on every event azure-cli
+raises for the command. Commands that don't use an extension feature should have none:
+
+    python benchmarks/loader.py --repeat 20
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARKS_DIR, "..", "src", "noelbundick")
+
+COMMANDS = [
+    ["account", "show"],
+    ["group", "list", "-o", "table"],
+    ["storage", "account", "create", "-n", "bench", "-g", "bench-rg"],
+    [
+        "storage",
+        "account",
+        "create",
+        "-n",
+        "bench",
+        "-g",
+        "bench-rg",
+        "--self-destruct",
+        "1d",
+    ],
+    ["ad", "sp", "credential", "list", "--id", "bench", "--keyvault", "bench-kv"],
+    ["self-destruct", "list"],
+    ["vm", "auto-shutdown", "show", "-n", "bench", "-g", "bench-rg"],
+    [],
+]
+
+# Runs in the child process. azure-cli is loaded first, so only the extension's own cost is measured
+CHILD = """
+import json, sys, time
+from azure.cli.core import get_default_cli
+
+cli = get_default_cli()
+args = json.loads(sys.argv[1])
+handlers = sum(len(h) for h in cli._event_handlers.values())
+before = set(sys.modules)
+start = time.perf_counter()
+
+import azext_noelbundick
+
+loader = azext_noelbundick.COMMAND_LOADER_CLS(cli_ctx=cli)
+loader.load_command_table(args)
+elapsed = time.perf_counter() - start
+print(
+    json.dumps(
+        {
+            "ms": elapsed * 1000,
+            "modules": len(set(sys.modules) - before),
+            "hooks": sum(len(h) for h in cli._event_handlers.values()) - handlers,
+        }
+    )
+)
+"""
+
+
+def measure(args):
+    env = dict(os.environ, PYTHONPATH=SOURCE_DIR)
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, json.dumps(args)],
+        env=env,
+        universal_newlines=True,
+    )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Fresh processes per command"
+    )
+    parser.add_argument("--json", help="Also write the raw results to this file")
+    args = parser.parse_args()
+
+    results = []
+    row = "{:<70} {:>9} {:>9} {:>9} {:>9}"
+    print(row.format("command", "p50 ms", "max ms", "modules", "hooks"))
+    for command in COMMANDS:
+        samples = [measure(command) for _ in range(args.repeat)]
+        times = sorted(s["ms"] for s in samples)
+        result = {
+            "command": command,
+            "p50": times[(len(times) - 1) // 2],
+            "max": times[-1],
+            "modules": samples[-1]["modules"],
+            "hooks": samples[-1]["hooks"],
+        }
+        results.append(result)
+        print(
+            row.format(
+                "az " + " ".join(command) if command else "(every command group)",
+                "{:.1f}".format(result["p50"]),
+                "{:.1f}".format(result["max"]),
+                result["modules"],
+                result["hooks"],
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
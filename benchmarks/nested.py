@@ -0,0 +1,115 @@
+"""How long one nested az command takes in-process versus in a child process, on the real azure-cli
+
+run.py answers nested commands from a stand-in. Nothing is faked here: this process loads azure-cli with the
+extension installed from this tree, and times cli_utils.az_cli for the same command both ways. The default command
+only reads the local self-destruct ledger, so it needs no login or network. Pass --command to time one of the
+commands the extension really nests, once you're logged in:
+
+    python benchmarks/nested.py --repeat 10
+    python benchmarks/nested.py --command "ad sp show --id <appId>"
+
+With only azure-cli-core installed there is no `python -m azure.cli`, so child processes run
+get_default_cli().invoke() instead, which is what `python -m azure.cli` does once it has started.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARKS_DIR, "..", "src", "noelbundick")
+
+DEFAULT_COMMAND = (
+    "self-destruct list --local --subscriptions 00000000-0000-0000-0000-000000000000"
+)
+
+# Stands in for `python -m azure.cli` when only azure-cli-core is installed
+INVOKE = "import sys; from azure.cli.core import get_default_cli; sys.exit(get_default_cli().invoke(sys.argv[1:]))"
+
+
+def install_extension(ext_dir):
+    """Install the extension from this tree the way `az extension add` lays it out, without copying it"""
+    path = os.path.join(ext_dir, "noelbundick")
+    os.makedirs(os.path.join(path, "noelbundick-0.0.0.dist-info"))
+    with open(
+        os.path.join(path, "noelbundick-0.0.0.dist-info", "METADATA"), "w"
+    ) as metadata:
+        metadata.write("Metadata-Version: 2.1\nName: noelbundick\nVersion: 0.0.0\n")
+    os.symlink(
+        os.path.abspath(os.path.join(SOURCE_DIR, "azext_noelbundick")),
+        os.path.join(path, "azext_noelbundick"),
+    )
+
+
+def measure(run, repeat):
+    """(first call ms, p50 ms of the rest)"""
+    samples = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        run()
+        samples.append((time.perf_counter() - start) * 1000)
+    rest = sorted(samples[1:])
+    return samples[0], rest[(len(rest) - 1) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--command", default=DEFAULT_COMMAND, help="The nested az command to time"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Timed calls after the first"
+    )
+    parser.add_argument("--json", help="Also write the raw results to this file")
+    args = parser.parse_args()
+
+    ext_dir = tempfile.mkdtemp(prefix="noelbundick-nested-")
+    try:
+        install_extension(ext_dir)
+        # Before azure-cli is loaded, so both this process and its children see the extension
+        os.environ["AZURE_EXTENSION_DIR"] = ext_dir
+        os.environ["AZEXT_NOELBUNDICK_DAEMON"] = "false"
+        os.environ["AZEXT_NOELBUNDICK_NO_CACHE"] = "true"
+        sys.path.insert(0, SOURCE_DIR)
+
+        # pylint: disable=import-outside-toplevel
+        from azext_noelbundick import cli_utils
+        from azext_noelbundick.in_process import IN_PROCESS
+
+        if importlib.util.find_spec("azure.cli.__main__") is None:
+            cli_utils.AZ_COMMAND = [sys.executable, "-c", INVOKE]
+
+        cmd = shlex.split(args.command)
+        results = {"command": args.command}
+        for (mode, in_process) in [("child process", False), ("in-process", True)]:
+            IN_PROCESS["enabled"] = in_process
+            first, p50 = measure(lambda: cli_utils.az_cli(cmd), args.repeat)
+            results[mode] = {"first": first, "p50": p50}
+    finally:
+        shutil.rmtree(ext_dir, True)
+
+    row = "{:<16} {:>12} {:>12}"
+    print("az " + args.command)
+    print(row.format("mode", "first ms", "p50 ms"))
+    for mode in ("child process", "in-process"):
+        print(
+            row.format(
+                mode,
+                "{:.1f}".format(results[mode]["first"]),
+                "{:.1f}".format(results[mode]["p50"]),
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,632 @@
+"""Offline benchmarks for the noelbundick extension
+
+Drives the extension's commands against fake_azure.py (ARM, graph and *.azurewebsites.net) and fake_az.py
+(nested `az` commands), and reports latency percentiles per data set size:
+
+    python benchmarks/run.py --sizes 10,1000,100000 --repeat 10
+    python benchmarks/run.py --scenario "self-destruct list" --latency-ms 20 --json results.json
+    python benchmarks/run.py --scenario "create --self-destruct" --deployment-ms 2000
+
+Nothing here needs a subscription or a login, so runs are comparable from machine to machine and commit to commit.
+The fake az runner is much faster than a real az process - set --az-startup-ms to model its cold start.
+Scenarios that run nested az commands also run "(in-process az)", which pays that cold start once per process
+instead of once per command, to compare the two:
+
+    python benchmarks/run.py --scenario "aks grant-access" --scenario "credential list" --az-startup-ms 240
+Fake template deployments finish instantly - set --deployment-ms to model real ones.
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+from requests.adapters import HTTPAdapter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src", "noelbundick"))
+
+# Nested az commands always go to the fake az runner, and ARM reads are never answered from the cache
+os.environ["AZEXT_NOELBUNDICK_IN_PROCESS"] = "false"
+os.environ["AZEXT_NOELBUNDICK_DAEMON"] = "false"
+os.environ["AZEXT_NOELBUNDICK_NO_CACHE"] = "true"
+
+# pylint: disable=wrong-import-position
+from azext_noelbundick import (  # noqa: E402
+    ad,
+    aks,
+    arm,
+    auth,
+    cli_cache,
+    cli_utils,
+    disarm,
+    early_arm,
+    extend,
+    functionapp,
+    in_process,
+    ledger,
+    rbac,
+    self_destruct,
+    sweeper,
+    vm,
+    watch,
+)
+
+DEFAULT_SIZES = "10,100,1000,10000,100000"
+PERCENTILES = (50, 90, 99)
+
+Scenario = namedtuple("Scenario", ["name", "run", "setup"])
+
+
+class FakeAzure(object):
+    """Runs fake_azure.py in its own process, so serving requests doesn't compete with the extension for the GIL"""
+
+    def __init__(self, latency_ms=0, deployment_ms=0):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(BENCHMARKS_DIR, "fake_azure.py"),
+                "--latency-ms",
+                str(latency_ms),
+                "--deployment-ms",
+                str(deployment_ms),
+            ],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.url = self.process.stdout.readline().strip()
+
+    def admin(self, command, body=None):
+        request = Request(
+            "{}/_admin/{}".format(self.url, command),
+            data=json.dumps(body).encode() if body is not None else None,
+            headers={"Content-Type": "application/json"},
+            method="GET" if command in ("stats", "targets") else "POST",
+        )
+        with urlopen(request) as response:
+            return json.loads(response.read().decode())
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class FakeAzureAdapter(HTTPAdapter):
+    """Sends every https request to the fake server. The host it was meant for goes along in a header"""
+
+    def __init__(self, url):
+        self.netloc = urlsplit(url).netloc
+        super(FakeAzureAdapter, self).__init__(pool_connections=4, pool_maxsize=32)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        url = urlsplit(request.url)
+        request.headers["X-Fake-Host"] = url.hostname
+        request.url = urlunsplit(("http", self.netloc, url.path, url.query, ""))
+        return super(FakeAzureAdapter, self).send(request, **kwargs)
+
+
+class FakeInProcessCli(object):
+    """Stands in for the AzCli that nested commands run on in-process, answering them the way fake_az.py does
+
+    Building a real AzCli is the az cold start, so --az-startup-ms is paid once here rather than per command
+    """
+
+    def __init__(self, url):
+        time.sleep(float(os.environ.get("FAKE_AZ_STARTUP_MS") or 0) / 1000.0)
+        self.url = url
+        self.result = None
+
+    def invoke(self, args, out_file=None):
+        request = Request(
+            self.url + "/_az",
+            data=json.dumps({"args": args}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urlopen(request) as response:
+            exit_code = int(response.headers.get("X-Az-Exit-Code", "0"))
+            output = response.read().decode()
+
+        if exit_code:
+            self.result = SimpleNamespace(result=None, error=output.strip())
+            return exit_code
+        result = None
+        if args[args.index("--output") + 1] == "none":
+            # AzCli hands back the result object, not formatted output
+            result = json.loads(output) if output.strip() else None
+        else:
+            out_file.write(output)
+        self.result = SimpleNamespace(result=result, error=None)
+        return 0
+
+
+def install_fakes(fake, targets):
+    def get_account(cli_ctx):
+        return {
+            "id": targets["subscription"],
+            "tenantId": targets["tenant"],
+            "user": {"name": "bench@example.com", "type": "user"},
+        }
+
+    def acquire_cli_token(cli_ctx, resource, subscription):
+        # Token requests go to the fake server too, so they show up in the call counts
+        r = arm.get_session().post(
+            "https://login.microsoftonline.com/{}/oauth2/v2.0/token".format(
+                targets["tenant"]
+            ),
+            data={"grant_type": "refresh_token", "resource": resource},
+        )
+        token = r.json()
+        return token["access_token"], time.time() + token["expires_in"]
+
+    auth.get_account = get_account
+    auth.acquire_cli_token = acquire_cli_token
+    # Start from an empty api-version index, and leave the real one in the Azure config dir alone
+    index_dir = tempfile.mkdtemp(prefix="noelbundick-bench-")
+    atexit.register(shutil.rmtree, index_dir, True)
+    arm.API_VERSIONS_PATH = os.path.join(index_dir, "api-versions.json")
+    ledger.LEDGER_PATH = os.path.join(index_dir, "self-destruct-ledger.sqlite")
+    cli_cache.CACHE_PATH = os.path.join(index_dir, "cache.json")
+    cli_cache.USED_PATH = os.path.join(index_dir, "cache-used.log")
+    arm.get_session().mount("https://", FakeAzureAdapter(fake.url))
+    cli_utils.AZ_COMMAND = [sys.executable, os.path.join(BENCHMARKS_DIR, "fake_az.py")]
+    os.environ["FAKE_AZURE_URL"] = fake.url
+
+    # Keep the extension's warnings (ex: "You've activated a self-destruct sequence!") out of the report
+    logging.getLogger("cli").setLevel(logging.ERROR)
+
+    endpoints = SimpleNamespace(
+        resource_manager="https://management.azure.com/",
+        active_directory_resource_id="https://management.core.windows.net/",
+    )
+    return SimpleNamespace(
+        cli_ctx=SimpleNamespace(cloud=SimpleNamespace(endpoints=endpoints))
+    )
+
+
+def get_scenarios(fake, cmd, targets):
+    storage_id = targets["storage"]
+
+    def reset():
+        fake.admin("reset")
+
+    def armed():
+        reset()
+        self_destruct.arm(cmd, "1d", resource_id=storage_id)
+
+    def create_with_self_destruct(args, result, create_ms=0):
+        early_arm.self_destruct_pre_parse_args_handler(
+            cmd.cli_ctx, args=args + ["-g", targets["group"], "--self-destruct", "1d"]
+        )
+        try:
+            # The create itself, which an early arm runs alongside
+            time.sleep(create_ms / 1000.0)
+            early_arm.self_destruct_transform_handler(
+                cmd.cli_ctx, event_data={"result": dict(result)}
+            )
+        finally:
+            self_destruct.SELF_DESTRUCT["active"] = False
+
+    def bulk_armed():
+        reset()
+        self_destruct.arm(cmd, "1d", resource_ids=targets["bulk"])
+
+    def forget_sync():
+        with ledger.transaction() as connection:
+            connection.execute("DELETE FROM synced")
+
+    def synced_then_armed():
+        # A ledger synced before the arm, so the next sync only has the arm's changes to read
+        self_destruct.list_self_destruct_resources(cmd, sync=True)
+        armed()
+
+    watched = {}
+
+    def watching():
+        # A watch that has already read what's on screen once, so the next poll is the steady state
+        watched["state"] = watch.start_watch(cmd.cli_ctx)
+        watch.poll_watch(cmd.cli_ctx, watched["state"])
+
+    # A custom role as big as the data set: a literal and a wildcard action per provider, and some notActions
+    size = targets["size"]
+    large_role = [
+        {
+            "actions": [
+                "Microsoft.Bench{}/things/delete".format(i) for i in range(size)
+            ]
+            + ["Microsoft.Bench{}/*/read".format(i) for i in range(size)],
+            "notActions": [
+                "Microsoft.Bench{}/*/delete".format(i) for i in range(0, size, 7)
+            ],
+        }
+    ]
+
+    def check_large_role():
+        allows = rbac.compile_permissions(large_role)
+        for i in range(size):
+            allows("Microsoft.Bench{}/things/delete".format(i))
+            allows("microsoft.bench{}/things/widgets/read".format(i))
+
+    def in_process_az(run):
+        """The same scenario, with nested az commands run in-process instead of as child processes"""
+
+        def run_in_process():
+            if in_process.IN_PROCESS["cli"] is None:
+                in_process.IN_PROCESS["cli"] = FakeInProcessCli(fake.url)
+            in_process.IN_PROCESS["enabled"] = True
+            try:
+                run()
+            finally:
+                in_process.IN_PROCESS["enabled"] = False
+
+        return run_in_process
+
+    def cached_reads(run):
+        """The same scenario, with cacheable ARM reads answered from the cache. The warmup run fills it"""
+
+        def run_cached():
+            cli_cache.CACHE["enabled"] = True
+            try:
+                run()
+            finally:
+                cli_cache.CACHE["enabled"] = False
+
+        return run_cached
+
+    def grant_access():
+        aks.grant_access(
+            cmd,
+            targets["aks"],
+            targets["group"],
+            container_registry=targets["registry"],
+        )
+
+    def list_credentials():
+        args = [
+            "ad",
+            "sp",
+            "credential",
+            "list",
+            "--id",
+            targets["sp"],
+            "--keyvault",
+            targets["keyvault"],
+        ]
+        ad.pre_parse_args_handler(None, args=args)
+        try:
+            # The outer `az ad sp credential list` is azure-cli's, so start from its result
+            ad.transform_handler(
+                None, event_data={"result": [dict(c) for c in targets["credentials"]]}
+            )
+        finally:
+            ad.SP_KEYVAULT["active"] = False
+
+    return [
+        Scenario(
+            "self-destruct arm",
+            lambda: self_destruct.arm(cmd, "1d", resource_id=storage_id),
+            reset,
+        ),
+        Scenario(
+            "self-destruct arm (bulk)",
+            lambda: self_destruct.arm(cmd, "1d", resource_ids=targets["bulk"]),
+            reset,
+        ),
+        Scenario(
+            "vm create --self-destruct",
+            lambda: create_with_self_destruct(
+                ["vm", "create", "-n", "bench-vm"], targets["vm_create"]
+            ),
+            reset,
+        ),
+        Scenario(
+            "storage account create --self-destruct (500 ms create)",
+            lambda: create_with_self_destruct(
+                ["storage", "account", "create", "-n", "benchtarget"],
+                {"id": storage_id, "type": "Microsoft.Storage/storageAccounts"},
+                create_ms=500,
+            ),
+            reset,
+        ),
+        Scenario(
+            "self-destruct list",
+            lambda: self_destruct.list_self_destruct_resources(cmd),
+            None,
+        ),
+        Scenario(
+            "self-destruct list --before 1h",
+            lambda: self_destruct.list_self_destruct_resources(cmd, before="1h"),
+            None,
+        ),
+        Scenario(
+            "self-destruct list --subscriptions all",
+            lambda: self_destruct.list_self_destruct_resources(
+                cmd, subscriptions=["all"]
+            ),
+            None,
+        ),
+        Scenario(
+            "self-destruct list --sync (full)",
+            lambda: self_destruct.list_self_destruct_resources(cmd, sync=True),
+            forget_sync,
+        ),
+        Scenario(
+            "self-destruct list --sync (since an arm)",
+            lambda: self_destruct.list_self_destruct_resources(cmd, sync=True),
+            synced_then_armed,
+        ),
+        Scenario(
+            "self-destruct list --local --before 1h",
+            lambda: self_destruct.list_self_destruct_resources(
+                cmd, local=True, before="1h"
+            ),
+            None,
+        ),
+        Scenario(
+            "self-destruct watch (start)",
+            lambda: watch.start_watch(cmd.cli_ctx),
+            None,
+        ),
+        Scenario(
+            "self-destruct watch (poll)",
+            lambda: watch.poll_watch(cmd.cli_ctx, watched["state"]),
+            watching,
+        ),
+        Scenario(
+            "self-destruct sweeper run --dry-run",
+            lambda: sweeper.run_sweeper(cmd, scope="subscription", dry_run=True),
+            None,
+        ),
+        Scenario(
+            "self-destruct disarm",
+            lambda: disarm.disarm(cmd, resource_id=storage_id),
+            armed,
+        ),
+        Scenario(
+            "self-destruct disarm (bulk)",
+            lambda: disarm.disarm(cmd, resource_ids=targets["bulk"]),
+            bulk_armed,
+        ),
+        Scenario(
+            "self-destruct extend",
+            lambda: extend.extend(cmd, resource_id=storage_id, by="2h"),
+            armed,
+        ),
+        Scenario(
+            "self-destruct extend (bulk)",
+            lambda: extend.extend(cmd, resource_ids=targets["bulk"], by="2h"),
+            bulk_armed,
+        ),
+        Scenario(
+            "rbac delete check (bulk)",
+            lambda: rbac.find_undeletable(cmd.cli_ctx, targets["bulk"]),
+            None,
+        ),
+        Scenario("rbac compile + match (role of size)", check_large_role, None),
+        Scenario("aks grant-access", grant_access, reset),
+        Scenario(
+            "aks grant-access (in-process az)", in_process_az(grant_access), reset
+        ),
+        Scenario(
+            "aks grant-access (cached reads)",
+            cached_reads(in_process_az(grant_access)),
+            reset,
+        ),
+        Scenario(
+            "functionapp keys list (v1)",
+            lambda: functionapp.list_functionapp_keys(
+                cmd, targets["group"], "bench-func-v1", include_all=True
+            ),
+            None,
+        ),
+        Scenario(
+            "functionapp keys list (v2)",
+            lambda: functionapp.list_functionapp_keys(
+                cmd, targets["group"], "bench-func-v2", include_all=True
+            ),
+            None,
+        ),
+        Scenario(
+            "vm auto-shutdown show",
+            lambda: vm.show_vm_autoshutdown(
+                cmd, targets["vm"]["name"], targets["vm"]["group"]
+            ),
+            None,
+        ),
+        Scenario(
+            "vm auto-shutdown show --subscriptions all",
+            lambda: vm.show_vm_autoshutdown(
+                cmd,
+                targets["vm"]["name"],
+                targets["vm"]["group"],
+                subscriptions=["all"],
+            ),
+            None,
+        ),
+        Scenario("ad sp credential list --keyvault", list_credentials, None),
+        Scenario(
+            "ad sp credential list --keyvault (in-process az)",
+            in_process_az(list_credentials),
+            None,
+        ),
+    ]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def run_scenario(fake, scenario, repeat, warmup):
+    samples = []
+    stats = {}
+    for iteration in range(warmup + repeat):
+        if scenario.setup:
+            scenario.setup()
+        fake.admin("stats/reset")
+
+        start = time.perf_counter()
+        scenario.run()
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if iteration >= warmup:
+            samples.append(elapsed)
+            stats = fake.admin("stats")
+
+    result = {
+        "scenario": scenario.name,
+        "samples": samples,
+        "mean": sum(samples) / len(samples),
+        "calls": stats,
+    }
+    for p in PERCENTILES:
+        result["p{}".format(p)] = percentile(samples, p)
+    return result
+
+
+def format_calls(calls):
+    return " ".join("{}={}".format(k, v) for (k, v) in sorted(calls.items()))
+
+
+def print_results(results, sizes):
+    width = max([34] + [len(r["scenario"]) for r in results])
+    row = "{} {:>7} {:>9} {:>9} {:>9} {:>9}  {}"
+    print(
+        row.format(
+            "scenario".ljust(width),
+            "size",
+            "p50 ms",
+            "p90 ms",
+            "p99 ms",
+            "mean ms",
+            "calls per run",
+        )
+    )
+    for result in results:
+        print(
+            row.format(
+                result["scenario"].ljust(width),
+                result["size"],
+                "{:.1f}".format(result["p50"]),
+                "{:.1f}".format(result["p90"]),
+                "{:.1f}".format(result["p99"]),
+                "{:.1f}".format(result["mean"]),
+                format_calls(result["calls"]),
+            )
+        )
+
+    if len(sizes) < 2:
+        return
+
+    # Scaling curve: p50 per size, and how much it grew from the smallest data set
+    print("")
+    print(
+        "p50 ms by size".ljust(width)
+        + " "
+        + " ".join("{:>9}".format(s) for s in sizes)
+        + " {:>9}".format("growth")
+    )
+    for name in sorted(
+        {r["scenario"] for r in results}, key=[r["scenario"] for r in results].index
+    ):
+        by_size = {r["size"]: r["p50"] for r in results if r["scenario"] == name}
+        first, last = by_size[sizes[0]], by_size[sizes[-1]]
+        print(
+            name.ljust(width)
+            + " "
+            + " ".join("{:>9.1f}".format(by_size[s]) for s in sizes)
+            + " {:>8.1f}x".format(last / first if first else 0)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help="Comma separated data set sizes. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Timed runs per scenario and size"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Untimed runs per scenario and size"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        help="Only run scenarios whose name contains this. Repeatable",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Delay the fake server adds to every request",
+    )
+    parser.add_argument(
+        "--az-startup-ms",
+        type=float,
+        default=0,
+        help="Delay the fake az runner adds to every nested az command",
+    )
+    parser.add_argument(
+        "--deployment-ms",
+        type=float,
+        default=0,
+        help="How long the fake server takes to run a template deployment",
+    )
+    parser.add_argument("--json", help="Also write the raw results to this file")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    os.environ["FAKE_AZ_STARTUP_MS"] = str(args.az_startup_ms)
+
+    fake = FakeAzure(latency_ms=args.latency_ms, deployment_ms=args.deployment_ms)
+    results = []
+    try:
+        cmd = install_fakes(fake, fake.admin("targets"))
+        for size in sizes:
+            fake.admin("load", {"size": size})
+            targets = fake.admin("targets")
+            for scenario in get_scenarios(fake, cmd, targets):
+                if args.scenario and not any(s in scenario.name for s in args.scenario):
+                    continue
+                result = run_scenario(fake, scenario, args.repeat, args.warmup)
+                result["size"] = size
+                results.append(result)
+                sys.stderr.write(
+                    "{} @ {}: p50 {:.1f} ms\n".format(
+                        scenario.name, size, result["p50"]
+                    )
+                )
+    finally:
+        fake.close()
+
+    print_results(results, sizes)
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(
+                {
+                    "sizes": sizes,
+                    "latency_ms": args.latency_ms,
+                    "az_startup_ms": args.az_startup_ms,
+                    "deployment_ms": args.deployment_ms,
+                    "results": results,
+                },
+                results_file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
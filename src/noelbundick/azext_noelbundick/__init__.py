@@ -2,49 +2,145 @@ import importlib
 
 from azure.cli.core import AzCommandsLoader
 
-from ._help import helps
-
 # Imported modules MUST implement load_command_table and load_arguments
 # Imported modules CAN optionally implement init
+# Modules in MODULE_FEATURES MUST implement register_hooks
+#
+# Modules are only imported when an invocation needs them, so `az account show` doesn't pay for this extension.
+# A module is needed when the command is in one of its groups, or when its hooks act on the command.
+# Which module owns which command comes from the command index, see command_index.py
 MODULE_NAMES = [
     "ad",
     "aks",
     "browse",
     "cloudshell",
+    "disarm",
+    "extend",
     "functionapp",
     "self_destruct",
+    "sweeper",
     "vm",
+    "watch",
 ]
 
 # Example module as a clean place to start from
-# MODULE_NAMES.append('sample')
+# MODULE_NAMES.append("sample")
+
+# Features that hook into commands outside of the extension's own. Their event handlers are only registered
+# when scan_args finds them in use, so every other az command runs without them
+MODULE_FEATURES = {
+    # --keyvault for `az ad sp credential list`
+    "ad": lambda args, flags: args[:4] == ["ad", "sp", "credential", "list"]
+    and ("--keyvault" in flags or is_help(flags)),
+    # --self-destruct for any create command
+    "early_arm": lambda args, flags: "--self-destruct" in flags
+    or ("create" in args and is_help(flags)),
+}
+
+
+def is_help(flags):
+    return "-h" in flags or "--help" in flags
+
+
+def scan_args(args):
+    """Return the names of the modules whose features are used by args
+
+    This runs for every az command, so it only looks at argv and doesn't import anything
+    """
+    flags = set(arg for arg in args if arg.startswith("-"))
+    return [name for (name, used) in MODULE_FEATURES.items() if used(args, flags)]
+
+
+def is_group(command_table, words):
+    """Whether the words name a command group rather than a command (ex: `az self-destruct`)"""
+    prefix = " ".join(words) + " "
+    return any(command.startswith(prefix) for command in command_table)
+
+
+def get_command_words(args):
+    words = []
+    for arg in args:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+    return words
 
-MODULES = list(
-    map(
-        importlib.import_module,
-        map(lambda m: "{}.{}".format("azext_noelbundick", m), MODULE_NAMES),
-    )
-)
+
+def get_module_names(args, index, features):
+    # Without a command (ex: `az`, or azure-cli rebuilding its command index), everything is needed
+    words = get_command_words(args)
+    if not words:
+        return list(MODULE_NAMES)
+
+    names = set(features)
+    for (command, name) in index["commands"].items():
+        # Either the command is ours, or it's a group that contains our commands (ex: `az vm -h`)
+        command = command.split()
+        if command[: len(words)] == words[: len(command)]:
+            names.add(name)
+    return [name for name in MODULE_NAMES if name in names]
 
 
 class NoelBundickCommandsLoader(AzCommandsLoader):
     def __init__(self, cli_ctx=None):
         super(NoelBundickCommandsLoader, self).__init__(cli_ctx=cli_ctx)
-        for m in MODULES:
+        self.modules = {}
+
+    def register_event(self, event_name, handler):
+        # The in-process CLI for nested az commands loads the extension again for every command.
+        # Register each handler once, rather than once per load
+        self.cli_ctx.unregister_event(event_name, handler)
+        self.cli_ctx.register_event(event_name, handler)
+
+    def load_module(self, name):
+        if name not in self.modules:
+            module = importlib.import_module("{}.{}".format(__name__, name))
             try:
-                m.init(self)
+                module.init(self)
             except AttributeError:
                 # init (most likely) doesn't exist. Ignore
                 pass
+            self.modules[name] = module
+        return self.modules[name]
 
     def load_command_table(self, args):
-        for m in MODULES:
-            m.load_command_table(self, args)
+        from . import command_index
+
+        args = args or []
+        features = scan_args(args)
+        index = command_index.get_index(
+            NoelBundickCommandsLoader, self.cli_ctx, MODULE_NAMES
+        )
+        for name in get_module_names(args, index, features):
+            self.load_module(name).load_command_table(self, args)
+
+        for name in features:
+            self.load_module(name).register_hooks(self)
+
+        words = get_command_words(args)
+        # Help is shown for bare groups too, which print their listing instead of running anything
+        if self.command_table and (
+            not words or is_help(args) or is_group(self.command_table, words)
+        ):
+            from . import _help  # pylint: disable=unused-import
+
+        # --no-cache, only for the extension's own commands
+        if " ".join(words) in self.command_table:
+            from . import cli_cache
+
+            cli_cache.init(self)
         return self.command_table
 
     def load_arguments(self, command):
-        for m in MODULES:
-            m.load_arguments(self, command)
+        from . import command_index
+
+        # Only the modules that register arguments for this command
+        scopes = command_index.INDEX.get("argument_scopes", {})
+        for (name, m) in self.modules.items():
+            if name not in scopes or any(
+                command_index.applies_to(scope, command) for scope in scopes[name]
+            ):
+                m.load_arguments(self, command)
 
 
 # pylint: disable=invalid-name
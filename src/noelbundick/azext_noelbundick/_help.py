@@ -124,19 +124,35 @@ helps[
 ] = """
   type: command
   short-summary: Schedule automatic deletion of a resource
+  long-summary: Many resources can be armed at once. They're grouped by resource group, with one deployment per group
   parameters:
     - name: --id
       type: string
       short-summary: The id of a resource to scheduled for deletion
+    - name: --ids
+      type: string
+      short-summary: Space-separated ids of resources to schedule for deletion
+    - name: --ids-file
+      type: string
+      short-summary: A file of resource ids to schedule for deletion, one per line
+    - name: --tag
+      type: string
+      short-summary: Schedule deletion of every resource with this tag. Format is key or key=value
+    - name: --resource-type
+      type: string
+      short-summary: Schedule deletion of every resource of this type. Ex Microsoft.Storage/storageAccounts
     - name: --resource-group -g
       type: string
-      short-summary: The name of a resource group to schedule for deletion
+      short-summary: The name of a resource group to schedule for deletion. With --tag or --resource-type, only resources in this group are matched
     - name: --timer -t
       type: string
       short-summary: How long to wait until deletion. You can specify durations like 1d, 6h, 2h30m, 30m, etc
     - name: --service-principal --sp
       type: boolean
       short-summary: Use legacy behavior that uses a predefined Service Principal
+    - name: --sweeper
+      type: boolean
+      short-summary: Only tag the resources, and leave deleting them to a sweeper. See `az self-destruct sweeper`
 """
 
 helps[
@@ -163,14 +179,66 @@ helps[
     "self-destruct disarm"
 ] = """
   type: command
-  short-summary: Cancel automatic deletion of a resource
+  short-summary: Cancel automatic deletion of one or many resources
+  long-summary: Targets are disarmed in parallel, and a status per target is shown at the end
   parameters:
     - name: --id
       type: string
       short-summary: The id of a resource that is scheduled for deletion
+    - name: --ids
+      type: string
+      short-summary: Space-separated ids of resources that are scheduled for deletion
+    - name: --ids-file
+      type: string
+      short-summary: A file with one resource id per line
     - name: --resource-group -g
       type: string
-      short-summary: The name of a resource group that is scheduled for deletion
+      short-summary: The name of a resource group that is scheduled for deletion. With --tag, --resource-type or --before, disarm matching resources in it instead
+    - name: --tag
+      type: string
+      short-summary: "Disarm scheduled resources with this tag: key[=value]. Ex: --tag self-destruct -g MyGroup disarms everything in MyGroup"
+    - name: --resource-type
+      type: string
+      short-summary: Disarm scheduled resources of this type. Use resourceGroup for resource groups
+    - name: --before
+      type: string
+      short-summary: Disarm everything scheduled before this UTC date (2020-01-31T18:00:00) or duration from now (1d, 6h, 2h30m)
+"""
+
+helps[
+    "self-destruct extend"
+] = """
+  type: command
+  short-summary: Move the self-destruct date of one or many armed resources, without redeploying anything
+  long-summary: Each target's Logic App trigger and tags are updated in place, so it keeps its role assignments. Targets are updated in parallel, and a status per target is shown at the end
+  parameters:
+    - name: --id
+      type: string
+      short-summary: The id of a resource that is scheduled for deletion
+    - name: --ids
+      type: string
+      short-summary: Space-separated ids of resources that are scheduled for deletion
+    - name: --ids-file
+      type: string
+      short-summary: A file with one resource id per line
+    - name: --resource-group -g
+      type: string
+      short-summary: The name of a resource group that is scheduled for deletion. With --tag, --resource-type or --before, extend matching resources in it instead
+    - name: --tag
+      type: string
+      short-summary: "Extend scheduled resources with this tag: key[=value]"
+    - name: --resource-type
+      type: string
+      short-summary: Extend scheduled resources of this type. Use resourceGroup for resource groups
+    - name: --before
+      type: string
+      short-summary: Extend everything scheduled before this UTC date (2020-01-31T18:00:00) or duration from now (1d, 6h, 2h30m)
+    - name: --by
+      type: string
+      short-summary: Push each self-destruct date back by this much (1d, 6h, 2h30m)
+    - name: --at
+      type: string
+      short-summary: Move every self-destruct date to this UTC date (2020-01-31T18:00:00) or duration from now
 """
 
 helps[
@@ -178,6 +246,89 @@ helps[
 ] = """
   type: command
   short-summary: List items that are scheduled to be deleted based on `self-destruct` tag
+  long-summary: Uses one Azure Resource Graph query, filtered on the server, so it stays fast in very large subscriptions
+  parameters:
+    - name: --resource-type
+      type: string
+      short-summary: Only list resources of this type, ex. Microsoft.Storage/storageAccounts. Use resourceGroup for resource groups
+    - name: --resource-group -g
+      type: string
+      short-summary: Only list the resource group and the resources in it
+    - name: --before
+      type: string
+      short-summary: Only list items that self-destruct before this UTC date (2020-01-31T18:00:00) or duration from now (1d, 6h, 2h30m)
+    - name: --after
+      type: string
+      short-summary: Only list items that self-destruct after this UTC date or duration from now
+    - name: --subscriptions
+      type: string
+      short-summary: List items in these subscriptions (ids or names), or `all`, instead of the current one. Adds a subscription column
+    - name: --local
+      type: boolean
+      short-summary: Answer from the local ledger of arms and disarms, without calling Azure
+    - name: --sync
+      type: boolean
+      short-summary: Update the local ledger from Azure (self-destruct tags and Logic Apps), then answer from it
+"""
+
+helps[
+    "self-destruct watch"
+] = """
+  type: command
+  short-summary: Count down to upcoming deletions, soonest first, until Ctrl+C
+  long-summary: Lists everything armed once, then each poll asks Resource Graph for Logic Apps that changed and re-reads the items on screen with If-None-Match, so unchanged ones cost a 304
+  parameters:
+    - name: --resource-group -g
+      type: string
+      short-summary: Only watch the resource group and the resources in it
+    - name: --interval -i
+      type: int
+      short-summary: Seconds between polls. Default 30
+    - name: --top
+      type: int
+      short-summary: How many of the soonest items to show and re-read. Default 20
+"""
+
+helps[
+    "self-destruct sweeper"
+] = """
+  type: group
+  short-summary: Manage sweepers, which delete every expired resource in a resource group or subscription
+  long-summary: Resources armed with `az self-destruct arm --sweeper` only get tags. A sweeper finds the ones whose self-destruct-date has passed and deletes them
+"""
+
+helps[
+    "self-destruct sweeper deploy"
+] = """
+  type: command
+  short-summary: Deploy a sweeper Logic App, and give it Contributor on the scope it sweeps
+  parameters:
+    - name: --resource-group -g
+      type: string
+      short-summary: The resource group the sweeper is deployed to. With --scope group, it's also the group that's swept
+    - name: --scope
+      type: string
+      short-summary: Sweep the resource group, or the whole subscription
+    - name: --interval -i
+      type: int
+      short-summary: How often to sweep, in minutes
+"""
+
+helps[
+    "self-destruct sweeper run"
+] = """
+  type: command
+  short-summary: Sweep now, from the CLI, using the same query as the sweeper Logic App
+  parameters:
+    - name: --resource-group -g
+      type: string
+      short-summary: The resource group to sweep
+    - name: --scope
+      type: string
+      short-summary: Sweep the resource group, or the whole subscription
+    - name: --dry-run
+      type: boolean
+      short-summary: Only list the expired resources
 """
 
 helps[
@@ -244,4 +395,7 @@ helps[
     - name: --name -n
       type: string
       short-summary: The name of the virtual machine
+    - name: --subscriptions
+      type: string
+      short-summary: Look for the VM in each of these subscriptions (ids or names), or `all`. Shows a list with a subscription column
 """
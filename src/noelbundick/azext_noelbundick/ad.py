@@ -1,32 +1,28 @@
 from datetime import timedelta
 from dateutil.parser import parse
 
-import requests
 from azure.cli.core.commands import CliCommandType
 from azure.cli.core.commands.parameters import get_enum_type
 from knack.log import get_logger
 from knack.util import CLIError
 
+from . import arm, auth
 from .cli_utils import az_cli
+from .in_process import is_nested_invocation
 
 LOGGER = get_logger(__name__)
 
 SP_KEYVAULT = {"active": False}
 
 
-def init(self):
+# Only registered for `az ad sp credential list --keyvault`, see MODULE_FEATURES in __init__.py
+def register_hooks(self):
     import knack.events as events
 
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_PRE_PARSE_ARGS, pre_parse_args_handler
-    )
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_POST_CMD_TBL_CREATE, add_parameters
-    )
-    self.cli_ctx.register_event(events.EVENT_INVOKER_POST_PARSE_ARGS, remove_parameters)
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_TRANSFORM_RESULT, transform_handler
-    )
+    self.register_event(events.EVENT_INVOKER_PRE_PARSE_ARGS, pre_parse_args_handler)
+    self.register_event(events.EVENT_INVOKER_POST_CMD_TBL_CREATE, add_parameters)
+    self.register_event(events.EVENT_INVOKER_POST_PARSE_ARGS, remove_parameters)
+    self.register_event(events.EVENT_INVOKER_TRANSFORM_RESULT, transform_handler)
 
 
 def load_command_table(self, _):
@@ -47,6 +43,7 @@ def load_arguments(self, _):
 
 # pylint: disable=too-many-arguments
 def create_sp_for_keyvault(
+    cmd,
     keyvault,
     secret_name=None,
     name=None,
@@ -55,7 +52,7 @@ def create_sp_for_keyvault(
     skip_assignment=None,
     password=None,
 ):
-    vault = az_cli(["keyvault", "show", "-n", keyvault])
+    vault = arm.find_resource(cmd.cli_ctx, "Microsoft.KeyVault/vaults", keyvault)
     if not vault:
         raise CLIError("Could not find Key Vault with name {}".format(keyvault))
 
@@ -98,6 +95,7 @@ def create_sp_for_keyvault(
 
 def pre_parse_args_handler(_, **kwargs):
     args = kwargs.get("args")
+    SP_KEYVAULT["active"] = False
 
     if args[:4] == ["ad", "sp", "credential", "list"] and "--keyvault" in args:
         SP_KEYVAULT["active"] = True
@@ -115,13 +113,8 @@ def pre_parse_args_handler(_, **kwargs):
 def add_parameters(cli_ctx, commands_loader):
     from knack.arguments import CLICommandArgument
 
-    command_table = cli_ctx.invocation.commands_loader.command_table
-
-    if not command_table:
-        return
-
-    if "ad sp credential list" in command_table:
-        command = command_table["ad sp credential list"]
+    command = commands_loader.command_table.get("ad sp credential list")
+    if command:
         command.arguments["keyvault"] = CLICommandArgument(
             "keyvault",
             options_list=["--keyvault"],
@@ -130,20 +123,14 @@ def add_parameters(cli_ctx, commands_loader):
         )
 
 
-def remove_parameters(cli_ctx, **kwargs):
-    command_table = cli_ctx.invocation.commands_loader.command_table
-
-    if not command_table:
-        return
-
-    if "ad sp credential list" in command_table:
-        args = kwargs.get("args")
-        if "keyvault" in args:
-            delattr(args, "keyvault")
+def remove_parameters(_, **kwargs):
+    args = kwargs.get("args")
+    if "keyvault" in args:
+        delattr(args, "keyvault")
 
 
 def transform_handler(_, **kwargs):
-    if SP_KEYVAULT["active"]:
+    if SP_KEYVAULT["active"] and not is_nested_invocation():
         result = kwargs.get("event_data")["result"]
 
         sp = az_cli(["ad", "sp", "show", "--id", SP_KEYVAULT["id"]])
@@ -187,28 +174,28 @@ def transform_handler(_, **kwargs):
             )
 
 
-def get_owned_objects():
-    token = az_cli(
-        ["account", "get-access-token", "--resource", "https://graph.windows.net/"]
-    )
-    access_token = token["accessToken"]
-    tenant_id = token["tenant"]
+def get_owned_objects(cli_ctx):
+    graph = cli_ctx.cloud.endpoints.active_directory_graph_resource_id.rstrip("/")
+    access_token, _ = auth.get_access_token(cli_ctx, resource=graph + "/")
+    tenant_id = auth.get_account(cli_ctx)["tenantId"]
 
-    next_url = "https://graph.windows.net/{}/me/ownedObjects?api-version=1.6".format(
-        tenant_id
-    )
+    next_url = "{}/{}/me/ownedObjects?api-version=1.6".format(graph, tenant_id)
     headers = {"Authorization": "Bearer {}".format(access_token)}
     objects = []
     while True:
-        result = requests.get(next_url, headers=headers).json()
+        result = (
+            arm.get_session()
+            .get(next_url, headers=headers, timeout=arm.REQUEST_TIMEOUT)
+            .json()
+        )
 
         if "odata.error" in result:
             raise CLIError("Request failed with {}".format(result["odata.error"]))
 
         objects.extend(result["value"])
         if "odata.nextLink" in result:
-            next_url = "https://graph.windows.net/{}/{}&api-version=1.6".format(
-                tenant_id, result["odata.nextLink"]
+            next_url = "{}/{}/{}&api-version=1.6".format(
+                graph, tenant_id, result["odata.nextLink"]
             )
         else:
             break
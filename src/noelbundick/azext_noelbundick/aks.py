@@ -1,8 +1,11 @@
+from functools import partial
+
 from azure.cli.core.commands import CliCommandType
 from knack.log import get_logger
 from knack.util import CLIError
 
-from .cli_utils import az_cli
+from . import arm
+from .cli_utils import az_cli, raise_for_errors, run_many
 
 LOGGER = get_logger(__name__)
 
@@ -22,6 +25,7 @@ def load_arguments(self, _):
 
 # pylint: disable=too-many-arguments
 def grant_access(
+    cmd,
     name,
     resource_group_name,
     container_registry=None,
@@ -29,6 +33,7 @@ def grant_access(
     target_resource_id=None,
     role=None,
 ):
+    cli_ctx = cmd.cli_ctx
     args = [container_registry, target_resource_group, target_resource_id]
     specified_args = len([x for x in args if x is not None])
 
@@ -38,55 +43,68 @@ def grant_access(
     if specified_args != 1:
         raise CLIError("You can only select one resource to grant access to at a time")
 
-    aks = az_cli(["aks", "show", "-n", name, "-g", resource_group_name])
-    sp_id = aks["servicePrincipalProfile"]["clientId"]
+    aks_id = "{}/providers/Microsoft.ContainerService/managedClusters/{}".format(
+        arm.get_resource_group_id(cli_ctx, resource_group_name), name
+    )
+    show_aks = partial(arm.show_resource, cli_ctx, aks_id)
 
     if container_registry:
         if not role:
             role = "Reader"
-        target = az_cli(["acr", "show", "-n", container_registry])
-        target_id = target["id"]
+        show_target = partial(
+            arm.find_resource,
+            cli_ctx,
+            "Microsoft.ContainerRegistry/registries",
+            container_registry,
+        )
 
     elif target_resource_group:
         if not role:
             role = "Contributor"
-        target = az_cli(["group", "show", "-n", target_resource_group])
-        target_id = target["id"]
+        show_target = partial(
+            arm.show_resource,
+            cli_ctx,
+            arm.get_resource_group_id(cli_ctx, target_resource_group),
+        )
 
-    elif target_resource_id:
+    else:
         if not role:
             role = "Contributor"
-        target_id = target_resource_id
+        show_target = partial(dict, id=target_resource_id)
+
+    aks, target = raise_for_errors(run_many([show_aks, show_target], fail_fast=True))
+    if not aks:
+        raise CLIError("Could not find managed cluster {}".format(name))
+    if not target:
+        raise CLIError("Could not find the resource to grant access to")
+    target_id = target["id"]
+    sp_id = aks["properties"]["servicePrincipalProfile"]["clientId"]
+
+    # Role assignments are made for the service principal's object id, not its client id
+    # Graph-based az (2.37+) calls it `id`, older versions `objectId`
+    get_object_id = partial(
+        az_cli,
+        ["ad", "sp", "show", "--id", sp_id, "--query", "id || objectId"],
+        output_as_json=False,
+    )
+    get_role_id = partial(arm.get_role_definition_id, cli_ctx, target_id, role)
+    object_id, role_id = raise_for_errors(
+        run_many([get_object_id, get_role_id], fail_fast=True)
+    )
+    if not object_id:
+        raise CLIError(
+            "Could not find the object id of service principal {}".format(sp_id)
+        )
 
     # Check for the role assignment first
     # Adding a role assignment blows up if it already exists ¯\_(ツ)_/¯
-    assignment = az_cli(
-        [
-            "role",
-            "assignment",
-            "list",
-            "--assignee",
-            sp_id,
-            "--scope",
-            target_id,
-            "--role",
-            role,
-        ]
+    assignment = arm.list_role_assignments(
+        cli_ctx, target_id, principal_id=object_id, role_definition_id=role_id
     )
     if assignment:
         return assignment[0]
 
-    result = az_cli(
-        [
-            "role",
-            "assignment",
-            "create",
-            "--assignee",
-            sp_id,
-            "--scope",
-            target_id,
-            "--role",
-            role,
-        ]
+    result = arm.create_role_assignment(
+        cli_ctx, target_id, role_id, object_id, principal_type="ServicePrincipal"
     )
     return result
@@ -0,0 +1,609 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from functools import partial
+
+from azure.cli.core._environment import get_config_dir
+from knack.log import get_logger
+from knack.util import CLIError
+from six.moves.urllib.parse import urlsplit
+
+from . import auth, cli_cache, tracing
+from .cli_utils import iter_many
+from .json_stream import CHUNK_SIZE, iter_json_array
+
+LOGGER = get_logger(__name__)
+
+RESOURCES_API_VERSION = "2019-10-01"
+RESOURCE_GRAPH_API_VERSION = "2021-03-01"
+AUTHORIZATION_API_VERSION = "2018-09-01-preview"
+PERMISSIONS_API_VERSION = "2015-07-01"
+SUBSCRIPTIONS_API_VERSION = "2020-01-01"
+
+# Subscriptions queried at once by --subscriptions
+SUBSCRIPTION_WORKERS = 8
+GUID_RE = re.compile(r"^[0-9a-f]{8}-([0-9a-f]{4}-){3}[0-9a-f]{12}$", re.IGNORECASE)
+
+# Seconds between checks on a running deployment, unless ARM asks for something else with Retry-After
+DEPLOYMENT_POLL_INTERVAL = 5
+DEPLOYMENT_TERMINAL_STATES = {"Succeeded", "Failed", "Canceled"}
+
+# What show_resource_if_changed returns for a resource that still matches its ETag
+NOT_MODIFIED = object()
+
+# Seconds to wait for ARM to accept a connection or send more of a response. Set AZEXT_NOELBUNDICK_ARM_TIMEOUT to change it
+REQUEST_TIMEOUT = float(os.environ.get("AZEXT_NOELBUNDICK_ARM_TIMEOUT", "60"))
+
+# Requests that change a resource, and so evict cached reads of it
+MUTATING_METHODS = {"DELETE", "PATCH", "PUT"}
+
+# One keep-alive session for the whole process, shared by every module and thread
+SESSION = {"session": None}
+SESSION_LOCK = threading.Lock()
+
+# subscription -> {"expires", "providers": {namespace -> {resource type -> [api versions]}}}
+API_VERSIONS = {}
+API_VERSIONS_LOCK = threading.Lock()
+API_VERSIONS_PATH = os.path.join(get_config_dir(), "noelbundick-api-versions.json")
+API_VERSIONS_TTL = 86400
+
+
+def get_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with SESSION_LOCK:
+        if SESSION["session"] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.hooks["response"].append(tracing.trace_response)
+            SESSION["session"] = session
+    return SESSION["session"]
+
+
+def get_access_token(cli_ctx, resource=None):
+    return auth.get_access_token(cli_ctx, resource=resource)
+
+
+def get_subscription_id(cli_ctx):
+    return auth.get_subscription_id(cli_ctx)
+
+
+def list_subscriptions(cli_ctx):
+    """The enabled subscriptions the logged in account can see"""
+    return [
+        s
+        for s in iter_resources(cli_ctx, "/subscriptions", SUBSCRIPTIONS_API_VERSION)
+        if s.get("state") == "Enabled"
+    ]
+
+
+def resolve_subscriptions(cli_ctx, subscriptions):
+    """--subscriptions values (ids, names, or `all`) -> subscription ids"""
+    if not subscriptions:
+        return [get_subscription_id(cli_ctx)]
+    if all(GUID_RE.match(s) for s in subscriptions):
+        return list(subscriptions)
+
+    available = list_subscriptions(cli_ctx)
+    if [s.lower() for s in subscriptions] == ["all"]:
+        return [s["subscriptionId"] for s in available]
+
+    by_name = {s["displayName"].lower(): s["subscriptionId"] for s in available}
+    ids = []
+    for subscription in subscriptions:
+        if GUID_RE.match(subscription):
+            ids.append(subscription)
+        elif subscription.lower() in by_name:
+            ids.append(by_name[subscription.lower()])
+        else:
+            raise CLIError("Could not find subscription {}".format(subscription))
+    return ids
+
+
+def iter_subscription_rows(subscription_ids, query, max_workers=SUBSCRIPTION_WORKERS):
+    """Run query(subscription_id) for each subscription concurrently
+
+    Rows are yielded with a `subscription` column as each subscription finishes. A subscription that fails is
+    logged and skipped, so one without access doesn't hide the rest
+    """
+
+    def run(subscription_id):
+        return list(query(subscription_id))
+
+    calls = [partial(run, s) for s in subscription_ids]
+    for (idx, item) in iter_many(calls, max_workers=max_workers):
+        subscription_id = subscription_ids[idx]
+        if item.error is not None:
+            LOGGER.warning("Skipping subscription %s: %s", subscription_id, item.error)
+            continue
+        for row in item.result:
+            row["subscription"] = subscription_id
+            yield row
+
+
+def get_endpoint(cli_ctx):
+    return cli_ctx.cloud.endpoints.resource_manager.rstrip("/")
+
+
+def get_audience(cli_ctx):
+    """The token audience for ARM in the current cloud"""
+    return cli_ctx.cloud.endpoints.active_directory_resource_id
+
+
+def get_cloud_parameters(cli_ctx):
+    """Template parameters for templates that call back into ARM, so they work outside the public cloud"""
+    return {
+        "managementEndpoint": {"value": get_endpoint(cli_ctx)},
+        "managementAudience": {"value": get_audience(cli_ctx)},
+    }
+
+
+def send_raw_request(cli_ctx, method, path, api_version, **kwargs):
+    """Send an ARM request and return the response. kwargs are body, params, headers and stream"""
+    from requests.exceptions import Timeout
+
+    url = path if path.startswith("http") else get_endpoint(cli_ctx) + path
+
+    access_token, _ = get_access_token(cli_ctx)
+    request_headers = {"Authorization": "Bearer {}".format(access_token)}
+    request_headers.update(kwargs.get("headers") or {})
+    # nextLinks already carry their api-version
+    request_params = {"api-version": api_version} if api_version else {}
+    request_params.update(kwargs.get("params") or {})
+
+    try:
+        r = get_session().request(
+            method,
+            url,
+            params=request_params,
+            json=kwargs.get("body"),
+            headers=request_headers,
+            stream=kwargs.get("stream", False),
+            timeout=REQUEST_TIMEOUT,
+        )
+    except Timeout:
+        raise CLIError("{} {} timed out after {}s".format(method, url, REQUEST_TIMEOUT))
+    LOGGER.debug("%s %s: %s", method, url, r.status_code)
+    if method in MUTATING_METHODS and r.status_code < 400:
+        cli_cache.invalidate_id(urlsplit(url).path)
+    return r
+
+
+def send_request(cli_ctx, method, path, api_version, **kwargs):
+    """Send an ARM request. Returns the response body, or None for a 404
+
+    GETs of the resource types in cli_cache.CACHE_TTLS are answered from the cache when they can be
+    """
+    cacheable = method == "GET" and path.startswith("/") and not kwargs
+    if cacheable:
+        hit, result = cli_cache.get(path, api_version)
+        if hit:
+            tracing.add_span(
+                "GET " + path, "http", time.time(), 0, {"status": "cached"}
+            )
+            return result
+
+    r = send_raw_request(cli_ctx, method, path, api_version, **kwargs)
+
+    if r.status_code == 404:
+        return None
+    if r.status_code >= 400:
+        raise CLIError(get_error_message(r))
+    if not r.content:
+        return None
+    result = r.json()
+    if cacheable:
+        cli_cache.update(path, api_version, result)
+    return result
+
+
+def get_error_message(response):
+    try:
+        error = response.json()["error"]
+        return "{}: {}".format(error["code"], error["message"])
+    except Exception:  # pylint: disable=broad-except
+        return "{} {}: {}".format(
+            response.request.method, response.url, response.status_code
+        )
+
+
+def iter_resources(cli_ctx, path, api_version, params=None):
+    """GET a collection, following nextLink. Resources are yielded as they're decoded from the response stream"""
+    while path:
+        trailer = {}
+        r = send_raw_request(
+            cli_ctx, "GET", path, api_version, params=params, stream=True
+        )
+        try:
+            if r.status_code == 404:
+                return
+            if r.status_code >= 400:
+                raise CLIError(get_error_message(r))
+
+            r.encoding = r.encoding or "utf-8"
+            chunks = r.iter_content(CHUNK_SIZE, decode_unicode=True)
+            for resource in iter_json_array(chunks, key="value", trailer=trailer):
+                yield resource
+        finally:
+            r.close()
+
+        path, api_version, params = trailer.get("nextLink"), None, None
+
+
+def list_resources(cli_ctx, path, api_version, params=None):
+    return list(iter_resources(cli_ctx, path, api_version, params=params))
+
+
+def query_resources(cli_ctx, query, subscriptions=None, page_size=1000):
+    """Run a Resource Graph query, following $skipToken. Rows are yielded a page at a time"""
+    path = "/providers/Microsoft.ResourceGraph/resources"
+    options = {"$top": page_size}
+    while True:
+        result = send_request(
+            cli_ctx,
+            "POST",
+            path,
+            RESOURCE_GRAPH_API_VERSION,
+            body={
+                "subscriptions": subscriptions or [get_subscription_id(cli_ctx)],
+                "query": query,
+                "options": options,
+            },
+        )
+        if result is None:
+            raise CLIError("Resource Graph query failed: {} returned 404".format(path))
+        for row in result.get("data", []):
+            yield row
+
+        skip_token = result.get("$skipToken")
+        if not skip_token:
+            return
+        options = dict(options, **{"$skipToken": skip_token})
+
+
+def get_query_list(values):
+    """Values as a list of KQL strings, for `in~ (...)`. Resource ids and names never contain quotes"""
+    return ", ".join("'{}'".format(v) for v in values)
+
+
+def get_api_version(cli_ctx, namespace, resource_type):
+    """Pick an api-version for a resource type (ex: `Microsoft.Web`, `sites/functions`), preferring stable versions"""
+    if namespace.lower() == "microsoft.resources":
+        return RESOURCES_API_VERSION
+
+    api_versions = get_api_versions(cli_ctx).get(namespace.lower(), {})
+    if resource_type.lower() not in api_versions:
+        # The index may predate a newly registered provider or type
+        api_versions = get_api_versions(cli_ctx, refresh=True).get(
+            namespace.lower(), {}
+        )
+    api_versions = api_versions.get(resource_type.lower())
+    if not api_versions:
+        raise CLIError(
+            "Could not find an api-version for {}/{}".format(namespace, resource_type)
+        )
+
+    # Prefer stable versions
+    stable = [v for v in api_versions if "preview" not in v]
+    return (stable or api_versions)[0]
+
+
+def get_api_versions(cli_ctx, refresh=False):
+    """The namespace -> resource type -> api-versions index for the current subscription
+
+    Every provider is fetched in one listing, then kept in memory and on disk for API_VERSIONS_TTL seconds
+    """
+    subscription_id = get_subscription_id(cli_ctx)
+    with API_VERSIONS_LOCK:
+        entry = API_VERSIONS.get(subscription_id)
+        if refresh and entry and entry.get("fetched"):
+            # Already fresh from ARM - another download won't find anything new
+            return entry["providers"]
+        if not refresh and (not entry or entry["expires"] < time.time()):
+            entry = _read_api_versions().get(subscription_id)
+        if refresh or not entry or entry["expires"] < time.time():
+            entry = {
+                "expires": time.time() + API_VERSIONS_TTL,
+                "providers": fetch_api_versions(cli_ctx, subscription_id),
+            }
+            _write_api_versions(subscription_id, entry)
+            entry = dict(entry, fetched=True)
+        API_VERSIONS[subscription_id] = entry
+        return entry["providers"]
+
+
+def fetch_api_versions(cli_ctx, subscription_id):
+    providers = {}
+    for provider in iter_resources(
+        cli_ctx,
+        "/subscriptions/{}/providers".format(subscription_id),
+        RESOURCES_API_VERSION,
+        params={"$expand": "resourceTypes"},
+    ):
+        providers[provider["namespace"].lower()] = {
+            t["resourceType"].lower(): t["apiVersions"]
+            for t in provider.get("resourceTypes", [])
+        }
+    return providers
+
+
+def _read_api_versions():
+    try:
+        with open(API_VERSIONS_PATH, "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_api_versions(subscription_id, entry):
+    entries = {
+        k: v for k, v in _read_api_versions().items() if v["expires"] >= time.time()
+    }
+    entries[subscription_id] = entry
+
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(API_VERSIONS_PATH))
+        with os.fdopen(fd, "w") as index_file:
+            json.dump(entries, index_file, separators=(",", ":"))
+        os.replace(temp_path, API_VERSIONS_PATH)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.debug("Could not write api-version index %s", API_VERSIONS_PATH)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_api_version_for_id(cli_ctx, resource_id):
+    from msrestazure.tools import parse_resource_id
+
+    parts = parse_resource_id(resource_id)
+    if "namespace" not in parts:
+        return RESOURCES_API_VERSION
+
+    # Nested types are registered as root_type/child_type
+    types = [parts["type"]]
+    level = 1
+    while "child_type_{}".format(level) in parts:
+        types.append(parts["child_type_{}".format(level)])
+        level += 1
+    return get_api_version(cli_ctx, parts["namespace"], "/".join(types))
+
+
+def get_resource_group_id(cli_ctx, resource_group_name):
+    return "/subscriptions/{}/resourceGroups/{}".format(
+        get_subscription_id(cli_ctx), resource_group_name
+    )
+
+
+def show_resource(cli_ctx, resource_id, api_version=None):
+    api_version = api_version or get_api_version_for_id(cli_ctx, resource_id)
+    return send_request(cli_ctx, "GET", resource_id, api_version)
+
+
+def show_resource_if_changed(cli_ctx, resource_id, etag=None, api_version=None):
+    """GET a resource with If-None-Match, so one that hasn't changed comes back as an empty 304
+
+    Returns (resource, etag). resource is NOT_MODIFIED if it still matches etag, and None if it's gone
+    """
+    api_version = api_version or get_api_version_for_id(cli_ctx, resource_id)
+    headers = {"If-None-Match": etag} if etag else None
+    r = send_raw_request(cli_ctx, "GET", resource_id, api_version, headers=headers)
+
+    if r.status_code == 304:
+        return NOT_MODIFIED, etag
+    if r.status_code == 404:
+        return None, None
+    if r.status_code >= 400:
+        raise CLIError(get_error_message(r))
+    resource = r.json()
+    return resource, r.headers.get("ETag") or resource.get("etag")
+
+
+def create_resource(cli_ctx, resource_id, resource, api_version=None):
+    api_version = api_version or get_api_version_for_id(cli_ctx, resource_id)
+    return send_request(cli_ctx, "PUT", resource_id, api_version, body=resource)
+
+
+def update_resource(cli_ctx, resource_id, patch, api_version=None):
+    api_version = api_version or get_api_version_for_id(cli_ctx, resource_id)
+    return send_request(cli_ctx, "PATCH", resource_id, api_version, body=patch)
+
+
+def delete_resource(cli_ctx, resource_id, api_version=None):
+    api_version = api_version or get_api_version_for_id(cli_ctx, resource_id)
+    return send_request(cli_ctx, "DELETE", resource_id, api_version)
+
+
+def find_resource(cli_ctx, resource_type, name):
+    """Find a resource in the current subscription by type and name"""
+    resources = list_resources(
+        cli_ctx,
+        "/subscriptions/{}/resources".format(get_subscription_id(cli_ctx)),
+        RESOURCES_API_VERSION,
+        params={
+            "$filter": "resourceType eq '{}' and name eq '{}'".format(
+                resource_type, name
+            )
+        },
+    )
+    return resources[0] if resources else None
+
+
+def update_tags(cli_ctx, resource_id, tags, operation="Merge"):
+    """Merge or Delete tags without needing the resource's own api-version"""
+    return send_request(
+        cli_ctx,
+        "PATCH",
+        "{}/providers/Microsoft.Resources/tags/default".format(resource_id),
+        RESOURCES_API_VERSION,
+        body={"operation": operation, "properties": {"tags": tags}},
+    )
+
+
+def deploy_template(
+    cli_ctx, resource_group_name, deployment_name, template, parameters
+):
+    """Deploy a template to a resource group in incremental mode and wait for it to finish"""
+    deployment_id = "{}/{}".format(
+        get_deployments_path(cli_ctx, resource_group_name), deployment_name
+    )
+    body = {
+        "properties": {
+            "template": template,
+            "parameters": parameters,
+            "mode": "Incremental",
+        }
+    }
+
+    with tracing.span(
+        "deployment {}/{}".format(resource_group_name, deployment_name), "deployment"
+    ):
+        r = send_raw_request(
+            cli_ctx, "PUT", deployment_id, RESOURCES_API_VERSION, body=body
+        )
+        while True:
+            if r.status_code >= 400:
+                raise CLIError(get_error_message(r))
+            deployment = r.json()
+            state = deployment["properties"]["provisioningState"]
+            if state in DEPLOYMENT_TERMINAL_STATES:
+                break
+            time.sleep(int(r.headers.get("Retry-After", DEPLOYMENT_POLL_INTERVAL)))
+            r = send_raw_request(cli_ctx, "GET", deployment_id, RESOURCES_API_VERSION)
+
+    if state != "Succeeded":
+        error = deployment["properties"].get("error") or {}
+        raise CLIError(
+            "Deployment {} {}: {}".format(
+                deployment_name, state.lower(), error.get("message", "")
+            )
+        )
+    return deployment
+
+
+def get_deployments_path(cli_ctx, resource_group_name):
+    return "{}/providers/Microsoft.Resources/deployments".format(
+        get_resource_group_id(cli_ctx, resource_group_name)
+    )
+
+
+def list_deployments(cli_ctx, resource_group_name):
+    return iter_resources(
+        cli_ctx,
+        get_deployments_path(cli_ctx, resource_group_name),
+        RESOURCES_API_VERSION,
+    )
+
+
+def delete_deployment(cli_ctx, resource_group_name, deployment_name):
+    """Delete a deployment from the resource group's history. The resources it created are left alone"""
+    return send_request(
+        cli_ctx,
+        "DELETE",
+        "{}/{}".format(
+            get_deployments_path(cli_ctx, resource_group_name), deployment_name
+        ),
+        RESOURCES_API_VERSION,
+    )
+
+
+def cancel_deployment(cli_ctx, resource_group_name, deployment_name):
+    """Ask ARM to stop a running deployment. Raises if it has already finished"""
+    return send_request(
+        cli_ctx,
+        "POST",
+        "{}/{}/cancel".format(
+            get_deployments_path(cli_ctx, resource_group_name), deployment_name
+        ),
+        RESOURCES_API_VERSION,
+    )
+
+
+def get_role_definition_id(cli_ctx, scope, role):
+    # Accept role ids as well as role names, like `az role assignment` does
+    if role.startswith("/"):
+        return role
+    try:
+        return "/subscriptions/{}/providers/Microsoft.Authorization/roleDefinitions/{}".format(
+            get_subscription_id(cli_ctx), uuid.UUID(role)
+        )
+    except ValueError:
+        pass
+
+    definitions = list_resources(
+        cli_ctx,
+        "{}/providers/Microsoft.Authorization/roleDefinitions".format(scope),
+        AUTHORIZATION_API_VERSION,
+        params={"$filter": "roleName eq '{}'".format(role)},
+    )
+    if not definitions:
+        raise CLIError("Could not find role '{}'".format(role))
+    return definitions[0]["id"]
+
+
+def list_role_assignments(cli_ctx, scope, principal_id=None, role_definition_id=None):
+    params = {}
+    if principal_id:
+        params["$filter"] = "principalId eq '{}'".format(principal_id)
+
+    assignments = list_resources(
+        cli_ctx,
+        "{}/providers/Microsoft.Authorization/roleAssignments".format(scope),
+        AUTHORIZATION_API_VERSION,
+        params=params,
+    )
+    # Only assignments made directly on the scope, like `az role assignment list --scope`
+    assignments = [
+        a for a in assignments if a["properties"]["scope"].lower() == scope.lower()
+    ]
+    if role_definition_id:
+        # The definition id can be subscription-scoped or not depending on the caller, so compare the guid
+        definition = role_definition_id.split("/")[-1].lower()
+        assignments = [
+            a
+            for a in assignments
+            if a["properties"]["roleDefinitionId"].split("/")[-1].lower() == definition
+        ]
+    return assignments
+
+
+def create_role_assignment(
+    cli_ctx, scope, role_definition_id, principal_id, principal_type=None
+):
+    properties = {"roleDefinitionId": role_definition_id, "principalId": principal_id}
+    if principal_type:
+        properties["principalType"] = principal_type
+
+    return send_request(
+        cli_ctx,
+        "PUT",
+        "{}/providers/Microsoft.Authorization/roleAssignments/{}".format(
+            scope, uuid.uuid4()
+        ),
+        AUTHORIZATION_API_VERSION,
+        body={"properties": properties},
+    )
+
+
+def list_permissions(cli_ctx, scope, access_token=None):
+    """The caller's effective permissions at a scope, or another identity's if access_token is theirs"""
+    headers = None
+    if access_token:
+        headers = {"Authorization": "Bearer {}".format(access_token)}
+    result = send_request(
+        cli_ctx,
+        "GET",
+        "{}/providers/Microsoft.Authorization/permissions".format(scope),
+        PERMISSIONS_API_VERSION,
+        headers=headers,
+    )
+    if result is None:
+        raise CLIError("Could not find {}".format(scope))
+    return result.get("value", [])
@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import datetime
+
+from knack.log import get_logger
+
+from . import tracing
+
+LOGGER = get_logger(__name__)
+
+# Tokens are refreshed this many seconds before they expire, so a request never goes out with a stale one
+TOKEN_REFRESH_MARGIN = 300
+# For tokens that don't say when they expire
+DEFAULT_TOKEN_LIFETIME = 600
+
+# (tenant, resource, identity) -> {"token", "expires"}
+TOKENS = {}
+# requested subscription -> account from the CLI profile
+ACCOUNTS = {}
+# One lock per token key, so concurrent callers wait for a single refresh instead of each fetching their own
+TOKEN_LOCKS = {}
+TOKEN_LOCK = threading.Lock()
+
+
+def get_access_token(cli_ctx, resource=None):
+    """Returns (access token, subscription id) for the logged in account, from cache when possible"""
+    account = get_account(cli_ctx)
+    subscription = account["id"]
+
+    token = get_token(
+        account["tenantId"],
+        resource or cli_ctx.cloud.endpoints.active_directory_resource_id,
+        account["user"]["name"],
+        lambda: acquire_cli_token(cli_ctx, resource, subscription),
+    )
+    return token, subscription
+
+
+def get_subscription_id(cli_ctx):
+    return get_account(cli_ctx)["id"]
+
+
+def get_account(cli_ctx):
+    # `az --subscription` is recorded on the context by azure-cli
+    subscription = (getattr(cli_ctx, "data", None) or {}).get("subscription_id")
+    with TOKEN_LOCK:
+        if subscription not in ACCOUNTS:
+            from azure.cli.core._profile import Profile
+
+            ACCOUNTS[subscription] = Profile(cli_ctx=cli_ctx).get_subscription(
+                subscription
+            )
+        return ACCOUNTS[subscription]
+
+
+def acquire_cli_token(cli_ctx, resource, subscription):
+    """Fetch a token for the CLI's logged in account. Returns (access token, expiry as a timestamp)"""
+    from azure.cli.core._profile import Profile
+
+    creds, _, _ = Profile(cli_ctx=cli_ctx).get_raw_token(
+        resource=resource, subscription=subscription
+    )
+    return creds[1], get_expiry(creds[2])
+
+
+def get_token(tenant, resource, identity, acquire):
+    """Return a cached token for (tenant, resource, identity), calling acquire() for a new one when needed
+
+    acquire returns (access token, expiry as a timestamp)
+    """
+    key = (tenant, resource, identity)
+    with TOKEN_LOCK:
+        entry = TOKENS.get(key)
+        if is_fresh(entry):
+            return entry["token"]
+        key_lock = TOKEN_LOCKS.setdefault(key, threading.Lock())
+
+    with key_lock:
+        # Someone else may have refreshed it while we waited
+        with TOKEN_LOCK:
+            entry = TOKENS.get(key)
+        if is_fresh(entry):
+            return entry["token"]
+
+        with tracing.span("acquire_token", "token", resource=resource):
+            token, expires = acquire()
+        LOGGER.debug("acquired a token for %s, expiring at %s", resource, expires)
+        with TOKEN_LOCK:
+            TOKENS[key] = {"token": token, "expires": expires}
+        return token
+
+
+def is_fresh(entry):
+    return entry is not None and entry["expires"] - TOKEN_REFRESH_MARGIN > time.time()
+
+
+def get_expiry(token_entry):
+    """Find the expiry timestamp of an azure-cli (MSAL or ADAL) token entry"""
+    if "expires_on" in token_entry:
+        return float(token_entry["expires_on"])
+    if "expiresOn" in token_entry:
+        # ADAL reports local time
+        try:
+            expires_on = datetime.strptime(
+                token_entry["expiresOn"], "%Y-%m-%d %H:%M:%S.%f"
+            )
+            return time.mktime(expires_on.timetuple())
+        except ValueError:
+            pass
+    if "expiresIn" in token_entry:
+        return time.time() + int(token_entry["expiresIn"])
+    return time.time() + DEFAULT_TOKEN_LIFETIME
@@ -0,0 +1,198 @@
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+from io import StringIO
+
+from azure.cli.core._environment import get_config_dir
+from knack.log import get_logger
+
+from .in_process import (
+    IN_PROCESS_LOCK,
+    environment,
+    invoke_in_process,
+    reset_in_process_cli,
+)
+
+LOGGER = get_logger(__name__)
+
+# The worker keeps azure-cli imported between requests and serves `az_cli` commands over a Unix socket
+# Opt in with AZEXT_NOELBUNDICK_DAEMON=true. It exits on its own after being idle for a while
+DAEMON = {
+    "enabled": os.environ.get("AZEXT_NOELBUNDICK_DAEMON", "false").lower() == "true"
+    and hasattr(socket, "AF_UNIX"),
+    "idle_timeout": int(os.environ.get("AZEXT_NOELBUNDICK_DAEMON_IDLE", "600")),
+}
+SOCKET_PATH = os.path.join(get_config_dir(), "noelbundick-daemon.sock")
+LOCK_PATH = SOCKET_PATH + ".lock"
+
+# azure-cli only reads these when the CLI object is built, so the worker rebuilds it whenever one changes
+PROFILE_FILES = ("azureProfile.json", "config", "clouds.config")
+WORKER = {"profile": None}
+
+STARTUP_TIMEOUT = 15
+REQUEST_TIMEOUT = 600
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+def run_command(args, autostart=True):
+    """Run az `args` on the worker with this process's environment, returning (exit_code, stdout, stderr)"""
+    request = {"args": args, "env": dict(os.environ)}
+    try:
+        return _send(request)
+    except (OSError, ValueError) as ex:
+        if not autostart:
+            raise DaemonUnavailable(ex)
+        LOGGER.debug("az daemon not reachable, starting one: %s", ex)
+
+    start()
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.2)
+        try:
+            return _send(request)
+        except (OSError, ValueError):
+            continue
+    raise DaemonUnavailable(
+        "az daemon did not come up within {}s".format(STARTUP_TIMEOUT)
+    )
+
+
+def _send(request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(REQUEST_TIMEOUT)
+        sock.connect(SOCKET_PATH)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reader:
+            response = json.loads(reader.readline().decode("utf-8"))
+    finally:
+        sock.close()
+    return response["exit_code"], response["output"], response.get("error", "")
+
+
+def start():
+    # The extension directory isn't on sys.path for a bare interpreter
+    package_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        x for x in [package_dir, env.get("PYTHONPATH")] if x
+    )
+    with open(os.devnull, "wb") as devnull:
+        subprocess.Popen(
+            [sys.executable, "-m", "azext_noelbundick.az_daemon"],
+            env=env,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            start_new_session=True,
+        )
+
+
+class _ErrorStream:
+    """Stands in for the worker's stderr, so log handlers bound at startup write to the current request"""
+
+    def __init__(self):
+        self.target = sys.__stderr__
+
+    def write(self, text):
+        return self.target.write(text)
+
+    def flush(self):
+        self.target.flush()
+
+    @staticmethod
+    def isatty():
+        return False
+
+
+ERRORS = _ErrorStream()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        if request.get("ping"):
+            self.wfile.write(b'{"exit_code": 0, "output": ""}\n')
+            return
+
+        response = run_request(request)
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def run_request(request):
+    out_file = StringIO()
+    error = StringIO()
+    with IN_PROCESS_LOCK, environment(request["env"]):
+        refresh_profile()
+        ERRORS.target = error
+        try:
+            exit_code, result = invoke_in_process(request["args"], out_file)
+            if exit_code and not error.getvalue() and result.error:
+                error.write(str(result.error))
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("az daemon failed to run %s", request["args"])
+            exit_code = 1
+        finally:
+            ERRORS.target = sys.__stderr__
+    return {
+        "exit_code": exit_code,
+        "output": out_file.getvalue(),
+        "error": error.getvalue(),
+    }
+
+
+def refresh_profile():
+    """Reload azure-cli if `az login`, `az account set` or `az config` ran since it was loaded"""
+    stamp = []
+    for name in PROFILE_FILES:
+        try:
+            stamp.append(os.stat(os.path.join(get_config_dir(), name)).st_mtime)
+        except OSError:
+            stamp.append(None)
+    if stamp != WORKER["profile"]:
+        reset_in_process_cli()
+        WORKER["profile"] = stamp
+
+
+class _Server(socketserver.UnixStreamServer):
+    idle = False
+
+    def handle_timeout(self):
+        self.idle = True
+
+
+def serve(idle_timeout=None):
+    import fcntl
+
+    # Only one worker owns the socket. The OS drops the lock if that worker dies, so a stale socket is safe to replace
+    with open(LOCK_PATH, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+
+        sys.stderr = ERRORS
+        server = _Server(SOCKET_PATH, _RequestHandler)
+        os.chmod(SOCKET_PATH, 0o600)
+        server.timeout = idle_timeout or DAEMON["idle_timeout"]
+        try:
+            while not server.idle:
+                server.handle_request()
+        finally:
+            server.server_close()
+            if os.path.exists(SOCKET_PATH):
+                os.remove(SOCKET_PATH)
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,236 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from azure.cli.core._environment import get_config_dir
+from knack.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+CACHE_PATH = os.path.join(get_config_dir(), "noelbundick-cache.json")
+MAX_ENTRIES = 256
+
+# Cache hits append "<time>\t<key>" lines here instead of rewriting the cache, and the next write folds them in
+USED_PATH = os.path.join(get_config_dir(), "noelbundick-cache-used.log")
+
+# Suffix of the ARM path that PATCHes a resource's tags
+TAGS_SUFFIX = "/providers/microsoft.resources/tags/default"
+
+# Role assignments and locks on a resource don't change what a GET of it returns
+UNRELATED_PROVIDER = "/providers/microsoft.authorization/"
+
+# Resource types whose GETs are safe to cache, and how long (in seconds) to keep them. Only top-level resources
+# Never add types whose GET returns secrets - the cache is a plain file on disk
+CACHE_TTLS = {
+    "microsoft.containerregistry/registries": 300,
+    "microsoft.containerservice/managedclusters": 300,
+    "microsoft.keyvault/vaults": 300,
+    "microsoft.web/sites": 300,
+    "resourcegroups": 300,
+}
+
+# Set AZEXT_NOELBUNDICK_NO_CACHE=true, or pass --no-cache to an extension command, to bypass the cache
+CACHE = {
+    "enabled": os.environ.get("AZEXT_NOELBUNDICK_NO_CACHE", "false").lower() != "true",
+    # The extension's own commands, which accept --no-cache
+    "commands": set(),
+}
+CACHE_LOCK = threading.Lock()
+
+# The last cache file read, reused until the file changes
+LOADED = {"stamp": None, "entries": {}}
+
+
+def init(self):
+    from knack import events
+
+    CACHE["commands"] = set(self.command_table)
+    # An in-process CLI loads the command table once per command, so don't stack up handlers
+    for (event, handler) in [
+        (events.EVENT_INVOKER_POST_CMD_TBL_CREATE, add_no_cache_parameter),
+        (events.EVENT_INVOKER_POST_PARSE_ARGS, remove_no_cache_parameter),
+    ]:
+        self.cli_ctx.unregister_event(event, handler)
+        self.cli_ctx.register_event(event, handler)
+
+
+# pylint: disable=unused-argument
+def add_no_cache_parameter(cli_ctx, commands_loader):
+    from knack.arguments import CLICommandArgument
+
+    # Only this extension's commands get the flag - `az acr build` has its own --no-cache
+    command = commands_loader.command_table.get(commands_loader.command_name)
+    if command and commands_loader.command_name in CACHE["commands"]:
+        command.arguments["no_cache"] = CLICommandArgument(
+            "no_cache",
+            options_list=["--no-cache"],
+            action="store_true",
+            arg_group="Cache (noelbundick)",
+            help="Don't reuse cached Resource Manager reads",
+        )
+
+
+def remove_no_cache_parameter(_, **kwargs):
+    args = kwargs.get("args")
+    if "no_cache" in args:
+        if args.no_cache:
+            CACHE["enabled"] = False
+        delattr(args, "no_cache")
+
+
+def get_id_values(resource_id):
+    """A resource id, then the ids of its resource group and parent resources, which it goes stale with
+
+    A tags PATCH changes the resource the tags belong to
+    """
+    resource_id = resource_id.lower().rstrip("/")
+    if resource_id.endswith(TAGS_SUFFIX):
+        resource_id = resource_id[: -len(TAGS_SUFFIX)]
+
+    ids = [resource_id]
+    parts = resource_id.split("/")
+    if len(parts) > 5 and parts[3] == "resourcegroups":
+        # /subscriptions/{}/resourcegroups/{}/providers/{namespace}/{type}/{name}/{type}/{name}...
+        ids += ["/".join(parts[:n]) for n in [5] + list(range(9, len(parts), 2))]
+    return ids
+
+
+def get_ttl(path):
+    """How long a GET of this ARM path can be cached, or None if it can't be"""
+    parts = path.lower().strip("/").split("/")
+    if len(parts) == 4 and parts[2] == "resourcegroups":
+        return CACHE_TTLS.get("resourcegroups")
+    if len(parts) == 8 and parts[2] == "resourcegroups" and parts[4] == "providers":
+        return CACHE_TTLS.get("/".join(parts[5:7]))
+    return None
+
+
+def get_cache_key(path, api_version):
+    # The subscription is part of the path
+    return json.dumps([get_id_values(path)[0], api_version])
+
+
+def get(path, api_version):
+    """Return (True, result) for a fresh cached GET of an ARM path, otherwise (False, None)"""
+    if not CACHE["enabled"] or get_ttl(path) is None:
+        return False, None
+
+    key = get_cache_key(path, api_version)
+    with CACHE_LOCK:
+        entries = _read_entries()
+        entry = entries.get(key)
+        if not entry or entry["expires"] < time.time():
+            return False, None
+
+        _mark_used(key)
+
+    LOGGER.debug("cache hit: %s", path)
+    return True, entry["result"]
+
+
+def update(path, api_version, result):
+    """Record the result of a GET, if its path is one that's cached"""
+    ttl = get_ttl(path)
+    if ttl is None:
+        return
+
+    with CACHE_LOCK:
+        entries = _read_entries()
+        entries[get_cache_key(path, api_version)] = {
+            "values": get_id_values(path),
+            "expires": time.time() + ttl,
+            "used": time.time(),
+            "result": result,
+        }
+        _write_entries(entries)
+
+
+def invalidate_id(resource_id):
+    """Evict the entries that an ARM request changing `resource_id` may have touched"""
+    if UNRELATED_PROVIDER in resource_id.lower():
+        return
+    ids = get_id_values(resource_id)
+    # The resource itself, or one it's part of, or one that's part of it
+    _evict(
+        lambda entry: entry["values"][0] in ids or ids[0] in entry["values"],
+        resource_id,
+    )
+
+
+def _evict(is_stale, reason):
+    with CACHE_LOCK:
+        entries = _read_entries()
+        stale = [k for k, v in entries.items() if is_stale(v)]
+        if stale:
+            LOGGER.debug("cache: evicting %d entries after %s", len(stale), reason)
+            for k in stale:
+                del entries[k]
+            _write_entries(entries)
+
+
+def _read_entries():
+    try:
+        stat = os.stat(CACHE_PATH)
+    except OSError:
+        return {}
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if stamp != LOADED["stamp"]:
+        try:
+            with open(CACHE_PATH, "r") as cache_file:
+                LOADED["entries"] = json.load(cache_file)
+        except (OSError, ValueError):
+            LOADED["entries"] = {}
+        LOADED["stamp"] = stamp
+    return LOADED["entries"]
+
+
+def _mark_used(key):
+    try:
+        with open(USED_PATH, "a") as used_file:
+            used_file.write("{}\t{}\n".format(time.time(), key))
+    except OSError:
+        LOGGER.debug("Could not write cache file %s", USED_PATH)
+
+
+def _read_used():
+    used = {}
+    try:
+        with open(USED_PATH, "r") as used_file:
+            for line in used_file:
+                (timestamp, _, key) = line.rstrip("\n").partition("\t")
+                used[key] = float(timestamp)
+    except (OSError, ValueError):
+        pass
+    return used
+
+
+def _write_entries(entries):
+    now = time.time()
+    entries = {k: v for k, v in entries.items() if v["expires"] >= now}
+    for (key, used) in _read_used().items():
+        if key in entries:
+            entries[key]["used"] = max(entries[key]["used"], used)
+
+    # LRU eviction
+    if len(entries) > MAX_ENTRIES:
+        keep = sorted(entries, key=lambda k: entries[k]["used"])[-MAX_ENTRIES:]
+        entries = {k: entries[k] for k in keep}
+
+    # Keep the file private and swap it in atomically
+    LOADED["stamp"] = None
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(CACHE_PATH))
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, CACHE_PATH)
+        if os.path.exists(USED_PATH):
+            os.remove(USED_PATH)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.debug("Could not write cache file %s", CACHE_PATH)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
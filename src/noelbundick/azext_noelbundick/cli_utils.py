@@ -1,22 +1,121 @@
 import json
 import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import StringIO
 from subprocess import CalledProcessError, check_output
 
 from knack.log import get_logger
 from knack.util import CLIError
 
+from . import tracing
+from .in_process import IN_PROCESS, InProcessUnavailable, invoke_in_process
+
 LOGGER = get_logger(__name__)
 
+AZ_COMMAND = [sys.executable, "-m", "azure.cli"]
+
+# Default number of run_many calls that run at once
+MAX_WORKERS = 4
+
+AzCliResult = namedtuple("AzCliResult", ["result", "error"])
+
 
 def az_cli(cmd, env=None, output_as_json=True):
+    words = get_command_words(cmd)
+    with tracing.span("az " + " ".join(words), "az_cli", args=cmd) as record:
+        result = _run_az_cli(cmd, env=env, output_as_json=output_as_json)
+        if tracing.TRACE["enabled"]:
+            record["size"] = len(json.dumps(result, default=str))
+        return result
+
+
+def get_command_words(cmd):
+    words = []
+    for arg in cmd:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+    return words
+
+
+def run_many(calls, max_workers=MAX_WORKERS, fail_fast=False):
+    """Run independent no-arg callables concurrently. Returns an AzCliResult per call, in order"""
+    results = [None] * len(calls)
+    for (idx, item) in iter_many(calls, max_workers=max_workers, fail_fast=fail_fast):
+        results[idx] = item
+    return results
+
+
+def iter_many(calls, max_workers=MAX_WORKERS, fail_fast=False):
+    """Like run_many, but yields (index, AzCliResult) as each call finishes"""
+    if not calls:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+        futures = {executor.submit(call): idx for idx, call in enumerate(calls)}
+        for future in as_completed(futures):
+            try:
+                item = AzCliResult(future.result(), None)
+            except Exception as ex:  # pylint: disable=broad-except
+                item = AzCliResult(None, ex)
+                if fail_fast:
+                    for pending in futures:
+                        pending.cancel()
+            yield futures[future], item
+
+
+def raise_for_errors(results):
+    """Unwrap run_many results, raising the first error"""
+    for item in results:
+        if item.error is not None:
+            raise item.error
+    return [item.result for item in results]
+
+
+def _run_az_cli(cmd, env=None, output_as_json=True):
+    if IN_PROCESS["enabled"] and env is None:
+        try:
+            return run_cli_command_in_process(cmd, output_as_json=output_as_json)
+        except InProcessUnavailable as ex:
+            LOGGER.debug("in-process execution unavailable, falling back: %s", ex)
+            IN_PROCESS["enabled"] = False
+
     cli_cmd = prepare_cli_command(cmd, output_as_json=output_as_json)
     json_cmd_output = run_cli_command(cli_cmd, output_as_json=output_as_json, env=env)
     return json_cmd_output
 
 
+def run_cli_command_in_process(cmd, output_as_json=True, empty_json_as_error=False):
+    out_file = StringIO()
+
+    # json results are read straight off the result object, so skip formatting them
+    output = "none" if output_as_json else "tsv"
+    exit_code, result = invoke_in_process(list(cmd) + ["--output", output], out_file)
+
+    if exit_code:
+        LOGGER.error("command failed: %s", cmd)
+        LOGGER.error("error: %s", result.error)
+        raise CalledProcessError(
+            exit_code, cmd, output=out_file.getvalue(), stderr=str(result.error)
+        )
+
+    LOGGER.debug("command: %s ended with result: %s", cmd, result.result)
+    if output_as_json:
+        if result.result is None and empty_json_as_error:
+            raise CLIError("Command returned an unexpected empty string.")
+        return result.result
+
+    return out_file.getvalue().strip()
+
+
 def run_cli_command(cmd, output_as_json=True, empty_json_as_error=False, env=None):
     try:
-        cmd_output = check_output(cmd, universal_newlines=True, env=env)
+        cmd_output = None
+        if env is None:
+            cmd_output = run_cli_command_on_daemon(cmd)
+        if cmd_output is None:
+            cmd_output = check_output(cmd, universal_newlines=True, env=env)
         LOGGER.debug("command: %s ended with output: %s", cmd, cmd_output)
 
         if output_as_json:
@@ -31,14 +130,34 @@ def run_cli_command(cmd, output_as_json=True, empty_json_as_error=False, env=Non
     except CalledProcessError as ex:
         LOGGER.error("command failed: %s", cmd)
         LOGGER.error("output: %s", ex.output)
+        if ex.stderr:
+            LOGGER.error("error: %s", ex.stderr)
         raise ex
     except Exception:
         LOGGER.error("command ended with an error: %s", cmd)
         raise
 
 
+def run_cli_command_on_daemon(cmd):
+    from .az_daemon import DAEMON, DaemonUnavailable, run_command
+
+    if not DAEMON["enabled"]:
+        return None
+
+    try:
+        exit_code, cmd_output, error = run_command(cmd[len(AZ_COMMAND) :])
+    except DaemonUnavailable as ex:
+        LOGGER.warning("az daemon is unhealthy, using a fresh process instead: %s", ex)
+        DAEMON["enabled"] = False
+        return None
+
+    if exit_code:
+        raise CalledProcessError(exit_code, cmd, output=cmd_output, stderr=error)
+    return cmd_output
+
+
 def prepare_cli_command(cmd, output_as_json=True):
-    full_cmd = [sys.executable, "-m", "azure.cli"] + cmd
+    full_cmd = AZ_COMMAND + cmd
 
     if output_as_json:
         full_cmd += ["--output", "json"]
@@ -0,0 +1,112 @@
+import importlib
+import json
+import os
+
+from azure.cli.core._environment import get_config_dir
+from knack.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+INDEX_PATH = os.path.join(get_config_dir(), "noelbundick-command-index.json")
+PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
+PACKAGE_NAME = __name__.rsplit(".", 1)[0]
+
+# The index is read on every az invocation, so keep it in memory for in-process and daemon reuse too
+INDEX = {}
+
+
+def get_index(loader_cls, cli_ctx, module_names):
+    """The command -> module / argument index, rebuilt whenever the installed extension changes
+
+    {
+        "key": fingerprint of the extension's files,
+        "commands": {command: module},
+        "arguments": {command: {dest: [options]}},
+        "argument_scopes": {module: [scopes its load_arguments registers]},
+    }
+    """
+    key = get_key(module_names)
+    if INDEX.get("key") == key:
+        return INDEX
+
+    index = _read_index()
+    if index.get("key") != key:
+        LOGGER.debug("Rebuilding command index %s", INDEX_PATH)
+        index = build_index(loader_cls, cli_ctx, module_names)
+        index["key"] = key
+        _write_index(index)
+
+    INDEX.clear()
+    INDEX.update(index)
+    return INDEX
+
+
+def get_key(module_names):
+    # Upgrading the extension replaces its files, and so do local edits during development
+    # Either one changes the size or mtime of something here, without having to look up package metadata
+    key = [list(module_names)]
+    for name in sorted(os.listdir(PACKAGE_DIR)):
+        if name.endswith((".py", ".json")):
+            stat = os.stat(os.path.join(PACKAGE_DIR, name))
+            key.append([name, stat.st_size, int(stat.st_mtime)])
+    return key
+
+
+def build_index(loader_cls, cli_ctx, module_names):
+    index = {"commands": {}, "arguments": {}, "argument_scopes": {}}
+    registry = {}
+
+    for name in module_names:
+        module = importlib.import_module("{}.{}".format(PACKAGE_NAME, name))
+
+        # A scratch loader per module, so each module's commands and argument scopes can be told apart
+        loader = loader_cls(cli_ctx=cli_ctx)
+        loader.skip_applicability = True
+        module.load_command_table(loader, None)
+        module.load_arguments(loader, None)
+
+        for command in loader.command_table:
+            index["commands"][command] = name
+        scopes = loader.argument_registry.arguments
+        index["argument_scopes"][name] = sorted(scopes)
+        for (scope, arguments) in scopes.items():
+            registry.setdefault(scope, {}).update(arguments)
+
+    for command in index["commands"]:
+        arguments = {}
+        # Less specific scopes first, like knack applies them
+        for scope in sorted(registry, key=len):
+            if applies_to(scope, command):
+                for (dest, argument) in registry[scope].items():
+                    options = argument.settings.get("options_list")
+                    if options:
+                        arguments[dest] = [str(o) for o in options]
+        index["arguments"][command] = arguments
+    return index
+
+
+def applies_to(scope, command):
+    return not scope or command == scope or command.startswith(scope + " ")
+
+
+def _read_index():
+    try:
+        with open(INDEX_PATH, "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(index):
+    import tempfile
+
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(INDEX_PATH))
+        with os.fdopen(fd, "w") as index_file:
+            json.dump(index, index_file, separators=(",", ":"))
+        os.replace(temp_path, INDEX_PATH)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.debug("Could not write command index %s", INDEX_PATH)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,245 @@
+from functools import partial
+
+from azure.cli.core.commands import CliCommandType
+from knack.log import get_logger
+from knack.util import CLIError
+
+from . import arm as arm_client
+from . import ledger
+from .cli_utils import raise_for_errors, run_many
+from .self_destruct import (
+    ARMED_COLUMNS,
+    BULK_WORKERS,
+    LOGIC_API_VERSION,
+    get_logic_app_parts,
+    get_self_destruct_query,
+    get_window_time,
+    read_ids_file,
+)
+
+LOGGER = get_logger(__name__)
+
+
+def load_command_table(self, _):
+    custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
+
+    with self.command_group("self-destruct", custom_command_type=custom) as g:
+        g.custom_command("disarm", "disarm")
+
+
+def load_arguments(self, _):
+    with self.argument_context("self-destruct disarm") as c:
+        c.argument("resource_id", options_list=["--id"])
+        c.argument("resource_ids", options_list=["--ids"], nargs="+")
+        c.argument("ids_file", options_list=["--ids-file"])
+        c.argument("tag", options_list=["--tag"])
+        c.argument("resource_type", options_list=["--resource-type"])
+        c.argument("resource_group_name", options_list=["--resource-group", "-g"])
+        c.argument("before", options_list=["--before"])
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def disarm(
+    cmd,
+    resource_id=None,
+    resource_group_name=None,
+    resource_ids=None,
+    ids_file=None,
+    tag=None,
+    resource_type=None,
+    before=None,
+):
+    cli_ctx = cmd.cli_ctx
+    selecting = tag or resource_type or before
+    targets = get_armed_targets(
+        cli_ctx,
+        resource_id=resource_id,
+        resource_group_name=resource_group_name,
+        resource_ids=resource_ids,
+        ids_file=ids_file,
+        tag=tag,
+        resource_type=resource_type,
+        before=before,
+    )
+
+    # Targets are independent, so they're all disarmed at once
+    results = run_many(
+        [partial(disarm_target, cli_ctx, t) for t in targets],
+        max_workers=BULK_WORKERS,
+    )
+    summary = []
+    for (target, result) in zip(targets, results):
+        status = result.result
+        if result.error is not None:
+            status = "Failed: {}".format(result.error)
+        summary.append(
+            {"id": target["resource_id"], "name": target["name"], "status": status}
+        )
+    ledger.record_disarmed(
+        [s["id"] for s in summary if not s["status"].startswith("Failed")]
+    )
+
+    if len(summary) == 1 and not selecting:
+        # One resource disarms (or fails) the way it always has
+        target, result = summary[0], results[0]
+        if result.error is not None:
+            raise result.error
+        if target["status"] == "Not found":
+            raise CLIError("Could not find resource with id: {}".format(target["id"]))
+        if target["status"] == "Not armed":
+            raise CLIError(
+                "Could not find a self-destruct Logic App for resource with id: {}".format(
+                    target["name"]
+                )
+            )
+        LOGGER.warning("Self-destruct sequence deactivated for %s", target["name"])
+        return summary
+
+    LOGGER.warning(
+        "Self-destruct sequence deactivated for %d of %d resources",
+        sum(1 for s in summary if s["status"] == "Disarmed"),
+        len(summary),
+    )
+    return summary
+
+
+# pylint: disable=too-many-arguments
+def get_armed_targets(
+    cli_ctx,
+    resource_id=None,
+    resource_group_name=None,
+    resource_ids=None,
+    ids_file=None,
+    tag=None,
+    resource_type=None,
+    before=None,
+):
+    """Targets for disarm and extend, from --id/--ids/--ids-file, and every armed resource a selector matches"""
+    ids = ([resource_id] if resource_id else []) + list(resource_ids or [])
+    if ids_file:
+        ids.extend(read_ids_file(ids_file))
+
+    # --tag, --resource-type and --before pick armed resources (within -g, if given). Otherwise -g is the group itself
+    selecting = tag or resource_type or before
+    if not ids and not selecting:
+        if not resource_group_name:
+            raise CLIError(
+                "You must specify resource ids, a resource group name, --tag, --resource-type or --before"
+            )
+        ids = [arm_client.get_resource_group_id(cli_ctx, resource_group_name)]
+
+    targets = get_disarm_targets(cli_ctx, ids)
+    if selecting:
+        rows = arm_client.query_resources(
+            cli_ctx,
+            get_self_destruct_query(
+                resource_type=resource_type,
+                resource_group_name=resource_group_name,
+                before=get_window_time(before) if before else None,
+                tag=tag,
+                columns=ARMED_COLUMNS,
+            ),
+        )
+        targets.extend(
+            get_disarm_target(r["id"], r["date"], swept=bool(r["apiVersion"]))
+            for r in rows
+        )
+    unique = {}
+    for target in targets:
+        unique.setdefault(target["resource_id"].lower(), target)
+    return list(unique.values())
+
+
+def get_disarm_targets(cli_ctx, resource_ids):
+    """How each resource was armed: from the ledger if it's there, otherwise from the resource's tags"""
+    from .sweeper import API_VERSION_TAG
+
+    targets, unknown = [], []
+    for resource_id in resource_ids:
+        entry = ledger.get(resource_id)
+        if entry:
+            targets.append(entry)
+        else:
+            unknown.append(resource_id)
+
+    lookups = run_many(
+        [partial(arm_client.show_resource, cli_ctx, i) for i in unknown],
+        max_workers=BULK_WORKERS,
+    )
+    for (resource_id, lookup) in zip(unknown, lookups):
+        resource = lookup.result or {}
+        tags = resource.get("tags") or {}
+        target = get_disarm_target(
+            resource.get("id", resource_id),
+            tags.get("self-destruct-date"),
+            swept=API_VERSION_TAG in tags,
+        )
+        if lookup.error is not None:
+            target["error"] = lookup.error
+        elif not resource:
+            target["missing"] = True
+        targets.append(target)
+    return targets
+
+
+def get_disarm_target(resource_id, date_tag, swept=False):
+    resource_group, name, logic_app = get_logic_app_parts(resource_id)
+    return {
+        "resource_id": resource_id,
+        "resource_group": resource_group,
+        "name": name,
+        "date_tag": date_tag,
+        "logic_app": None if swept else logic_app,
+    }
+
+
+def get_target_logic_app_id(target):
+    return "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Logic/workflows/{}".format(
+        target["resource_id"].split("/")[2],
+        target["resource_group"],
+        target["logic_app"],
+    )
+
+
+def disarm_target(cli_ctx, target):
+    """Delete a target's Logic App and remove its tags, side by side. Returns its status for the summary"""
+    if target.get("error") is not None:
+        raise target["error"]
+    if target.get("missing"):
+        return "Not found"
+
+    calls = []
+    if target["logic_app"]:
+        calls.append(
+            partial(delete_logic_app, cli_ctx, get_target_logic_app_id(target))
+        )
+    if target["date_tag"] is not None:
+        calls.append(
+            partial(
+                arm_client.update_tags,
+                cli_ctx,
+                target["resource_id"],
+                {"self-destruct": "", "self-destruct-date": target["date_tag"]},
+                operation="Delete",
+            )
+        )
+    results = raise_for_errors(run_many(calls, max_workers=len(calls) or 1))
+
+    if target["date_tag"] is not None and results[-1] is None:
+        # The tags 404'd: the resource was deleted since the ledger (or the query) saw it
+        return "Not found"
+    deleted_logic_app = bool(target["logic_app"]) and results[0]
+    if deleted_logic_app or target["date_tag"] is not None:
+        return "Disarmed"
+    return "Not armed"
+
+
+def delete_logic_app(cli_ctx, logic_app_id):
+    """Returns False if there was no Logic App to delete"""
+    r = arm_client.send_raw_request(cli_ctx, "DELETE", logic_app_id, LOGIC_API_VERSION)
+    # ARM answers 204 when there was nothing to delete
+    if r.status_code in (204, 404):
+        return False
+    if r.status_code >= 400:
+        raise CLIError(arm_client.get_error_message(r))
+    return True
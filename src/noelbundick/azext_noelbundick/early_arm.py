@@ -0,0 +1,478 @@
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from functools import partial
+
+from knack.log import get_logger
+from knack.util import CLIError
+
+from . import arm as arm_client
+from .cli_utils import run_many
+from .disarm import delete_logic_app
+from .in_process import is_nested_invocation
+from .self_destruct import (
+    BULK_WORKERS,
+    SELF_DESTRUCT,
+    check_service_principal,
+    deploy_self_destruct_group,
+    deploy_self_destruct_templates,
+    get_deployment_name,
+    get_destruct_time,
+    get_resource_type,
+    get_self_destruct_target,
+    is_self_destruct_deployment,
+    read_self_destruct_sp_config,
+    tag_armed,
+)
+
+LOGGER = get_logger(__name__)
+
+# `az <group> create` commands whose new resource id is known from -n and -g before the command runs,
+# so `--self-destruct` can arm it while it's being created
+PREDICTABLE_TYPES = {
+    "acr": "Microsoft.ContainerRegistry/registries",
+    "aks": "Microsoft.ContainerService/managedClusters",
+    "appservice plan": "Microsoft.Web/serverfarms",
+    "cosmosdb": "Microsoft.DocumentDB/databaseAccounts",
+    "functionapp": "Microsoft.Web/sites",
+    "keyvault": "Microsoft.KeyVault/vaults",
+    "network nic": "Microsoft.Network/networkInterfaces",
+    "network nsg": "Microsoft.Network/networkSecurityGroups",
+    "network public-ip": "Microsoft.Network/publicIPAddresses",
+    "network vnet": "Microsoft.Network/virtualNetworks",
+    "storage account": "Microsoft.Storage/storageAccounts",
+    "vm": "Microsoft.Compute/virtualMachines",
+    "webapp": "Microsoft.Web/sites",
+}
+# Deployment timestamps come from ARM's clock, not ours
+CLOCK_SKEW = timedelta(minutes=5)
+# Guards an early arm's `target` and `cancelled`, so it can't start deploying after it was cancelled
+EARLY_LOCK = threading.Lock()
+
+
+# Only registered for invocations that use --self-destruct, see MODULE_FEATURES in __init__.py
+def register_hooks(self):
+    from knack import events
+
+    # In pre-parse args, we'll gather the --self-destruct arguments and validate them
+    self.register_event(
+        events.EVENT_INVOKER_PRE_PARSE_ARGS, self_destruct_pre_parse_args_handler
+    )
+
+    # Inject the --self-destruct parameter to the command table
+    self.register_event(
+        events.EVENT_INVOKER_POST_CMD_TBL_CREATE, self_destruct_add_parameters
+    )
+
+    # Strip the --self-destruct args
+    self.register_event(
+        events.EVENT_INVOKER_POST_PARSE_ARGS, self_destruct_post_parse_args_handler
+    )
+
+    # If the command failed, take back anything that was armed while it ran
+    self.register_event(
+        events.EVENT_CLI_POST_EXECUTE, self_destruct_post_execute_handler
+    )
+
+    # In result transform, we can access the created resource id, and create a Logic App that will delete it at the specified time offset
+    self.register_event(
+        events.EVENT_INVOKER_TRANSFORM_RESULT, self_destruct_transform_handler
+    )
+
+
+# --self-destruct works on other modules' create commands, so there are no commands or arguments of its own here.
+# The loader still calls load_arguments for every module it has loaded
+def load_arguments(_, __):
+    pass
+
+
+# TODO: update tags of an existing resource during the Logic App ARM template deployment
+def add_self_destruct_tag_args(args, destroy_date):
+    exclude = {"identity", "container"}
+
+    if exclude.intersection(args):
+        LOGGER.warning(
+            "Cannot add tags for this resource - it won't show in `az self-destruct list`"
+        )
+        return
+
+    create_tags = True
+    for idx, arg in enumerate(args):
+        if arg == "--tags":
+            create_tags = False
+            args.insert(idx + 1, "self-destruct-date={}".format(destroy_date))
+            args.insert(idx + 1, "self-destruct=")
+
+    if create_tags:
+        args.extend(
+            ["--tags", "self-destruct", "self-destruct-date={}".format(destroy_date)]
+        )
+
+
+def self_destruct_pre_parse_args_handler(cli_ctx, **kwargs):
+    # Nested in-process az calls share this module's state - only act on the outer command
+    if is_nested_invocation():
+        return
+
+    args = kwargs.get("args")
+    SELF_DESTRUCT["active"] = False
+    SELF_DESTRUCT["early"] = None
+
+    # activate only when --self-destruct is activated
+    if "--self-destruct" in args:
+
+        # simple validations
+        if "create" not in args:
+            raise CLIError(
+                "You can only initiate a self-destruct sequence when creating a resource"
+            )
+        if "container" in args:
+            raise CLIError("`az container create` does not support tags")
+
+        if "--self-destruct-sp" in args:
+            read_self_destruct_sp_config()
+
+        index = args.index("--self-destruct")
+        delta_str = args[index + 1]
+        SELF_DESTRUCT["destroyDate"] = get_destruct_time(delta_str)
+        SELF_DESTRUCT["started"] = datetime.utcnow()
+        SELF_DESTRUCT["active"] = True
+
+        add_self_destruct_tag_args(args, SELF_DESTRUCT["destroyDate"])
+        start_early_arm(cli_ctx, args)
+
+
+def start_early_arm(cli_ctx, args):
+    """Start arming the resource a create command will make, so the arm and the create run side by side
+
+    Only for commands whose new resource id can be predicted from their args. The transform handler checks the
+    prediction against what was really created, and arms anything else
+    """
+    resource_id = predict_resource_id(cli_ctx, args)
+    if not resource_id:
+        return
+
+    LOGGER.info("Arming %s while it's created", resource_id)
+    early = {
+        "id": resource_id,
+        "destroyDate": SELF_DESTRUCT["destroyDate"],
+        "future": Future(),
+    }
+    SELF_DESTRUCT["early"] = early
+    # A daemon thread, so a command that fails can exit without waiting for the deployment
+    threading.Thread(target=run_early_arm, args=(cli_ctx, early), daemon=True).start()
+
+
+def run_early_arm(cli_ctx, early):
+    if not early["future"].set_running_or_notify_cancel():
+        return
+    try:
+        early["future"].set_result(arm_early(cli_ctx, early))
+    except Exception as ex:  # pylint: disable=broad-except
+        early["future"].set_exception(ex)
+
+
+def predict_resource_id(cli_ctx, args):
+    """The id of the resource `az <group> create -n name -g group` will make, or None if it can't be known yet"""
+    command = []
+    for arg in args:
+        if arg.startswith("-"):
+            break
+        command.append(arg)
+    if command[-1:] != ["create"] or "--subscription" in args:
+        return None
+
+    resource_type = PREDICTABLE_TYPES.get(" ".join(command[:-1]))
+    name = get_arg_value(args, ("--name", "-n"))
+    if not (resource_type and name):
+        return None
+    resource_group = get_arg_value(
+        args, ("--resource-group", "-g")
+    ) or cli_ctx.config.get("defaults", "group", None)
+    if not resource_group:
+        return None
+
+    return "{}/providers/{}/{}".format(
+        arm_client.get_resource_group_id(cli_ctx, resource_group),
+        resource_type,
+        name,
+    )
+
+
+def get_arg_value(args, options):
+    """The value of the first of these options, as `--name value` or `--name=value`"""
+    for (idx, arg) in enumerate(args):
+        option, equals, value = arg.partition("=")
+        if option not in options:
+            continue
+        if equals:
+            return value
+        if idx + 1 < len(args) and not args[idx + 1].startswith("-"):
+            return args[idx + 1]
+    return None
+
+
+def arm_early(cli_ctx, early):
+    """Deploy the Logic App for a resource that's still being created. Returns its target"""
+    resource_id = early["id"]
+    target = get_self_destruct_target(cli_ctx, {"id": resource_id})
+    if "clientId" in SELF_DESTRUCT:
+        denied = check_service_principal(cli_ctx, [target])
+        if denied:
+            raise CLIError(denied[resource_id])
+    with EARLY_LOCK:
+        if early.get("cancelled"):
+            raise CLIError("The early arm of {} was cancelled".format(resource_id))
+        early["target"] = target
+    deploy_self_destruct_group(
+        cli_ctx,
+        target["resourceGroup"],
+        get_deployment_name([target], target["destroyDate"]),
+        [target],
+    )
+    return target
+
+
+def claim_early_arm(cli_ctx, resources):
+    """The early arm, if there was one and the command really created its resource
+
+    An arm for a resource that wasn't created (a wrong prediction) is taken back
+    """
+    early, SELF_DESTRUCT["early"] = SELF_DESTRUCT.get("early"), None
+    if early is None or early["id"].lower() in {r["id"].lower() for r in resources}:
+        return early
+
+    LOGGER.info("%s wasn't created, so it won't self-destruct", early["id"])
+    cancel_early_arm(cli_ctx, early)
+    return None
+
+
+def cancel_early_arm(cli_ctx, early):
+    """Stop an early arm without waiting for it to finish
+
+    Before it deploys, it's told not to. After, its deployment is cancelled and any Logic App it made is deleted
+    """
+    if early["future"].cancel():
+        return
+    with EARLY_LOCK:
+        early["cancelled"] = True
+        target = early.get("target")
+    if target is None:
+        return
+
+    try:
+        arm_client.cancel_deployment(
+            cli_ctx,
+            target["resourceGroup"],
+            get_deployment_name([target], target["destroyDate"]),
+        )
+    except CLIError as ex:
+        # Most likely it already finished
+        LOGGER.debug("Could not cancel the early arm of %s: %s", target["id"], ex)
+    take_back_early_arm(cli_ctx, target)
+
+
+def take_back_early_arm(cli_ctx, target):
+    logic_app_id = "{}/providers/Microsoft.Logic/workflows/{}".format(
+        "/".join(target["id"].split("/")[:5]), target["logicAppName"]
+    )
+    try:
+        delete_logic_app(cli_ctx, logic_app_id)
+    except CLIError as ex:
+        LOGGER.warning("Could not delete %s: %s", logic_app_id, ex)
+
+
+def self_destruct_post_execute_handler(cli_ctx, **_):
+    if is_nested_invocation():
+        return
+    early, SELF_DESTRUCT["early"] = SELF_DESTRUCT.get("early"), None
+    if early is None:
+        return
+    # The command failed before its result was transformed, so the early arm was never claimed
+    LOGGER.warning(
+        "The command failed, so the self-destruct sequence for %s is cancelled",
+        early["id"],
+    )
+    cancel_early_arm(cli_ctx, early)
+
+
+def self_destruct_post_parse_args_handler(_, **kwargs):
+    args = kwargs.get("args")
+
+    if "self_destruct" in args:
+        delattr(args, "self_destruct")
+    if "self_destruct_sp" in args:
+        delattr(args, "self_destruct_sp")
+
+
+def self_destruct_transform_handler(cli_ctx, **kwargs):
+    # Nested in-process az calls share this module's state - only act on the outer command
+    if SELF_DESTRUCT["active"] and not is_nested_invocation():
+        result = kwargs.get("event_data")["result"]
+        resources = get_created_resources(cli_ctx, result)
+        early = claim_early_arm(cli_ctx, resources)
+        if not resources:
+            raise CLIError(
+                "Could not find the resource this command created. Use `az self-destruct arm` instead"
+            )
+
+        armed, errors = deploy_self_destruct_templates(
+            cli_ctx, resources, stagger=True, early=early
+        )
+        # --tags only reached what the command module passed them to, and only with the unstaggered date
+        for (target, tag_result) in zip(armed, tag_armed(cli_ctx, armed)):
+            if tag_result.error is not None:
+                LOGGER.warning(
+                    "Could not tag %s, so it won't show in `az self-destruct list`: %s",
+                    target["id"],
+                    tag_result.error,
+                )
+        if errors:
+            raise CLIError(
+                "Could not activate a self-destruct sequence for {} of {} resources:\n{}".format(
+                    len(resources) - len(armed), len(resources), "\n".join(errors)
+                )
+            )
+
+
+def get_created_resources(cli_ctx, result):
+    """Every resource a create command made: the ones in its result, whatever the deployment it ran made,
+    and the disks a new VM made for itself"""
+    created = {}
+    for resource_id in iter_result_ids(result):
+        created.setdefault(resource_id.lower(), resource_id)
+    for resource_id in get_deployed_ids(cli_ctx, list(created.values())):
+        created.setdefault(resource_id.lower(), resource_id)
+
+    vms = [
+        i
+        for i in created.values()
+        if get_resource_type(i).lower() == "microsoft.compute/virtualmachines"
+    ]
+    results = run_many(
+        [partial(get_vm_disk_ids, cli_ctx, i) for i in vms], max_workers=BULK_WORKERS
+    )
+    for (vm_id, disks) in zip(vms, results):
+        if disks.error is not None:
+            LOGGER.warning("Could not find the disks of %s: %s", vm_id, disks.error)
+            continue
+        for resource_id in disks.result:
+            created.setdefault(resource_id.lower(), resource_id)
+
+    return [{"id": i, "type": get_resource_type(i)} for i in created.values()]
+
+
+def iter_result_ids(value, root=True):
+    """The resources in a create command's result, however the command module wrapped them
+
+    Some command modules (ahem, networking...) output data in bizarro formats, like {"newVNet": {...}}
+    Besides the result itself, only full resources (with a type) count. Bare {"id": ...} references, like a NIC's
+    subnet or an NSG that already existed, are things the new resource uses, not things the command made.
+    Child resources like subnets go with their parent
+    """
+    if isinstance(value, list):
+        for item in value:
+            for resource_id in iter_result_ids(item, root=False):
+                yield resource_id
+        return
+    if not isinstance(value, dict):
+        return
+
+    resource_id = value.get("id")
+    if (
+        isinstance(resource_id, str)
+        and (root or value.get("type"))
+        and is_top_level_id(resource_id)
+    ):
+        yield resource_id
+    for item in value.values():
+        for resource_id in iter_result_ids(item, root=False):
+            yield resource_id
+
+
+def is_top_level_id(resource_id):
+    """A resource group, or a resource in one that isn't a child of another resource"""
+    parts = resource_id.strip("/").split("/")
+    if len(parts) < 4 or parts[0].lower() != "subscriptions":
+        return False
+    if parts[2].lower() != "resourcegroups":
+        return False
+    return len(parts) == 4 or (len(parts) == 8 and parts[4].lower() == "providers")
+
+
+def get_deployed_ids(cli_ctx, resource_ids):
+    """Everything made by the deployments that made these resources during this command
+
+    Commands like `az vm create` deploy a template, and its outputResources have the NIC, NSG, public IP and VNet
+    that the command's result doesn't mention
+    """
+    since = (SELF_DESTRUCT["started"] - CLOCK_SKEW).strftime("%Y-%m-%dT%H:%M:%S")
+    wanted = {i.lower() for i in resource_ids}
+    groups = sorted(
+        {"/".join(i.split("/")[:5]).lower() for i in resource_ids if is_top_level_id(i)}
+    )
+    results = run_many(
+        [
+            partial(arm_client.list_deployments, cli_ctx, g.split("/")[-1])
+            for g in groups
+        ],
+        max_workers=BULK_WORKERS,
+    )
+
+    deployed = []
+    for (group, deployments) in zip(groups, results):
+        if deployments.error is not None:
+            LOGGER.warning(
+                "Could not find what else was deployed in %s: %s",
+                group,
+                deployments.error,
+            )
+            continue
+        for deployment in deployments.result:
+            properties = deployment["properties"]
+            if is_self_destruct_deployment(deployment["name"]):
+                continue
+            if properties.get("timestamp", "") < since:
+                continue
+            outputs = [r["id"] for r in properties.get("outputResources") or []]
+            if wanted.intersection(o.lower() for o in outputs):
+                deployed.extend(o for o in outputs if is_top_level_id(o))
+    return deployed
+
+
+def get_vm_disk_ids(cli_ctx, vm_id):
+    """The managed disks a VM made for itself. Attached disks (--attach-os-disk, --attach-data-disks) aren't ours to
+    delete, and disks that are deleted along with the VM don't need a Logic App"""
+    vm = arm_client.show_resource(cli_ctx, vm_id) or {}
+    storage = vm.get("properties", {}).get("storageProfile", {})
+    disks = [storage.get("osDisk") or {}] + (storage.get("dataDisks") or [])
+    return [
+        d["managedDisk"]["id"]
+        for d in disks
+        if d.get("createOption") in ("FromImage", "Empty")
+        and d.get("deleteOption") != "Delete"
+        and (d.get("managedDisk") or {}).get("id")
+    ]
+
+
+# pylint: disable=unused-argument
+def self_destruct_add_parameters(cli_ctx, commands_loader):
+    from knack.arguments import CLICommandArgument
+
+    # azure-cli has already trimmed the table down to the command being invoked
+    name = commands_loader.command_name
+    command = commands_loader.command_table.get(name)
+    if command and "create" in name.split():
+        command.arguments["self_destruct"] = CLICommandArgument(
+            "self_destruct",
+            options_list=["--self-destruct"],
+            arg_group="Self Destruct (noelbundick)",
+            help="How long to wait until deletion. You can specify durations like 1d, 6h, 2h30m, 30m, etc",
+        )
+        command.arguments["self_destruct_sp"] = CLICommandArgument(
+            "self_destruct_sp",
+            options_list=["--self-destruct-sp"],
+            action="store_true",
+            arg_group="Self Destruct (noelbundick)",
+            help="Use legacy behavior that uses a predefined Service Principal",
+        )
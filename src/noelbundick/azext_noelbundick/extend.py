@@ -0,0 +1,203 @@
+from copy import deepcopy
+from datetime import datetime
+from functools import partial
+
+from azure.cli.core.commands import CliCommandType
+from knack.log import get_logger
+from knack.util import CLIError
+
+from . import arm as arm_client
+from . import ledger
+from .cli_utils import raise_for_errors, run_many
+from .disarm import get_armed_targets, get_target_logic_app_id
+from .self_destruct import (
+    BULK_WORKERS,
+    DURATION_RE,
+    LOGIC_API_VERSION,
+    get_ledger_entry,
+    get_resource_type,
+    get_window_time,
+    parse_date,
+    parse_time,
+)
+
+LOGGER = get_logger(__name__)
+
+
+def load_command_table(self, _):
+    custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
+
+    with self.command_group("self-destruct", custom_command_type=custom) as g:
+        g.custom_command("extend", "extend")
+
+
+def load_arguments(self, _):
+    with self.argument_context("self-destruct extend") as c:
+        c.argument("resource_id", options_list=["--id"])
+        c.argument("resource_ids", options_list=["--ids"], nargs="+")
+        c.argument("ids_file", options_list=["--ids-file"])
+        c.argument("tag", options_list=["--tag"])
+        c.argument("resource_type", options_list=["--resource-type"])
+        c.argument("resource_group_name", options_list=["--resource-group", "-g"])
+        c.argument("before", options_list=["--before"])
+        c.argument("by", options_list=["--by"])
+        c.argument("at", options_list=["--at"])
+
+
+# pylint: disable=too-many-arguments
+def extend(
+    cmd,
+    resource_id=None,
+    resource_group_name=None,
+    resource_ids=None,
+    ids_file=None,
+    tag=None,
+    resource_type=None,
+    before=None,
+    by=None,
+    at=None,
+):
+    """Move self-destruct dates in place: each Logic App's trigger and tag, and the resource's tags
+
+    Nothing is redeployed, so role assignments stay as they are and each target is a couple of requests
+    """
+    cli_ctx = cmd.cli_ctx
+    if bool(by) == bool(at):
+        raise CLIError("You must specify one of --by or --at")
+    if by:
+        if not DURATION_RE.match(by) or not parse_time(by):
+            raise CLIError(
+                "Could not parse {}. Use a duration like 1d, 6h, 2h30m".format(by)
+            )
+        by = parse_time(by)
+    else:
+        at = get_window_time(at)
+        if at <= datetime.utcnow():
+            raise CLIError("--at must be in the future")
+
+    selecting = tag or resource_type or before
+    targets = get_armed_targets(
+        cli_ctx,
+        resource_id=resource_id,
+        resource_group_name=resource_group_name,
+        resource_ids=resource_ids,
+        ids_file=ids_file,
+        tag=tag,
+        resource_type=resource_type,
+        before=before,
+    )
+    results = run_many(
+        [partial(extend_target, cli_ctx, t, by=by, at=at) for t in targets],
+        max_workers=BULK_WORKERS,
+    )
+    summary, extended = [], []
+    for (target, result) in zip(targets, results):
+        status, date = result.result or ("Failed: {}".format(result.error), None)
+        summary.append(
+            {
+                "id": target["resource_id"],
+                "name": target["name"],
+                "status": status,
+                "date": str(date) if date else None,
+            }
+        )
+        if date:
+            extended.append(
+                get_ledger_entry(
+                    target["resource_id"],
+                    target.get("type") or get_resource_type(target["resource_id"]),
+                    str(date),
+                    swept=not target["logic_app"],
+                )
+            )
+    ledger.record_armed(extended)
+    # Deleted out of band, so the ledger shouldn't list them any more
+    ledger.record_disarmed([s["id"] for s in summary if s["status"] == "Not found"])
+
+    if len(summary) == 1 and not selecting:
+        target, result = summary[0], results[0]
+        if result.error is not None:
+            raise result.error
+        if target["status"] == "Not found":
+            raise CLIError("Could not find resource with id: {}".format(target["id"]))
+        if target["status"] == "Not armed":
+            raise CLIError(
+                "Could not find a self-destruct date for resource with id: {}".format(
+                    target["id"]
+                )
+            )
+        if target["status"] == "Logic App missing":
+            raise CLIError(
+                "The self-destruct Logic App for resource with id: {} is gone. Run self-destruct arm to re-arm it".format(
+                    target["id"]
+                )
+            )
+        LOGGER.warning(
+            "Self-destruct sequence for %s moved to %s UTC",
+            target["name"],
+            target["date"],
+        )
+        return summary
+
+    LOGGER.warning(
+        "Self-destruct sequence moved for %d of %d resources",
+        len(extended),
+        len(summary),
+    )
+    return summary
+
+
+def extend_target(cli_ctx, target, by=None, at=None):
+    """Move one target's self-destruct date later by a timedelta, or to a datetime. Returns (status, new date)
+
+    The Logic App is read back and PUT with its trigger's startTime moved, beside a tag update on the resource
+    """
+    if target.get("error") is not None:
+        raise target["error"]
+    if target.get("missing"):
+        return "Not found", None
+
+    workflow = None
+    if target["logic_app"]:
+        workflow = arm_client.show_resource(
+            cli_ctx, get_target_logic_app_id(target), api_version=LOGIC_API_VERSION
+        )
+        if workflow is None:
+            # Only the tag is left, and nothing will delete the resource when it says so
+            return "Logic App missing", None
+    date = parse_date(target["date_tag"]) if target["date_tag"] else None
+    if date is None and workflow is not None:
+        date = parse_date((workflow.get("tags") or {}).get("self-destruct-time", ""))
+    if date is None:
+        return "Not armed", None
+    date = at or date + by
+
+    calls = []
+    if workflow is not None:
+        calls.append(partial(update_logic_app_time, cli_ctx, workflow, date))
+    if target["date_tag"] is not None:
+        calls.append(
+            partial(
+                arm_client.update_tags,
+                cli_ctx,
+                target["resource_id"],
+                {"self-destruct-date": str(date)},
+            )
+        )
+    results = raise_for_errors(run_many(calls, max_workers=len(calls)))
+    if target["date_tag"] is not None and results[-1] is None:
+        return "Not found", None
+    return "Extended", date
+
+
+def update_logic_app_time(cli_ctx, workflow, date):
+    """PUT the workflow back as it was read, with only its trigger's startTime and tag moved"""
+    utc_time = date.strftime("%Y-%m-%dT%H:%M:%SZ")
+    body = deepcopy(workflow)
+    body["properties"]["definition"]["triggers"]["Recurrence"]["recurrence"][
+        "startTime"
+    ] = utc_time
+    body["tags"] = dict(body.get("tags") or {}, **{"self-destruct-time": utc_time})
+    return arm_client.create_resource(
+        cli_ctx, workflow["id"], body, api_version=LOGIC_API_VERSION
+    )
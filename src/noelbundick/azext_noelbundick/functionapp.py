@@ -1,11 +1,13 @@
-import requests
 from azure.cli.core.commands import CliCommandType
 from knack.log import get_logger
+from knack.util import CLIError
 
-from .cli_utils import az_cli
+from . import arm
 
 LOGGER = get_logger(__name__)
 
+WEB_API_VERSION = "2018-02-01"
+
 
 def load_command_table(self, _):
     custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
@@ -31,82 +33,88 @@ def load_arguments(self, _):
         c.argument("include_all", options_list=["--all", "-a"])
 
 
-def list_functionapp_keys(resource_group_name, functionapp_name, include_all=False):
-    appsettings = az_cli(
-        [
-            "functionapp",
-            "config",
-            "appsettings",
-            "list",
-            "-g",
-            resource_group_name,
-            "-n",
-            functionapp_name,
-        ]
+def get_functionapp_id(cli_ctx, resource_group_name, functionapp_name):
+    return "{}/providers/Microsoft.Web/sites/{}".format(
+        arm.get_resource_group_id(cli_ctx, resource_group_name), functionapp_name
+    )
+
+
+def get_functions_version(cli_ctx, function_id):
+    appsettings = arm.send_request(
+        cli_ctx,
+        "POST",
+        "{}/config/appsettings/list".format(function_id),
+        WEB_API_VERSION,
     )
-    version = next(
-        a for a in appsettings if a["name"] == "FUNCTIONS_EXTENSION_VERSION"
-    )["value"]
+    if not appsettings:
+        raise CLIError("Could not find function app {}".format(function_id))
+    return appsettings["properties"]["FUNCTIONS_EXTENSION_VERSION"]
+
+
+def list_functionapp_keys(
+    cmd, resource_group_name, functionapp_name, include_all=False
+):
+    cli_ctx = cmd.cli_ctx
+    function_id = get_functionapp_id(cli_ctx, resource_group_name, functionapp_name)
+    version = get_functions_version(cli_ctx, function_id)
 
     # v1 and v2 return different things from ARM
     if version == "~1" or version.startswith("1"):
         return list_v1_functionapp_keys(
-            resource_group_name, functionapp_name, include_all
+            cli_ctx, function_id, functionapp_name, include_all
         )
 
-    return list_v2_functionapp_keys(resource_group_name, functionapp_name, include_all)
+    return list_v2_functionapp_keys(cli_ctx, function_id, include_all)
 
 
 def list_function_keys(
-    resource_group_name, functionapp_name, function_name, include_all=False
+    cmd, resource_group_name, functionapp_name, function_name, include_all=False
 ):
-    appsettings = az_cli(
-        [
-            "functionapp",
-            "config",
-            "appsettings",
-            "list",
-            "-g",
-            resource_group_name,
-            "-n",
-            functionapp_name,
-        ]
-    )
-    version = next(
-        a for a in appsettings if a["name"] == "FUNCTIONS_EXTENSION_VERSION"
-    )["value"]
+    cli_ctx = cmd.cli_ctx
+    function_id = get_functionapp_id(cli_ctx, resource_group_name, functionapp_name)
+    version = get_functions_version(cli_ctx, function_id)
 
     # v1 and v2 return different things from ARM
     if version == "~1" or version.startswith("1"):
-        return list_v1_function_keys(
-            resource_group_name, functionapp_name, function_name, include_all
+        keys = list_v1_function_keys(
+            cli_ctx, function_id, functionapp_name, function_name
         )
+    else:
+        keys = list_v2_function_keys(cli_ctx, function_id, function_name)
 
-    return list_v2_function_keys(
-        resource_group_name, functionapp_name, function_name, include_all
-    )
+    # System keys can also be used but aren't returned by default. Include them if --all was specified
+    if include_all:
+        for key in keys:
+            key.update({"type": "function"})
+        host_keys = list_functionapp_keys(
+            cmd, resource_group_name, functionapp_name, include_all=True
+        )
+        for key in host_keys:
+            key.update({"type": "host"})
+        keys.extend(host_keys)
 
+    return keys
 
-def list_v1_functionapp_keys(resource_group_name, functionapp_name, include_all):
-    function_id = az_cli(
-        ["functionapp", "show", "-g", resource_group_name, "-n", functionapp_name]
-    )["id"]
 
+def get_function_token(cli_ctx, function_id):
     # Get a function app token, which can be exchanged for keys
-    token_url = "https://management.azure.com{}/functions/admin/token?api-version=2018-02-01".format(
-        function_id
+    return arm.send_request(
+        cli_ctx,
+        "GET",
+        "{}/functions/admin/token".format(function_id),
+        WEB_API_VERSION,
     )
-    arm_token, _ = get_access_token()
-    arm_headers = {"Authorization": "Bearer {}".format(arm_token)}
-    token_result = requests.get(token_url, headers=arm_headers)
-    function_token = token_result.json()
+
+
+def list_v1_functionapp_keys(cli_ctx, function_id, functionapp_name, include_all):
+    function_token = get_function_token(cli_ctx, function_id)
 
     keys = []
 
     # Get the keys
     keys_url = "https://{}.azurewebsites.net/admin/host/keys".format(functionapp_name)
     function_headers = {"Authorization": "Bearer {}".format(function_token)}
-    keys_result = requests.get(keys_url, headers=function_headers)
+    keys_result = get_from_host(keys_url, function_headers)
     if keys_result:
         keys.extend(keys_result.json()["keys"])
 
@@ -114,8 +122,7 @@ def list_v1_functionapp_keys(resource_group_name, functionapp_name, include_all)
     keys_url = "https://{}.azurewebsites.net/admin/host/systemkeys".format(
         functionapp_name
     )
-    function_headers = {"Authorization": "Bearer {}".format(function_token)}
-    keys_result = requests.get(keys_url, headers=function_headers)
+    keys_result = get_from_host(keys_url, function_headers)
     if keys_result:
         keys.extend(keys_result.json()["keys"])
 
@@ -124,118 +131,73 @@ def list_v1_functionapp_keys(resource_group_name, functionapp_name, include_all)
         keys_url = "https://{}.azurewebsites.net/admin/host/systemkeys/_master".format(
             functionapp_name
         )
-        master_key = requests.get(keys_url, headers=function_headers).json()
+        master_key = get_from_host(keys_url, function_headers).json()
         keys.append({k: master_key[k] for k in ("name", "value")})
 
     return keys
 
 
-def list_v2_functionapp_keys(resource_group_name, functionapp_name, include_all):
-    function_id = az_cli(
-        ["functionapp", "show", "-g", resource_group_name, "-n", functionapp_name]
-    )["id"]
+def get_from_host(url, headers):
+    """GET from a function app's own *.azurewebsites.net host, with the same timeout as ARM requests"""
+    from requests.exceptions import Timeout
 
+    try:
+        return arm.get_session().get(url, headers=headers, timeout=arm.REQUEST_TIMEOUT)
+    except Timeout:
+        raise CLIError("GET {} timed out after {}s".format(url, arm.REQUEST_TIMEOUT))
+
+
+def list_v2_functionapp_keys(cli_ctx, function_id, include_all):
     keys = []
 
     # Get the keys
-    url = "https://management.azure.com{}/hostruntime/admin/host/keys?api-version=2018-02-01".format(
-        function_id
+    result = arm.send_request(
+        cli_ctx,
+        "GET",
+        "{}/hostruntime/admin/host/keys".format(function_id),
+        WEB_API_VERSION,
     )
-    access_token, _ = get_access_token()
-    headers = {"Authorization": "Bearer {}".format(access_token)}
-    result = requests.get(url, headers=headers)
     if result:
-        keys.extend(result.json()["keys"])
+        keys.extend(result["keys"])
 
     # Get the system keys
-    url = "https://management.azure.com{}/hostruntime/admin/host/systemkeys?api-version=2018-02-01".format(
-        function_id
+    result = arm.send_request(
+        cli_ctx,
+        "GET",
+        "{}/hostruntime/admin/host/systemkeys".format(function_id),
+        WEB_API_VERSION,
     )
-    access_token, _ = get_access_token()
-    headers = {"Authorization": "Bearer {}".format(access_token)}
-    result = requests.get(url, headers=headers)
     if result:
-        keys.extend(result.json()["keys"])
+        keys.extend(result["keys"])
 
     # The _master key isn't returned by default. Get it if --all was specified
     if include_all:
-        url = "https://management.azure.com{}/hostruntime/admin/host/systemkeys/_master?api-version=2018-02-01".format(
-            function_id
+        master_key = arm.send_request(
+            cli_ctx,
+            "GET",
+            "{}/hostruntime/admin/host/systemkeys/_master".format(function_id),
+            WEB_API_VERSION,
         )
-        master_key = requests.get(url, headers=headers).json()
         keys.append({k: master_key[k] for k in ("name", "value")})
 
     return keys
 
 
-def list_v1_function_keys(
-    resource_group_name, functionapp_name, function_name, include_all=False
-):
-    function_id = az_cli(
-        ["functionapp", "show", "-g", resource_group_name, "-n", functionapp_name]
-    )["id"]
-
-    # Get a function app token, which can be exchanged for keys
-    token_url = "https://management.azure.com{}/functions/admin/token?api-version=2018-02-01".format(
-        function_id
-    )
-    arm_token, _ = get_access_token()
-    arm_headers = {"Authorization": "Bearer {}".format(arm_token)}
-    token_result = requests.get(token_url, headers=arm_headers)
-    function_token = token_result.json()
+def list_v1_function_keys(cli_ctx, function_id, functionapp_name, function_name):
+    function_token = get_function_token(cli_ctx, function_id)
 
     # Get the function keys
     keys_url = "https://{}.azurewebsites.net/admin/functions/{}/keys".format(
         functionapp_name, function_name
     )
     function_headers = {"Authorization": "Bearer {}".format(function_token)}
-    keys = requests.get(keys_url, headers=function_headers).json()["keys"]
-
-    # System keys can also be used but aren't returned by default. Include them if --all was specified
-    if include_all:
-        for key in keys:
-            key.update({"type": "function"})
-        host_keys = list_functionapp_keys(
-            resource_group_name, functionapp_name, include_all=True
-        )
-        for key in host_keys:
-            key.update({"type": "host"})
-        keys.extend(host_keys)
-
-    return keys
-
-
-def list_v2_function_keys(
-    resource_group_name, functionapp_name, function_name, include_all=False
-):
-    function_id = az_cli(
-        ["functionapp", "show", "-g", resource_group_name, "-n", functionapp_name]
-    )["id"]
-
-    url = "https://management.azure.com{}/hostruntime/admin/functions/{}/keys?api-version=2018-02-01".format(
-        function_id, function_name
-    )
-    access_token, _ = get_access_token()
-    headers = {"Authorization": "Bearer {}".format(access_token)}
-    keys = requests.get(url, headers=headers).json()["keys"]
-
-    # System keys can also be used but aren't returned by default. Include them if --all was specified
-    if include_all:
-        for key in keys:
-            key.update({"type": "function"})
-        host_keys = list_functionapp_keys(
-            resource_group_name, functionapp_name, include_all=True
-        )
-        for key in host_keys:
-            key.update({"type": "host"})
-        keys.extend(host_keys)
-
-    return keys
-
+    return get_from_host(keys_url, function_headers).json()["keys"]
 
-def get_access_token():
-    from azure.cli.core._profile import Profile
 
-    profile = Profile()
-    creds, subscription, _ = profile.get_raw_token()
-    return (creds[1], subscription)
+def list_v2_function_keys(cli_ctx, function_id, function_name):
+    return arm.send_request(
+        cli_ctx,
+        "GET",
+        "{}/hostruntime/admin/functions/{}/keys".format(function_id, function_name),
+        WEB_API_VERSION,
+    )["keys"]
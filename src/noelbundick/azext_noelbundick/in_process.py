@@ -0,0 +1,69 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Nested az commands run inside the current process by default, which skips the interpreter + azure-cli cold start
+# Set AZEXT_NOELBUNDICK_IN_PROCESS=false to always fork `python -m azure.cli` instead
+IN_PROCESS = {
+    "enabled": os.environ.get("AZEXT_NOELBUNDICK_IN_PROCESS", "true").lower()
+    != "false",
+    "cli": None,
+}
+IN_PROCESS_LOCK = threading.RLock()
+
+# How many in-process az commands this thread is inside of. Per thread, because run_many workers and the early arm
+# run nested commands while the outer command's handlers fire on the main thread
+DEPTH = threading.local()
+
+
+class InProcessUnavailable(Exception):
+    pass
+
+
+def is_nested_invocation():
+    return getattr(DEPTH, "depth", 0) > 0
+
+
+def get_in_process_cli():
+    if IN_PROCESS["cli"] is None:
+        try:
+            from azure.cli.core import get_default_cli
+
+            IN_PROCESS["cli"] = get_default_cli()
+        except Exception as ex:  # pylint: disable=broad-except
+            raise InProcessUnavailable(ex)
+    return IN_PROCESS["cli"]
+
+
+def reset_in_process_cli():
+    """Drop the loaded CLI so the next command re-reads the profile and config"""
+    with IN_PROCESS_LOCK:
+        IN_PROCESS["cli"] = None
+
+
+def invoke_in_process(args, out_file):
+    # knack keeps per-invocation state on the CLI object, so nested commands take turns
+    with IN_PROCESS_LOCK:
+        cli = get_in_process_cli()
+        DEPTH.depth = getattr(DEPTH, "depth", 0) + 1
+        try:
+            exit_code = cli.invoke(args, out_file=out_file)
+        except SystemExit as ex:
+            # argument parsing errors are re-raised by knack after being recorded
+            exit_code = ex.code or 0
+        finally:
+            DEPTH.depth -= 1
+        return exit_code, cli.result
+
+
+@contextmanager
+def environment(env):
+    """Swap os.environ for `env` while a command runs. Hold IN_PROCESS_LOCK around this"""
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
@@ -0,0 +1,132 @@
+import json
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\r\n"
+DECODER = json.JSONDecoder()
+
+
+def iter_json_array(chunks, key=None, trailer=None):
+    """Yield the elements of a JSON array as they arrive from an iterable of text chunks
+
+    With key, stream the array stored under that key of a top level object instead, like ARM's `value`.
+    The object's other keys (ex: `nextLink`), before or after the array, are stored in the trailer dict.
+    Only the element being decoded is held in memory, no matter how long the array is.
+    """
+    reader = _Reader(chunks)
+    if key:
+        trailer = {} if trailer is None else trailer
+        found = _seek_key(reader, key, trailer)
+    else:
+        found = _seek_array(reader)
+    if not found:
+        # No array (ex: empty output) means nothing to yield
+        return
+
+    while True:
+        c = reader.skip(WHITESPACE + ",")
+        if c == "]":
+            reader.consume()
+            break
+        if not c:
+            raise ValueError("Unexpected end of JSON array")
+        yield reader.decode()
+
+    if key:
+        _read_members(reader, trailer)
+
+
+class _Reader:
+    """A text buffer that pulls more chunks as it runs out"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ""
+
+    def more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buf += chunk
+        return True
+
+    def skip(self, chars=WHITESPACE):
+        """Drop leading `chars`, returning the next character, or "" at the end of the input"""
+        while True:
+            self.buf = self.buf.lstrip(chars)
+            if self.buf or not self.more():
+                return self.buf[:1]
+
+    def consume(self):
+        self.buf = self.buf[1:]
+
+    def decode(self):
+        """Decode the next complete JSON value"""
+        while True:
+            try:
+                if not self.buf:
+                    raise ValueError("Need more data")
+                value, end = DECODER.raw_decode(self.buf)
+            except ValueError:
+                if not self.more():
+                    raise ValueError("Unexpected end of JSON")
+                continue
+
+            # A number can be cut off at the edge of a chunk (ex: `1.` of `1.5`), so make sure it's complete
+            incomplete = end == len(self.buf) or self.buf[end] not in WHITESPACE + ",]}"
+            if incomplete and not isinstance(value, (dict, list, str)) and self.more():
+                continue
+
+            self.buf = self.buf[end:]
+            return value
+
+
+def _seek_array(reader):
+    c = reader.skip()
+    if not c:
+        return False
+    if c != "[":
+        raise ValueError("Expected a JSON array")
+    reader.consume()
+    return True
+
+
+def _seek_key(reader, key, trailer):
+    """Move to the start of the array under `key`, storing the keys before it in trailer"""
+    c = reader.skip()
+    if not c:
+        return False
+    if c != "{":
+        raise ValueError("Expected a JSON object")
+    reader.consume()
+
+    while True:
+        name = _read_name(reader)
+        if name is None:
+            return False
+        if name == key and reader.skip() == "[":
+            reader.consume()
+            return True
+        trailer[name] = reader.decode()
+
+
+def _read_members(reader, trailer):
+    while True:
+        name = _read_name(reader)
+        if name is None:
+            return
+        trailer[name] = reader.decode()
+
+
+def _read_name(reader):
+    """Read the next `"name":` of an object, or return None at its end"""
+    c = reader.skip(WHITESPACE + ",")
+    if c in ("}", ""):
+        reader.consume()
+        return None
+
+    name = reader.decode()
+    if reader.skip() != ":":
+        raise ValueError("Expected ':' after {}".format(json.dumps(name)))
+    reader.consume()
+    reader.skip()
+    return name
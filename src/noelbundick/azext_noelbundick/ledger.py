@@ -0,0 +1,244 @@
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+from azure.cli.core._environment import get_config_dir
+from knack.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+# Next to the self-destruct SP config
+LEDGER_PATH = os.path.join(get_config_dir(), "self-destruct-ledger.sqlite")
+
+# Resource Graph can take a few minutes to see new tags, so a sync doesn't drop entries this young
+GRAPH_LAG = 600
+
+# One row per armed resource or resource group. `id`, `subscription` and `logic_app` are lowercase
+# destroy_date is `YYYY-MM-DD HH:MM:SS` UTC, so it sorts and compares as text. date_tag is the tag as it was written
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS armed (
+    id TEXT PRIMARY KEY,
+    resource_id TEXT NOT NULL,
+    subscription TEXT NOT NULL,
+    resource_group TEXT NOT NULL COLLATE NOCASE,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL COLLATE NOCASE,
+    destroy_date TEXT NOT NULL,
+    date_tag TEXT NOT NULL,
+    logic_app TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS armed_destroy_date ON armed (subscription, destroy_date);
+-- When `self-destruct list --sync` last caught each subscription up with ARM
+CREATE TABLE IF NOT EXISTS synced (
+    subscription TEXT PRIMARY KEY,
+    synced REAL NOT NULL
+);
+"""
+COLUMNS = (
+    "id",
+    "resource_id",
+    "subscription",
+    "resource_group",
+    "name",
+    "type",
+    "destroy_date",
+    "date_tag",
+    "logic_app",
+)
+
+
+def connect():
+    connection = sqlite3.connect(LEDGER_PATH, timeout=10)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+@contextmanager
+def transaction():
+    """A connection that commits when the block finishes, or rolls back if it raises"""
+    with closing(connect()) as connection:
+        with connection:
+            yield connection
+
+
+def make_entry(resource_id, resource_type, destroy_date, date_tag, names):
+    """A ledger row. destroy_date is a datetime
+
+    names is (resource group, name, Logic App name). The Logic App is None for resources armed for a sweeper
+    """
+    resource_group, name, logic_app = names
+    return {
+        "id": resource_id.lower(),
+        "resource_id": resource_id,
+        "subscription": resource_id.split("/")[2].lower(),
+        "resource_group": resource_group,
+        "name": name,
+        "type": resource_type,
+        "destroy_date": destroy_date.strftime("%Y-%m-%d %H:%M:%S"),
+        "date_tag": date_tag,
+        "logic_app": logic_app.lower() if logic_app else None,
+    }
+
+
+def record_armed(entries):
+    """Best effort: arming never fails because the ledger can't be written"""
+    try:
+        with transaction() as connection:
+            _upsert(connection, entries, time.time())
+    except sqlite3.Error as ex:
+        LOGGER.debug("Could not record armed resources in %s: %s", LEDGER_PATH, ex)
+
+
+def record_disarmed(resource_ids):
+    try:
+        with transaction() as connection:
+            connection.executemany(
+                "DELETE FROM armed WHERE id = ?", [(i.lower(),) for i in resource_ids]
+            )
+    except sqlite3.Error as ex:
+        LOGGER.debug("Could not record disarmed resources in %s: %s", LEDGER_PATH, ex)
+
+
+def get(resource_id):
+    """The ledger row for a resource, or None if it isn't there (or the ledger can't be read)"""
+    try:
+        with closing(connect()) as connection:
+            row = connection.execute(
+                "SELECT * FROM armed WHERE id = ?", (resource_id.lower(),)
+            ).fetchone()
+    except sqlite3.Error as ex:
+        LOGGER.debug("Could not read %s: %s", LEDGER_PATH, ex)
+        return None
+    return dict(row) if row else None
+
+
+# pylint: disable=too-many-arguments
+def query(
+    subscriptions,
+    resource_type=None,
+    resource_group_name=None,
+    before=None,
+    after=None,
+):
+    """Ledger rows in these subscriptions (None for all of them), soonest destroy date first
+
+    before and after are datetimes
+    """
+    clauses, params = [], []
+    if subscriptions is not None:
+        clauses.append(
+            "subscription IN ({})".format(", ".join("?" * len(subscriptions)))
+        )
+        params.extend(s.lower() for s in subscriptions)
+    if resource_type:
+        clauses.append("type = ?")
+        params.append(resource_type)
+    if resource_group_name:
+        clauses.append("resource_group = ?")
+        params.append(resource_group_name)
+    if before:
+        clauses.append("destroy_date <= ?")
+        params.append(before.strftime("%Y-%m-%d %H:%M:%S"))
+    if after:
+        clauses.append("destroy_date >= ?")
+        params.append(after.strftime("%Y-%m-%d %H:%M:%S"))
+
+    try:
+        with closing(connect()) as connection:
+            rows = connection.execute(
+                "SELECT * FROM armed {} ORDER BY destroy_date, id".format(
+                    "WHERE " + " AND ".join(clauses) if clauses else ""
+                ),
+                params,
+            ).fetchall()
+    except sqlite3.Error as ex:
+        LOGGER.warning("Could not read %s: %s", LEDGER_PATH, ex)
+        return []
+    return [dict(r) for r in rows]
+
+
+def get_synced(subscription):
+    """When the subscription was last synced (a timestamp), or None if it never was"""
+    try:
+        with closing(connect()) as connection:
+            row = connection.execute(
+                "SELECT synced FROM synced WHERE subscription = ?",
+                (subscription.lower(),),
+            ).fetchone()
+    except sqlite3.Error as ex:
+        LOGGER.debug("Could not read %s: %s", LEDGER_PATH, ex)
+        return None
+    return row["synced"] if row else None
+
+
+def get_logic_apps(subscription):
+    """{id: Logic App name} for the rows in a subscription that have a Logic App"""
+    try:
+        with closing(connect()) as connection:
+            rows = connection.execute(
+                "SELECT id, logic_app FROM armed WHERE subscription = ? AND logic_app IS NOT NULL",
+                (subscription.lower(),),
+            ).fetchall()
+    except sqlite3.Error as ex:
+        LOGGER.debug("Could not read %s: %s", LEDGER_PATH, ex)
+        return {}
+    return {r["id"]: r["logic_app"] for r in rows}
+
+
+def reconcile(subscription, entries, logic_apps, changed=None, synced=None):
+    """Make the ledger match what ARM has for one subscription, writing only what changed
+
+    entries are what the tags say is armed. A ledger row that's missing from them is kept if its Logic App still
+    exists (some resources can't be tagged), or if it was written recently enough that Resource Graph may not have
+    caught up yet. Returns (added, updated, removed)
+
+    With changed (lowercased resource ids), only the rows for those are reconciled, since the rest can't have moved.
+    synced is the time the sync started, which the next incremental sync looks for changes after
+    """
+    subscription = subscription.lower()
+    now = time.time()
+    with transaction() as connection:
+        existing = {
+            r["id"]: dict(r)
+            for r in connection.execute(
+                "SELECT * FROM armed WHERE subscription = ?", (subscription,)
+            )
+            if changed is None or r["id"] in changed
+        }
+
+        writes, added = [], 0
+        for entry in entries:
+            current = existing.pop(entry["id"], None)
+            if current is None:
+                added += 1
+                writes.append(entry)
+            elif any(current[c] != entry[c] for c in COLUMNS):
+                writes.append(entry)
+        _upsert(connection, writes, now)
+
+        removed = [
+            i
+            for (i, r) in existing.items()
+            if r["logic_app"] not in logic_apps and r["updated"] < now - GRAPH_LAG
+        ]
+        connection.executemany(
+            "DELETE FROM armed WHERE id = ?", [(i,) for i in removed]
+        )
+        if synced is not None:
+            connection.execute(
+                "INSERT OR REPLACE INTO synced (subscription, synced) VALUES (?, ?)",
+                (subscription, synced),
+            )
+    return added, len(writes) - added, len(removed)
+
+
+def _upsert(connection, entries, updated):
+    connection.executemany(
+        "INSERT OR REPLACE INTO armed ({}, updated) VALUES ({}, ?)".format(
+            ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))
+        ),
+        [[e[c] for c in COLUMNS] + [updated] for e in entries],
+    )
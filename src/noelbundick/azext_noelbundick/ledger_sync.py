@@ -0,0 +1,134 @@
+import time
+from datetime import datetime
+from functools import partial
+
+from knack.log import get_logger
+
+from . import arm as arm_client
+from . import ledger
+from .cli_utils import raise_for_errors, run_many
+
+LOGGER = get_logger(__name__)
+
+# The Logic Apps `self-destruct list --sync` looks for, besides tags
+LOGIC_APPS_QUERY = (
+    "resources | where type =~ 'microsoft.logic/workflows'"
+    " | where name startswith 'self-destruct-' | project name"
+)
+# After the first sync, only what Resource Graph's change tables say changed since the last one is re-read
+CHANGES_QUERY = (
+    "resourcechanges | union resourcecontainerchanges"
+    " | where todatetime(properties.changeAttributes.timestamp) > datetime({since})"
+    " | project id = tostring(properties.targetResourceId) | limit {limit}"
+)
+# The change tables keep 14 days. A ledger last synced longer ago than this is synced in full
+SYNC_HISTORY = 13 * 24 * 3600
+# Past this many changes, one full query is cheaper than looking each change up
+SYNC_CHANGES_LIMIT = 1000
+# Ids or names per `in~ (...)` lookup, and lookups in flight at once
+SYNC_BATCH = 200
+SYNC_WORKERS = 16
+
+
+def sync_ledger(cli_ctx, subscription_ids, get_entries):
+    """Reconcile the ledger with the self-destruct tags and Logic Apps in each subscription
+
+    get_entries(cli_ctx, subscription_id, ids=None) returns the ledger entries for what the tags say is armed,
+    among ids if given
+    """
+    results = run_many(
+        [partial(sync_subscription, cli_ctx, s, get_entries) for s in subscription_ids],
+        max_workers=arm_client.SUBSCRIPTION_WORKERS,
+    )
+    for (subscription_id, result) in zip(subscription_ids, results):
+        if result.error is not None:
+            LOGGER.warning(
+                "Could not sync subscription %s: %s", subscription_id, result.error
+            )
+        else:
+            LOGGER.info(
+                "Synced subscription %s: %d added, %d updated, %d removed",
+                subscription_id,
+                *result.result
+            )
+
+
+def sync_subscription(cli_ctx, subscription_id, get_entries):
+    """Reconcile one subscription, re-reading only what changed since its last sync when there was one"""
+    started = time.time()
+    synced = ledger.get_synced(subscription_id)
+    if synced is not None and started - synced < SYNC_HISTORY:
+        changed = get_changed_ids(cli_ctx, subscription_id, synced - ledger.GRAPH_LAG)
+        if changed is not None:
+            return sync_changes(cli_ctx, subscription_id, get_entries, changed, started)
+
+    entries, logic_apps = raise_for_errors(
+        run_many(
+            [
+                partial(get_entries, cli_ctx, subscription_id),
+                partial(get_logic_apps, cli_ctx, subscription_id),
+            ]
+        )
+    )
+    return ledger.reconcile(subscription_id, entries, logic_apps, synced=started)
+
+
+def get_changed_ids(cli_ctx, subscription_id, since):
+    """Lowercased ids of everything that changed after a timestamp, or None if there are too many to look up"""
+    query = CHANGES_QUERY.format(
+        since=datetime.utcfromtimestamp(since).strftime("%Y-%m-%d %H:%M:%S"),
+        limit=SYNC_CHANGES_LIMIT + 1,
+    )
+    rows = list(
+        arm_client.query_resources(cli_ctx, query, subscriptions=[subscription_id])
+    )
+    if len(rows) > SYNC_CHANGES_LIMIT:
+        return None
+    return {r["id"].lower() for r in rows if r["id"]}
+
+
+def sync_changes(cli_ctx, subscription_id, get_entries, changed, started):
+    """Reconcile the changed resources, and the ones whose self-destruct Logic App changed"""
+    armed_by = ledger.get_logic_apps(subscription_id)
+    changed_logic_apps = {
+        i.rpartition("/")[2]
+        for i in changed
+        if "/providers/microsoft.logic/workflows/self-destruct-" in i
+    }
+    ids = changed.union(i for (i, app) in armed_by.items() if app in changed_logic_apps)
+    # Only resources and resource groups can be armed
+    ids = sorted(i for i in ids if "/resourcegroups/" in i)
+    # A ledger row whose tags are gone is kept while its Logic App is there, so look those up too
+    names = sorted({armed_by[i] for i in ids if i in armed_by})
+
+    entry_calls = [
+        partial(get_entries, cli_ctx, subscription_id, ids[i : i + SYNC_BATCH])
+        for i in range(0, len(ids), SYNC_BATCH)
+    ]
+    name_calls = [
+        partial(get_logic_apps, cli_ctx, subscription_id, names[i : i + SYNC_BATCH])
+        for i in range(0, len(names), SYNC_BATCH)
+    ]
+    results = raise_for_errors(
+        run_many(entry_calls + name_calls, max_workers=SYNC_WORKERS)
+    )
+    return ledger.reconcile(
+        subscription_id,
+        [e for entries in results[: len(entry_calls)] for e in entries],
+        set().union(*results[len(entry_calls) :]),
+        changed=set(ids),
+        synced=started,
+    )
+
+
+def get_logic_apps(cli_ctx, subscription_id, names=None):
+    """Lowercased names of the self-destruct Logic Apps in a subscription, or of the ones among names that exist"""
+    query = LOGIC_APPS_QUERY
+    if names is not None:
+        query += " | where name in~ ({})".format(arm_client.get_query_list(names))
+    return {
+        r["name"].lower()
+        for r in arm_client.query_resources(
+            cli_ctx, query, subscriptions=[subscription_id]
+        )
+    }
@@ -0,0 +1,167 @@
+from functools import partial
+
+from knack.log import get_logger
+
+from . import arm as arm_client
+from .cli_utils import run_many
+
+LOGGER = get_logger(__name__)
+
+RESOURCE_GROUP_DELETE_ACTION = "Microsoft.Resources/subscriptions/resourceGroups/delete"
+# Permission lookups in flight at once
+PERMISSION_WORKERS = 16
+
+
+def compile_actions(patterns):
+    """A function that says whether a lowercased action matches any of these action patterns
+
+    Actions are case-insensitive, and `*` matches anything, slashes included. Literal patterns are a set lookup, and
+    wildcard patterns are bucketed by provider namespace, so an action is only tried against its own provider's
+    """
+    literals, by_namespace, anywhere = set(), {}, []
+    for pattern in patterns or []:
+        pattern = pattern.lower()
+        if pattern == "*":
+            return lambda action: True
+        if "*" not in pattern:
+            literals.add(pattern)
+            continue
+        namespace, slash, _ = pattern.partition("/")
+        if slash and "*" not in namespace:
+            by_namespace.setdefault(namespace, []).append(compile_pattern(pattern))
+        else:
+            anywhere.append(compile_pattern(pattern))
+
+    def matches(action):
+        if action in literals:
+            return True
+        candidates = by_namespace.get(action.partition("/")[0], ())
+        return any(m(action) for m in candidates) or any(m(action) for m in anywhere)
+
+    return matches
+
+
+def compile_pattern(pattern):
+    """A function that says whether a lowercased action matches one lowercased pattern with wildcards"""
+    parts = pattern.split("*")
+    head, middle, tail = parts[0], parts[1:-1], parts[-1]
+    shortest = sum(len(p) for p in parts)
+
+    def matches(action):
+        if (
+            len(action) < shortest
+            or not action.startswith(head)
+            or not action.endswith(tail)
+        ):
+            return False
+        # Taking the first match of each middle part leaves the most room for the rest
+        position, end = len(head), len(action) - len(tail)
+        for part in middle:
+            position = action.find(part, position, end)
+            if position < 0:
+                return False
+            position += len(part)
+        return True
+
+    return matches
+
+
+def compile_permissions(permissions):
+    """A function that says whether permissions from the permissions API allow an action
+
+    Each entry is one role's actions minus its notActions, so a notAction only cancels actions from the same entry.
+    An action is allowed if any entry allows it. Answers are cached per action, since many resources share a type
+    """
+    entries = [
+        (compile_actions(p.get("actions")), compile_actions(p.get("notActions")))
+        for p in permissions
+    ]
+    cache = {}
+
+    def allows(action):
+        action = action.lower()
+        if action not in cache:
+            cache[action] = any(
+                allowed(action) and not denied(action) for (allowed, denied) in entries
+            )
+        return cache[action]
+
+    return allows
+
+
+def get_delete_action(resource_id):
+    """The RBAC action that deletes a resource or resource group. Ex: Microsoft.Sql/servers/databases/delete"""
+    from msrestazure.tools import parse_resource_id
+
+    parts = parse_resource_id(resource_id)
+    if "resource_name" not in parts:
+        return RESOURCE_GROUP_DELETE_ACTION
+
+    types = [parts["namespace"], parts["type"]]
+    for level in range(1, parts.get("last_child_num", 0) + 1):
+        types.append(parts["child_type_{}".format(level)])
+    return "/".join(types + ["delete"])
+
+
+def get_permission_scope(resource_id):
+    """The resource group a resource is in, or its subscription if it isn't in one"""
+    parts = resource_id.split("/")
+    if len(parts) >= 5 and parts[3].lower() == "resourcegroups":
+        return "/".join(parts[:5])
+    return "/".join(parts[:3])
+
+
+def find_undeletable(cli_ctx, resource_ids, access_token=None):
+    """Check that the caller (or the identity access_token belongs to) can delete each of these resources
+
+    Permissions are fetched once per resource group and matched locally. Assignments made on a resource itself only
+    add to what its group allows, so resources denied at the group are checked again at their own scope.
+    Returns {resource id: reason} for the ones that can't be deleted
+    """
+    actions = {i: get_delete_action(i) for i in resource_ids}
+    scopes = {}
+    for resource_id in resource_ids:
+        scopes.setdefault(get_permission_scope(resource_id).lower(), []).append(
+            resource_id
+        )
+
+    denied = {}
+    retry = []
+    for ((scope, ids), result) in zip(
+        scopes.items(), fetch_permissions(cli_ctx, list(scopes), access_token)
+    ):
+        if result.error is not None:
+            denied.update((i, str(result.error)) for i in ids)
+            continue
+        allows = compile_permissions(result.result)
+        retry.extend(i for i in ids if i.lower() != scope and not allows(actions[i]))
+        denied.update(
+            (i, "not authorized to {}".format(actions[i]))
+            for i in ids
+            if i.lower() == scope and not allows(actions[i])
+        )
+
+    for (resource_id, result) in zip(
+        retry, fetch_permissions(cli_ctx, retry, access_token)
+    ):
+        if result.error is not None:
+            denied[resource_id] = str(result.error)
+        elif not compile_permissions(result.result)(actions[resource_id]):
+            denied[resource_id] = "not authorized to {}".format(actions[resource_id])
+
+    LOGGER.info(
+        "Checked delete permissions for %d resources with %d permission lookups",
+        len(resource_ids),
+        len(scopes) + len(retry),
+    )
+    return denied
+
+
+def fetch_permissions(cli_ctx, scopes, access_token=None):
+    return run_many(
+        [
+            partial(arm_client.list_permissions, cli_ctx, s, access_token)
+            for s in scopes
+        ],
+        max_workers=PERMISSION_WORKERS,
+    )
@@ -1,9 +1,10 @@
+import hashlib
 import os
 import re
 import sys
 from datetime import datetime, timedelta
+from functools import partial
 
-import requests
 from azure.cli.core._environment import get_config_dir
 from azure.cli.core.commands import CliCommandType
 from azure.cli.core.util import get_file_json
@@ -11,13 +12,64 @@ from knack.log import get_logger
 from knack.util import CLIError
 from six.moves import configparser
 
-from .cli_utils import az_cli
+from . import arm as arm_client
+from . import auth, ledger, ledger_sync, rbac
+from .cli_utils import az_cli, raise_for_errors, run_many
 
 LOGGER = get_logger(__name__)
 
 CONFIG_DIR = get_config_dir()
 SELF_DESTRUCT_PATH = os.path.join(CONFIG_DIR, "self-destruct")
 
+LOGIC_API_VERSION = "2019-05-01"
+RESOURCE_GROUP_TYPE = "microsoft.resources/subscriptions/resourcegroups"
+# `self-destruct list --before/--after` take one of these, or a duration from now
+WINDOW_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%d %H:%M:%S",
+)
+# self-destruct-date tags are written with str(datetime)
+TAG_DATE_FORMATS = ("%Y-%m-%d %H:%M:%S.%f",) + WINDOW_DATE_FORMATS
+
+# Resource Graph columns for `self-destruct list`, and for everything that needs to know how a resource was armed
+LIST_COLUMNS = "name, resourceGroup, type, date = tostring(tags['self-destruct-date'])"
+ARMED_COLUMNS = (
+    "id, type, date = tostring(tags['self-destruct-date']),"
+    " apiVersion = tostring(tags['self-destruct-api-version'])"
+)
+
+# ARM allows 800 resources per deployment, copies included. The managed identity template creates 3 per target
+MAX_DEPLOYMENT_TARGETS = 250
+# Deployments (one per resource group) and tag updates in flight at once when arming many resources
+BULK_WORKERS = 16
+
+# Arm deployments are named after what they arm, see get_deployment_name
+DEPLOYMENT_PREFIX = "self-destruct-"
+# Finished arm deployments kept per resource group. ARM's limit is 800, and other deployments need room too
+DEPLOYMENT_HISTORY = 50
+# Older versions always used `self_destruct`, and `self_destruct-N` for big groups
+LEGACY_DEPLOYMENT_RE = re.compile(r"^self_destruct(-\d+)?$")
+
+# Resources a create command makes are deleted in tiers, so nothing is deleted while something else still uses it.
+# Ex: `az vm create` makes a VM, then its NIC and OS disk go, then its public IP and VNet, and its NSG last
+DELETE_TIERS = {
+    "microsoft.compute/availabilitysets": 1,
+    "microsoft.compute/disks": 1,
+    "microsoft.network/applicationgateways": 1,
+    "microsoft.network/loadbalancers": 1,
+    "microsoft.network/networkinterfaces": 1,
+    "microsoft.network/privateendpoints": 1,
+    "microsoft.web/serverfarms": 1,
+    "microsoft.network/publicipaddresses": 2,
+    "microsoft.network/virtualnetworks": 2,
+    "microsoft.network/networksecuritygroups": 3,
+    "microsoft.network/routetables": 3,
+}
+# Long enough for the tier before to finish deleting. Logic Apps wait for async deletes, but don't retry conflicts
+TIER_DELAY = timedelta(minutes=10)
+
 # you can specify self-destruct dates like 1d, 6h, 2h30m, 30m, etc
 DURATION_RE = re.compile(
     r"^((?P<days>\d+?)d)?((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?$"
@@ -28,115 +80,268 @@ SELF_DESTRUCT = {}
 SELF_DESTRUCT["active"] = False
 
 
-def init(self):
-    from knack import events
-
-    # In pre-parse args, we'll gather the --self-destruct arguments and validate them
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_PRE_PARSE_ARGS, self_destruct_pre_parse_args_handler
-    )
-
-    # Inject the --self-destruct parameter to the command table
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_POST_CMD_TBL_CREATE, self_destruct_add_parameters
-    )
-
-    # Strip the --self-destruct args
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_POST_PARSE_ARGS, self_destruct_post_parse_args_handler
-    )
-
-    # In result transform, we can access the created resource id, and create a Logic App that will delete it at the specified time offset
-    self.cli_ctx.register_event(
-        events.EVENT_INVOKER_TRANSFORM_RESULT, self_destruct_transform_handler
-    )
-
-
 def load_command_table(self, _):
     custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
 
     with self.command_group("self-destruct", custom_command_type=custom) as g:
         g.custom_command("arm", "arm")
         g.custom_command("configure", "configure_sp")
-        g.custom_command("disarm", "disarm")
         g.custom_command("list", "list_self_destruct_resources")
 
 
 def load_arguments(self, _):
     with self.argument_context("self-destruct arm") as c:
         c.argument("resource_id", options_list=["--id"])
+        c.argument("resource_ids", options_list=["--ids"], nargs="+")
+        c.argument("ids_file", options_list=["--ids-file"])
+        c.argument("tag", options_list=["--tag"])
+        c.argument("resource_type", options_list=["--resource-type"])
         c.argument("resource_group_name", options_list=["--resource-group", "-g"])
         c.argument("timer", options_list=["--timer", "-t"])
         c.argument(
             "use_sp", options_list=["--service-principal", "--sp"], action="store_true"
         )
+        c.argument("use_sweeper", options_list=["--sweeper"], action="store_true")
 
     with self.argument_context("self-destruct configure") as c:
         c.argument("force", options_list=["--force", "-f"])
 
-    with self.argument_context("self-destruct disarm") as c:
-        c.argument("resource_id", options_list=["--id"])
+    with self.argument_context("self-destruct list") as c:
+        c.argument("resource_type", options_list=["--resource-type"])
         c.argument("resource_group_name", options_list=["--resource-group", "-g"])
+        c.argument("before", options_list=["--before"])
+        c.argument("after", options_list=["--after"])
+        c.argument("subscriptions", options_list=["--subscriptions"], nargs="+")
+        c.argument("local", options_list=["--local"], action="store_true")
+        c.argument("sync", options_list=["--sync"], action="store_true")
+
+
+# pylint: disable=too-many-arguments
+def list_self_destruct_resources(
+    cmd,
+    resource_type=None,
+    resource_group_name=None,
+    before=None,
+    after=None,
+    subscriptions=None,
+    local=False,
+    sync=False,
+):
+    """Everything with a self-destruct-date, from one Resource Graph query over resource groups and resources
+
+    With --local, answer from the ledger instead. --sync brings the ledger up to date first
+    """
+    cli_ctx = cmd.cli_ctx
+    before = get_window_time(before) if before else None
+    after = get_window_time(after) if after else None
+
+    if local or sync:
+        if subscriptions and [s.lower() for s in subscriptions] == ["all"] and not sync:
+            # Everything the ledger knows about, without asking ARM which subscriptions there are
+            subscription_ids = None
+        else:
+            subscription_ids = arm_client.resolve_subscriptions(cli_ctx, subscriptions)
+        if sync:
+            ledger_sync.sync_ledger(cli_ctx, subscription_ids, get_armed_entries)
+        if resource_type and resource_type.lower() == "resourcegroup":
+            resource_type = "resourceGroup"
+        return [
+            get_ledger_row(entry, with_subscription=bool(subscriptions))
+            for entry in ledger.query(
+                subscription_ids,
+                resource_type=resource_type,
+                resource_group_name=resource_group_name,
+                before=before,
+                after=after,
+            )
+        ]
 
+    query = get_self_destruct_query(
+        resource_type=resource_type,
+        resource_group_name=resource_group_name,
+        before=before,
+        after=after,
+    )
 
-def list_self_destruct_resources():
-    self_destruct_resources = []
+    def list_subscription(subscription_id):
+        return arm_client.query_resources(
+            cli_ctx, query, subscriptions=[subscription_id]
+        )
 
-    groups = az_cli(
-        [
-            "group",
-            "list",
-            "--tag",
-            "self-destruct",
-            "--query",
-            '[].{name:name, resourceGroup: name, date:tags."self-destruct-date", type:"resourceGroup"}',
-        ]
+    if subscriptions:
+        rows = arm_client.iter_subscription_rows(
+            arm_client.resolve_subscriptions(cli_ctx, subscriptions),
+            list_subscription,
+        )
+    else:
+        rows = arm_client.query_resources(cli_ctx, query)
+
+    results = []
+    for row in rows:
+        if row["type"] == RESOURCE_GROUP_TYPE:
+            row["type"] = "resourceGroup"
+        results.append(row)
+    return results
+
+
+def get_ledger_row(entry, with_subscription=False):
+    """A ledger entry, shaped like a row from the Resource Graph query"""
+    row = {
+        "name": entry["name"],
+        "resourceGroup": entry["resource_group"],
+        "type": entry["type"],
+        "date": entry["destroy_date"],
+    }
+    if with_subscription:
+        row["subscription"] = entry["subscription"]
+    return row
+
+
+def get_armed_entries(cli_ctx, subscription_id, ids=None):
+    """Ledger entries for everything the tags say is armed in a subscription, or just among these ids"""
+    # Just the columns the ledger keeps, so a big subscription is still a small download
+    rows = arm_client.query_resources(
+        cli_ctx,
+        get_self_destruct_query(ids=ids, columns=ARMED_COLUMNS),
+        subscriptions=[subscription_id],
+    )
+    entries = []
+    for row in rows:
+        entry = get_ledger_entry(
+            row["id"], row["type"], row["date"], swept=bool(row["apiVersion"])
+        )
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def get_ledger_entry(resource_id, resource_type, date_tag, swept=False):
+    """The ledger entry for an armed resource, or None if its self-destruct-date can't be read"""
+    destroy_date = parse_date(date_tag)
+    if destroy_date is None:
+        return None
+
+    resource_group, name, logic_app = get_logic_app_parts(resource_id)
+    resource_type = resource_type.lower()
+    if resource_type in (
+        RESOURCE_GROUP_TYPE,
+        "microsoft.resources/resourcegroups",
+        "resourcegroup",
+    ):
+        resource_type = "resourceGroup"
+    return ledger.make_entry(
+        resource_id,
+        resource_type,
+        destroy_date,
+        date_tag,
+        (resource_group, name, None if swept else logic_app),
     )
-    self_destruct_resources.extend(groups)
 
-    # Bug? Can filter on tags but doesnt' return tag content
-    resources = az_cli(
+
+def record_armed(targets, swept=False):
+    ledger.record_armed(
         [
-            "resource",
-            "list",
-            "--tag",
-            "self-destruct",
-            "--query",
-            '[].{name:name, resourceGroup: resourceGroup, type:type, date:tags."self-destruct-date"}',
+            get_ledger_entry(t["id"], t["type"], str(t["destroyDate"]), swept=swept)
+            for t in targets
         ]
     )
-    self_destruct_resources.extend(resources)
 
-    return self_destruct_resources
+
+# pylint: disable=too-many-arguments
+def get_self_destruct_query(
+    resource_type=None,
+    resource_group_name=None,
+    before=None,
+    after=None,
+    tag=None,
+    ids=None,
+    columns=LIST_COLUMNS,
+):
+    """Resource Graph query for resources and resource groups with a self-destruct-date"""
+    clauses = [
+        "resources",
+        "union resourcecontainers",
+        "where isnotempty(tags['self-destruct-date'])",
+    ]
+    if ids is not None:
+        clauses.append("where id in~ ({})".format(arm_client.get_query_list(ids)))
+    if resource_type:
+        if resource_type.lower() == "resourcegroup":
+            resource_type = RESOURCE_GROUP_TYPE
+        clauses.append("where type =~ '{}'".format(resource_type))
+    if resource_group_name:
+        clauses.append("where resourceGroup =~ '{}'".format(resource_group_name))
+    if tag:
+        name, _, value = tag.partition("=")
+        if value:
+            clauses.append("where tags['{}'] == '{}'".format(name, value))
+        else:
+            clauses.append("where isnotnull(tags['{}'])".format(name))
+    for (op, value) in (("<=", before), (">=", after)):
+        if value:
+            clauses.append(
+                "where todatetime(tags['self-destruct-date']) {} datetime({})".format(
+                    op, value.strftime("%Y-%m-%d %H:%M:%S")
+                )
+            )
+    clauses.append("project " + columns)
+    return " | ".join(clauses)
+
+
+def get_window_time(value):
+    """A UTC date, or a duration like 2h30m from now"""
+    if DURATION_RE.match(value):
+        return get_destruct_time(value)
+    window_time = parse_date(value, WINDOW_DATE_FORMATS)
+    if window_time:
+        return window_time
+    raise CLIError(
+        "Could not parse {}. Use a UTC date like 2020-01-31T18:00:00, or a duration like 2h30m".format(
+            value
+        )
+    )
 
 
-def get_resource(resource_id=None, resource_group_name=None):
+def get_resource(cli_ctx, resource_id=None, resource_group_name=None):
     if resource_id:
-        resource = az_cli(["resource", "show", "--ids", resource_id])
-        resource_type = resource["type"]
-        _, resource_type = resource_type.split("/")
-        resource_group = resource["resourceGroup"]
+        resource = arm_client.show_resource(cli_ctx, resource_id)
         if not resource:
             raise CLIError("Could not find resource with id: {}".format(resource_id))
     else:
-        resource = az_cli(["group", "show", "-n", resource_group_name])
-        resource_type = "resourceGroup"
-        resource_group = resource_group_name
+        resource = arm_client.show_resource(
+            cli_ctx, arm_client.get_resource_group_id(cli_ctx, resource_group_name)
+        )
         if not resource:
             raise CLIError(
                 "Could not find resource group with name: {}".format(
                     resource_group_name
                 )
             )
-    return resource, resource_type, resource_group
-
-
-def arm(cmd, timer, resource_id=None, resource_group_name=None, use_sp=False):
-    if not any([resource_id, resource_group_name]):
-        raise CLIError("You must specify a resourceId or resource group name")
-
-    resource, _, _ = get_resource(
-        resource_id=resource_id, resource_group_name=resource_group_name
+    return resource
+
+
+# pylint: disable=too-many-arguments
+def arm(
+    cmd,
+    timer,
+    resource_id=None,
+    resource_group_name=None,
+    use_sp=False,
+    resource_ids=None,
+    ids_file=None,
+    tag=None,
+    resource_type=None,
+    use_sweeper=False,
+):
+    cli_ctx = cmd.cli_ctx
+    resources = get_arm_targets(
+        cli_ctx,
+        resource_id=resource_id,
+        resource_group_name=resource_group_name,
+        resource_ids=resource_ids,
+        ids_file=ids_file,
+        tag=tag,
+        resource_type=resource_type,
     )
 
     if use_sp:
@@ -144,77 +349,178 @@ def arm(cmd, timer, resource_id=None, resource_group_name=None, use_sp=False):
 
     SELF_DESTRUCT["destroyDate"] = get_destruct_time(timer)
 
-    deploy_self_destruct_template(cmd.cli_ctx, resource)
-
-    if resource_id:
-        args = ["resource", "update", "--ids", resource_id]
+    if use_sweeper:
+        # A sweeper deletes anything whose date has passed, so arming is just the tags
+        armed, errors = get_swept_targets(cli_ctx, resources), []
     else:
-        args = ["group", "update", "-n", resource_group_name]
-
-    args.extend(["--set", "tags.self-destruct"])
-    args.extend(
-        ["--set", "tags.self-destruct-date={}".format(SELF_DESTRUCT["destroyDate"])]
-    )
-    az_cli(args)
+        armed, errors = deploy_self_destruct_templates(cli_ctx, resources)
 
+    raise_for_errors(tag_armed(cli_ctx, armed))
 
-def disarm(resource_id=None, resource_group_name=None):
-    if not any([resource_id, resource_group_name]):
-        raise CLIError("You must specify a resourceId or resource group name")
+    if use_sweeper:
+        record_armed(armed, swept=True)
 
-    resource, resource_type, resource_group = get_resource(
-        resource_id=resource_id, resource_group_name=resource_group_name
-    )
-    name = resource["name"]
+    if errors:
+        raise CLIError(
+            "Could not activate a self-destruct sequence for {} of {} resources:\n{}".format(
+                len(resources) - len(armed), len(resources), "\n".join(errors)
+            )
+        )
 
-    logic_name = "self-destruct-{}-{}-{}".format(resource_type, resource_group, name)
 
-    logic_app = az_cli(
-        [
-            "resource",
-            "show",
-            "-g",
-            resource_group,
-            "-n",
-            logic_name,
-            "--resource-type",
-            "Microsoft.Logic/workflows",
-        ]
-    )
-    if not logic_app:
+# pylint: disable=too-many-arguments
+def get_arm_targets(
+    cli_ctx,
+    resource_id=None,
+    resource_group_name=None,
+    resource_ids=None,
+    ids_file=None,
+    tag=None,
+    resource_type=None,
+):
+    """Find the resources to arm from --id/--ids/--ids-file, a --tag/--resource-type selector, or -g"""
+    ids = ([resource_id] if resource_id else []) + list(resource_ids or [])
+    if ids_file:
+        ids.extend(read_ids_file(ids_file))
+
+    resources = []
+    if tag or resource_type:
+        # With a selector, -g narrows the search instead of naming a target
+        resources.extend(
+            select_resources(cli_ctx, tag, resource_type, resource_group_name)
+        )
+    elif resource_group_name:
+        resources.append(get_resource(cli_ctx, resource_group_name=resource_group_name))
+    elif not ids:
         raise CLIError(
-            "Could not find a self-destruct Logic App for resource with id: {}".format(
-                name
+            "You must specify resource ids, a tag or resource type, or a resource group name"
+        )
+
+    resources.extend(
+        raise_for_errors(
+            run_many(
+                [partial(get_resource, cli_ctx, resource_id=i) for i in ids],
+                max_workers=BULK_WORKERS,
+                fail_fast=True,
             )
         )
+    )
 
-    az_cli(
-        [
-            "resource",
-            "delete",
-            "-g",
-            resource_group,
-            "-n",
-            logic_name,
-            "--resource-type",
-            "Microsoft.Logic/workflows",
-        ]
+    # The same resource can be named more than once, ex: in --ids and by --tag
+    unique = {}
+    for resource in resources:
+        unique.setdefault(resource["id"].lower(), resource)
+    if not unique:
+        raise CLIError("No resources matched")
+    return list(unique.values())
+
+
+def get_swept_targets(cli_ctx, resources):
+    from .sweeper import API_VERSION_TAG, get_sweeper_scopes
+
+    targets = [get_self_destruct_target(cli_ctx, r) for r in resources]
+    scopes = get_sweeper_scopes(cli_ctx)
+    subscription_id = "/subscriptions/{}".format(
+        arm_client.get_subscription_id(cli_ctx)
+    ).lower()
+
+    for target in targets:
+        target["tags"] = {API_VERSION_TAG: target["apiVersion"]}
+
+    if subscription_id not in scopes:
+        # A group sweeper can't delete the group it lives in
+        groups = sorted(
+            t["resourceGroup"] for t in targets if is_resource_group_id(t["id"])
+        )
+        unswept = {
+            t["resourceGroup"]
+            for t in targets
+            if not is_resource_group_id(t["id"])
+            and "{}/resourcegroups/{}".format(
+                subscription_id, t["resourceGroup"].lower()
+            )
+            not in scopes
+        }
+        for resource_group in groups:
+            LOGGER.warning(
+                "Only a subscription sweeper can delete resource group %s. Run `az self-destruct sweeper deploy -g <group> --scope subscription`",
+                resource_group,
+            )
+        for resource_group in sorted(unswept):
+            LOGGER.warning(
+                "No sweeper covers resource group %s yet. Run `az self-destruct sweeper deploy -g %s`",
+                resource_group,
+                resource_group,
+            )
+
+    LOGGER.warning(
+        "You've activated a self-destruct sequence! %d resources will be swept after %s UTC",
+        len(targets),
+        SELF_DESTRUCT["destroyDate"],
     )
+    return targets
 
-    LOGGER.warning("Self-destruct sequence deactivated for %s", name)
 
-    if resource_id:
-        args = ["resource", "update", "--ids", resource_id]
+def read_ids_file(path):
+    """Resource ids, one per line. Blank lines and # comments are skipped"""
+    try:
+        with open(os.path.expanduser(path), "r") as ids_file:
+            lines = [line.split("#", 1)[0].strip() for line in ids_file]
+    except (IOError, OSError) as ex:
+        raise CLIError("Could not read resource ids from {}: {}".format(path, ex))
+    return [line for line in lines if line]
+
+
+def select_resources(cli_ctx, tag=None, resource_type=None, resource_group_name=None):
+    path = "/subscriptions/{}".format(arm_client.get_subscription_id(cli_ctx))
+    if resource_group_name:
+        path = arm_client.get_resource_group_id(cli_ctx, resource_group_name)
+
+    # ARM can't combine a tag filter with anything else, so the type is checked here when both are given
+    if tag:
+        name, _, value = tag.partition("=")
+        resource_filter = "tagName eq '{}'".format(name)
+        if value:
+            resource_filter += " and tagValue eq '{}'".format(value)
     else:
-        args = ["group", "update", "-n", resource_group_name]
+        resource_filter = "resourceType eq '{}'".format(resource_type)
+
+    for resource in arm_client.iter_resources(
+        cli_ctx,
+        "{}/resources".format(path),
+        arm_client.RESOURCES_API_VERSION,
+        params={"$filter": resource_filter},
+    ):
+        if not resource_type or resource["type"].lower() == resource_type.lower():
+            yield resource
+
+
+def parse_date(value, date_formats=TAG_DATE_FORMATS):
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
 
-    if "self-destruct" in resource["tags"]:
-        args.extend(["--remove", "tags.self-destruct"])
-    if "self-destruct-date" in resource["tags"]:
-        args.extend(["--remove", "tags.self-destruct-date"])
+def get_logic_app_name(resource_type, resource_group, name):
+    return "self-destruct-{}-{}-{}".format(resource_type, resource_group, name)
+
+
+def get_logic_app_parts(resource_id):
+    """(resource group, name, self-destruct Logic App name) for a resource or resource group id"""
+    from msrestazure.tools import parse_resource_id
 
-    if len(args) > 4:
-        az_cli(args)
+    parts = parse_resource_id(resource_id)
+    resource_group = parts["resource_group"]
+    if "resource_name" in parts:
+        name = parts["resource_name"]
+        logic_app = get_logic_app_name(parts["resource_type"], resource_group, name)
+    else:
+        name = resource_group
+        logic_app = get_logic_app_name("resourceGroups", resource_group, name)
+    return resource_group, name, logic_app
 
 
 def configure_sp(client_id=None, client_secret=None, tenant_id=None, force=False):
@@ -292,193 +598,313 @@ def get_destruct_time(delta_str):
         raise CLIError("Could not parse the time offset {}".format(delta_str))
 
 
-# TODO: update tags of an existing resource during the Logic App ARM template deployment
-def add_self_destruct_tag_args(args, destroy_date):
-    exclude = {"identity", "container"}
-
-    if exclude.intersection(args):
-        LOGGER.warning(
-            "Cannot add tags for this resource - it won't show in `az self-destruct list`"
-        )
-        return
-
-    create_tags = True
-    for idx, arg in enumerate(args):
-        if arg == "--tags":
-            create_tags = False
-            args.insert(idx + 1, "self-destruct-date={}".format(destroy_date))
-            args.insert(idx + 1, "self-destruct=")
-
-    if create_tags:
-        args.extend(
-            ["--tags", "self-destruct", "self-destruct-date={}".format(destroy_date)]
-        )
-
-
-def self_destruct_pre_parse_args_handler(_, **kwargs):
-    args = kwargs.get("args")
-
-    # activate only when --self-destruct is activated
-    if "--self-destruct" in args:
-
-        # simple validations
-        if "create" not in args:
-            raise CLIError(
-                "You can only initiate a self-destruct sequence when creating a resource"
-            )
-        if "container" in args:
-            raise CLIError("`az container create` does not support tags")
-
-        if "--self-destruct-sp" in args:
-            read_self_destruct_sp_config()
-
-        index = args.index("--self-destruct")
-        delta_str = args[index + 1]
-        SELF_DESTRUCT["destroyDate"] = get_destruct_time(delta_str)
-        SELF_DESTRUCT["active"] = True
-
-        add_self_destruct_tag_args(args, SELF_DESTRUCT["destroyDate"])
-
-
-def self_destruct_post_parse_args_handler(_, **kwargs):
-    args = kwargs.get("args")
-
-    if "self_destruct" in args:
-        delattr(args, "self_destruct")
-    if "self_destruct_sp" in args:
-        delattr(args, "self_destruct_sp")
-
-
-def check_service_principal(
-    cli_ctx, resource_id, namespace, resource_type, root_type=None
-):
+def get_service_principal_token(cli_ctx):
+    """An ARM token for the self-destruct service principal"""
     from azure.cli.core._profile import (
         ServicePrincipalAuth,
         _authentication_context_factory,
     )
 
-    try:
-        # Get SP token
-        sp_auth = ServicePrincipalAuth(SELF_DESTRUCT["clientSecret"])
-        context = _authentication_context_factory(
-            cli_ctx, SELF_DESTRUCT["tenantId"], None
-        )
-        resource = cli_ctx.cloud.endpoints.active_directory_resource_id
+    sp_auth = ServicePrincipalAuth(SELF_DESTRUCT["clientSecret"])
+    context = _authentication_context_factory(cli_ctx, SELF_DESTRUCT["tenantId"], None)
+    resource = cli_ctx.cloud.endpoints.active_directory_resource_id
+
+    def acquire():
         token = sp_auth.acquire_token(context, resource, SELF_DESTRUCT["clientId"])
+        return token["accessToken"], auth.get_expiry(token)
 
-        # Check permissions for resource
-        uri = "https://management.azure.com{}/providers/Microsoft.Authorization/permissions?api-version=2015-07-01".format(
-            resource_id
-        )
-        headers = {"Authorization": "Bearer {}".format(token["accessToken"])}
-        r = requests.get(uri, headers=headers)
+    return auth.get_token(
+        SELF_DESTRUCT["tenantId"], resource, SELF_DESTRUCT["clientId"], acquire
+    )
 
-        # TODO: Check expiration date of SP
 
-        # If we can't read permissions - it may or may not be an actual problem
-        # It's perfectly valid to create a "Delete Storage Accounts in resource group X only" cleanup role that can't read roleAssignments
-        # I'd prefer always-correct behavior - so fail fast here
-        if r.status_code != 200:
-            error = r.json()
-            LOGGER.error(
-                "There was a failure when checking service principal permissions. Your self-destruct sequence cannot be activated!"
-            )
-            LOGGER.error("%s: %s", error["error"]["code"], error["error"]["message"])
-            return False
-    except Exception:  # pylint: disable=broad-except
+def check_service_principal(cli_ctx, targets):
+    """Make sure the self-destruct SP can delete each target. Returns {resource id: reason} for the ones it can't"""
+    # If we can't read permissions - it may or may not be an actual problem
+    # It's perfectly valid to create a "Delete Storage Accounts in resource group X only" cleanup role that can't read roleAssignments
+    # I'd prefer always-correct behavior - so fail fast here
+    # TODO: Check expiration date of SP
+    try:
+        access_token = get_service_principal_token(cli_ctx)
+    except Exception as ex:  # pylint: disable=broad-except
         LOGGER.error(
             "There was a failure when checking service principal permissions. Your self-destruct sequence cannot be activated!"
         )
-        return False
-
-    # This is a mine field of complex behavior
-    # action: '*' means everything, unless there's an overriding notAction
-    # There can be wildcards inlined in both actions and notActions
-    # Namespaces often don't match product names, etc
-    permissions = r.json()["value"][0]
-    reqs = {
-        "*",
-        "{}/*".format(namespace),  # Microsoft.Storage/*
-        "{}/*/delete".format(namespace),  # Microsoft.Storage/*/delete
-        "{}/{}/*".format(namespace, resource_type),  # Microsoft.Storage/storageAccounts
-        "{}/{}/delete".format(
-            namespace, resource_type
-        ),  # Microsoft.Storage/storageAccounts/delete
-    }
-    if root_type:
-        reqs.add("{}/{}/{}/*".format(namespace, root_type, resource_type))
-        reqs.add("{}/{}/{}/delete".format(namespace, root_type, resource_type))
-
-    actions = set(permissions["actions"])
-    not_actions = set(permissions["notActions"])
+        return {t["id"]: str(ex) for t in targets}
 
-    if not reqs.intersection(actions) or reqs.intersection(not_actions):
+    denied = rbac.find_undeletable(
+        cli_ctx, [t["id"] for t in targets], access_token=access_token
+    )
+    if denied:
         LOGGER.error(
             "Service principal delete permissions could not be verified. Your self-destruct sequence cannot be activated!"
         )
-        LOGGER.error("Needed: one of %s", reqs)
-        LOGGER.error("Allow: %s", actions)
-        LOGGER.error("Deny: %s", not_actions)
-        return False
-
-    return True
+    return denied
 
 
-def deploy_self_destruct_template(cli_ctx, resource):
+def get_self_destruct_target(cli_ctx, resource):
+    """Everything needed to arm one resource: where its Logic App goes, and how to delete it"""
     from msrestazure.tools import parse_resource_id
 
     resource_id = resource["id"]
     parts = parse_resource_id(resource_id)
 
-    root_type = None
     if "resource_name" in parts:
         namespace = parts["namespace"]
         resource_type = parts["resource_type"]
-        if parts["type"] != parts["resource_type"]:
-            root_type = parts["type"]
         resource_group = parts["resource_group"]
         # Get api-version
-        api_version = az_cli(
-            [
-                "provider",
-                "show",
-                "-n",
-                parts["namespace"],
-                "--query",
-                "resourceTypes | [?resourceType==`{}`] | [0].apiVersions[0]".format(
-                    resource_type
-                ),
-            ],
-            output_as_json=False,
-        )
+        api_version = arm_client.get_api_version_for_id(cli_ctx, resource_id)
         name = parts["resource_name"]
     else:
         namespace = "Microsoft.Resources"
         resource_type = "resourceGroups"
-        root_type = "subscriptions"
         resource_group = resource_id.split("/")[-1]
         name = resource_id.split("/")[-1]
         api_version = "2018-02-01"
 
-    # Make sure the SP (if specified) can delete the resource
-    if "client_id" in SELF_DESTRUCT:
-        authorized = check_service_principal(
-            cli_ctx, resource_id, namespace, resource_type, root_type=root_type
-        )
-        if not authorized:
+    return {
+        "id": resource_id,
+        "type": resource.get("type") or "{}/{}".format(namespace, resource_type),
+        "resourceGroup": resource_group,
+        "logicAppName": get_logic_app_name(resource_type, resource_group, name),
+        "apiVersion": api_version,
+        "destroyDate": SELF_DESTRUCT["destroyDate"],
+        # Tags to set on the resource, besides the self-destruct date
+        "tags": {},
+        # Build ARM URL
+        "resourceUri": "{}{}?api-version={}".format(
+            arm_client.get_endpoint(cli_ctx), resource_id, api_version
+        ),
+    }
+
+
+def deploy_self_destruct_templates(cli_ctx, resources, stagger=False, early=None):
+    """Create the Logic Apps that delete resources at SELF_DESTRUCT["destroyDate"]
+
+    Resources are grouped by resource group. Each group gets one deployment that creates all of its Logic Apps
+    with a copy loop, and the groups are deployed concurrently. With stagger, resources are deleted in DELETE_TIERS
+    order instead of all at once. early is an arm that started while the resource was created (see early_arm.py).
+    It's waited on alongside the deployments, and only redone if it failed or its date changed. Either way it has
+    finished before its target is deployed again.
+    Returns (armed resources, error messages)
+    """
+    targets = [get_self_destruct_target(cli_ctx, r) for r in resources]
+    if stagger:
+        stagger_targets(targets)
+    errors = []
+
+    # Make sure the SP (if specified) can delete the resources
+    if "clientId" in SELF_DESTRUCT:
+        denied = check_service_principal(cli_ctx, targets)
+        if denied:
+            errors.extend("{}: {}".format(i, reason) for (i, reason) in denied.items())
             LOGGER.error(
                 "You may need to run `az self-destruct configure` to reenable self-destruct mode"
             )
-            return
+        targets = [t for t in targets if t["id"] not in denied]
+
+    early_targets = []
+    if early:
+        key = (early["id"].lower(), early["destroyDate"])
+        early_targets = [
+            t for t in targets if (t["id"].lower(), t["destroyDate"]) == key
+        ]
+        targets = [t for t in targets if t not in early_targets]
+        if not early_targets:
+            # Its date moved (ex: stagger), so its target is deployed again below. Not while the early arm is
+            # still writing the same Logic App
+            wait_for_early_arm(early)
+
+    deployments = get_deployments(targets)
+    calls = [
+        partial(deploy_self_destruct_group, cli_ctx, resource_group, name, chunk)
+        for (resource_group, name, chunk) in deployments
+    ]
+    if early_targets:
+        # Whatever's left of the early arm, while the rest deploy
+        calls.append(early["future"].result)
+        deployments.append(
+            (early_targets[0]["resourceGroup"], "(early arm)", early_targets)
+        )
+    results = run_many(calls, max_workers=BULK_WORKERS)
+    if early_targets and results[-1].error is not None:
+        # Most likely something the arm needed didn't exist yet. It does now
+        LOGGER.info("Could not arm while creating, arming now: %s", results[-1].error)
+        resource_group = early_targets[0]["resourceGroup"]
+        name = get_deployment_name(early_targets, SELF_DESTRUCT["destroyDate"])
+        deployments[-1] = (resource_group, name, early_targets)
+        results[-1] = run_many(
+            [
+                partial(
+                    deploy_self_destruct_group,
+                    cli_ctx,
+                    resource_group,
+                    name,
+                    early_targets,
+                )
+            ]
+        )[0]
+
+    armed = []
+    for ((resource_group, name, chunk), result) in zip(deployments, results):
+        if result.error is not None:
+            LOGGER.error(
+                "Deployment %s in %s failed: %s", name, resource_group, result.error
+            )
+            errors.extend("{}: {}".format(t["id"], result.error) for t in chunk)
+            continue
+        armed.extend(chunk)
+    record_armed(armed)
+    prune_armed_groups(cli_ctx, armed)
+    log_armed(armed)
+    return armed, errors
+
+
+def wait_for_early_arm(early):
+    """Cancel an early arm, or wait for it if it already started. Its result doesn't matter anymore"""
+    if early["future"].cancel():
+        return
+    try:
+        early["future"].result()
+    except Exception as ex:  # pylint: disable=broad-except
+        LOGGER.info("Early arm of %s failed: %s", early["id"], ex)
+
+
+def get_deployments(targets):
+    """(resource group, deployment name, targets) for each deployment it takes to arm these targets"""
+    groups = {}
+    for target in targets:
+        groups.setdefault(target["resourceGroup"], []).append(target)
+
+    deployments = []
+    for (resource_group, group_targets) in groups.items():
+        for i in range(0, len(group_targets), MAX_DEPLOYMENT_TARGETS):
+            chunk = group_targets[i : i + MAX_DEPLOYMENT_TARGETS]
+            name = get_deployment_name(chunk, SELF_DESTRUCT["destroyDate"])
+            deployments.append((resource_group, name, chunk))
+    return deployments
+
+
+def prune_armed_groups(cli_ctx, armed):
+    """Keep deployment history under ARM's limit. Pruning is best effort, and never fails an arm"""
+    pruned_groups = sorted({t["resourceGroup"] for t in armed})
+    results = run_many(
+        [partial(prune_deployments, cli_ctx, g) for g in pruned_groups],
+        max_workers=BULK_WORKERS,
+    )
+    for (resource_group, result) in zip(pruned_groups, results):
+        if result.error is not None:
+            LOGGER.info(
+                "Could not prune deployments in %s: %s", resource_group, result.error
+            )
+
+
+def log_armed(armed):
+    dates = sorted({t["destroyDate"] for t in armed})
+    if len(armed) == 1:
+        LOGGER.warning(
+            "You've activated a self-destruct sequence! %s is scheduled for deletion at %s UTC",
+            armed[0]["id"],
+            SELF_DESTRUCT["destroyDate"],
+        )
+    elif len(dates) > 1:
+        LOGGER.warning(
+            "You've activated a self-destruct sequence! %d resources in %d resource groups are scheduled for deletion in %d tiers, from %s to %s UTC",
+            len(armed),
+            len({t["resourceGroup"] for t in armed}),
+            len(dates),
+            dates[0],
+            dates[-1],
+        )
+    elif armed:
+        LOGGER.warning(
+            "You've activated a self-destruct sequence! %d resources in %d resource groups are scheduled for deletion at %s UTC",
+            len(armed),
+            len({t["resourceGroup"] for t in armed}),
+            SELF_DESTRUCT["destroyDate"],
+        )
+
+
+def stagger_targets(targets):
+    """Push each target's destroy date back by its rank among the DELETE_TIERS present, so a lone NIC isn't delayed"""
+    tiers = {t["id"]: DELETE_TIERS.get(t["type"].lower(), 0) for t in targets}
+    ranks = {tier: rank for (rank, tier) in enumerate(sorted(set(tiers.values())))}
+    for target in targets:
+        target["destroyDate"] += TIER_DELAY * ranks[tiers[target["id"]]]
+
+
+def tag_armed(cli_ctx, targets):
+    """Tag armed resources with their own self-destruct-date. Returns an AzCliResult per target"""
+    return run_many(
+        [
+            partial(
+                arm_client.update_tags,
+                cli_ctx,
+                t["id"],
+                dict(
+                    {"self-destruct": "", "self-destruct-date": str(t["destroyDate"])},
+                    **t["tags"]
+                ),
+            )
+            for t in targets
+        ],
+        max_workers=BULK_WORKERS,
+    )
+
+
+def get_deployment_name(targets, destroy_date):
+    """Unique to the targets and time, so concurrent arms in a resource group never share a deployment
+
+    The same arm retried gets the same name, and updates its own deployment instead of starting another one
+    """
+    digest = hashlib.sha1()
+    for resource_id in sorted(t["id"].lower() for t in targets):
+        digest.update(resource_id.encode("utf-8"))
+        digest.update(b"\n")
+    digest.update(str(destroy_date).encode("utf-8"))
+    return DEPLOYMENT_PREFIX + digest.hexdigest()[:20]
+
+
+def is_self_destruct_deployment(name):
+    return name.startswith(DEPLOYMENT_PREFIX) or LEGACY_DEPLOYMENT_RE.match(name)
 
-    # Build ARM URL
-    resource_uri = "https://management.azure.com{}?api-version={}".format(
-        resource_id, api_version
+
+def prune_deployments(cli_ctx, resource_group, keep=DEPLOYMENT_HISTORY):
+    """Delete all but the newest finished arm deployments in a resource group. The Logic Apps they made stay"""
+    finished = [
+        d
+        for d in arm_client.list_deployments(cli_ctx, resource_group)
+        if is_self_destruct_deployment(d["name"])
+        and d["properties"]["provisioningState"]
+        in arm_client.DEPLOYMENT_TERMINAL_STATES
+    ]
+    finished.sort(key=lambda d: d["properties"].get("timestamp", ""), reverse=True)
+    stale = finished[keep:]
+    if not stale:
+        return 0
+
+    LOGGER.info(
+        "Pruning %d self-destruct deployments in %s", len(stale), resource_group
+    )
+    results = run_many(
+        [
+            partial(arm_client.delete_deployment, cli_ctx, resource_group, d["name"])
+            for d in stale
+        ],
+        max_workers=BULK_WORKERS,
     )
-    LOGGER.info(resource_uri)
+    for (deployment, result) in zip(stale, results):
+        if result.error is not None:
+            LOGGER.info(
+                "Could not delete deployment %s: %s", deployment["name"], result.error
+            )
+    return len(stale)
+
 
+def deploy_self_destruct_group(cli_ctx, resource_group, deployment_name, targets):
     # Create Logic App
-    if "client_id" in SELF_DESTRUCT:
+    if "clientId" in SELF_DESTRUCT:
         template_file = os.path.join(
             os.path.dirname(os.path.realpath(__file__)),
             "self_destruct_template_sp.json",
@@ -490,81 +916,43 @@ def deploy_self_destruct_template(cli_ctx, resource):
         )
     template = get_file_json(template_file)
 
-    parameters = {}
-    parameters["name"] = {
-        "value": "self-destruct-{}-{}-{}".format(resource_type, resource_group, name)
-    }
-    parameters["utcTime"] = {
-        "value": SELF_DESTRUCT["destroyDate"].strftime("%Y-%m-%dT%H:%M:%SZ")
+    parameters = arm_client.get_cloud_parameters(cli_ctx)
+    parameters["targets"] = {
+        "value": [
+            {
+                "name": t["logicAppName"],
+                "resourceUri": t["resourceUri"],
+                "utcTime": t["destroyDate"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+            for t in targets
+        ]
     }
-    parameters["resourceUri"] = {"value": resource_uri}
 
-    if "client_id" in SELF_DESTRUCT:
+    if "clientId" in SELF_DESTRUCT:
         parameters["servicePrincipalClientId"] = {"value": SELF_DESTRUCT["clientId"]}
         parameters["servicePrincipalClientSecret"] = {
             "value": SELF_DESTRUCT["clientSecret"]
         }
         parameters["servicePrincipalTenantId"] = {"value": SELF_DESTRUCT["tenantId"]}
 
-    deploy_result = _deploy_arm_template_core(
-        cli_ctx, resource_group, "self_destruct", template, parameters
-    )
-    LOGGER.warning(
-        "You've activated a self-destruct sequence! %s is scheduled for deletion at %s UTC",
-        resource_id,
-        SELF_DESTRUCT["destroyDate"],
+    deploy_result = arm_client.deploy_template(
+        cli_ctx, resource_group, deployment_name, template, parameters
     )
     LOGGER.info(deploy_result)
+    return deploy_result
 
 
-def self_destruct_transform_handler(cli_ctx, **kwargs):
-    if SELF_DESTRUCT["active"]:
-        result = kwargs.get("event_data")["result"]
+def is_resource_group_id(resource_id):
+    parts = resource_id.strip("/").split("/")
+    return len(parts) == 4 and parts[2].lower() == "resourcegroups"
 
-        # TODO: some command modules (ahem, networking...) output data in bizarro formats
-        # Ex: https://github.com/Azure/azure-cli/blob/d859a0ad99e3947731c877ac9b81c4431f3422c5/src/command_modules/azure-cli-network/azure/cli/command_modules/network/_format.py#L103
-        # There has to be a better way to hook in and steal the original response
-        # Not sure that transforms are even guaranteed to run in order
-        # This is a placeholder until I find something better
-        if "newVNet" in result:
-            result = result["newVNet"]
-        elif "publicIp" in result:
-            result = result["publicIp"]
-        elif "TrafficManagerProfile" in result:
-            result = result["TrafficManagerProfile"]
-        elif "NewNIC" in result:
-            result = result["NewNIC"]
-        elif "NewNSG" in result:
-            result = result["NewNSG"]
-
-        deploy_self_destruct_template(cli_ctx, result)
-
-
-# pylint: disable=unused-argument
-def self_destruct_add_parameters(cli_ctx, commands_loader):
-    from knack.arguments import CLICommandArgument
-
-    command_table = cli_ctx.invocation.commands_loader.command_table
-
-    if not command_table:
-        return
 
-    create_commands = [v for k, v in command_table.items() if "create" in k]
-    if create_commands:
-        command = create_commands[0]
-        command.arguments["self_destruct"] = CLICommandArgument(
-            "self_destruct",
-            options_list=["--self-destruct"],
-            arg_group="Self Destruct (noelbundick)",
-            help="How long to wait until deletion. You can specify durations like 1d, 6h, 2h30m, 30m, etc",
-        )
-        command.arguments["self_destruct_sp"] = CLICommandArgument(
-            "self_destruct_sp",
-            options_list=["--self-destruct-sp"],
-            action="store_true",
-            arg_group="Self Destruct (noelbundick)",
-            help="Use legacy behavior that uses a predefined Service Principal",
-        )
+def get_resource_type(resource_id):
+    """Ex: Microsoft.Network/virtualNetworks, or Microsoft.Resources/resourceGroups"""
+    parts = resource_id.strip("/").split("/")
+    if len(parts) == 4:
+        return "Microsoft.Resources/resourceGroups"
+    return "{}/{}".format(parts[5], parts[6])
 
 
 def get_config_parser():
@@ -581,29 +969,3 @@ def parse_time(time_str):
         if param:
             time_params[name] = int(param)
     return timedelta(**time_params)
-
-
-def resource_client_factory(cli_ctx, **_):
-    from azure.cli.core.commands.client_factory import get_mgmt_service_client
-    from azure.mgmt.resource import ResourceManagementClient
-
-    return get_mgmt_service_client(cli_ctx, ResourceManagementClient)
-
-
-def _deploy_arm_template_core(
-    cli_ctx, resource_group_name, deployment_name, template, parameters
-):
-    from azure.mgmt.resource.resources.models import Deployment, DeploymentProperties
-    from azure.cli.core.commands import LongRunningOperation
-
-    properties = DeploymentProperties(
-        template=template, parameters=parameters, mode="incremental"
-    )
-    deployment = Deployment(properties=properties)
-    client = resource_client_factory(cli_ctx)
-
-    deploy_poll = client.deployments.create_or_update(
-        resource_group_name, deployment_name, deployment, raw=False
-    )
-    result = LongRunningOperation(cli_ctx)(deploy_poll)
-    return result
@@ -0,0 +1,172 @@
+import os
+from functools import partial
+
+from azure.cli.core.commands import CliCommandType
+from azure.cli.core.commands.parameters import get_enum_type
+from azure.cli.core.util import get_file_json
+from knack.log import get_logger
+from knack.util import CLIError
+
+from . import arm as arm_client
+from .cli_utils import run_many
+
+LOGGER = get_logger(__name__)
+
+LOGIC_API_VERSION = "2019-05-01"
+CONTRIBUTOR_ROLE_ID = "b24988ac-6180-42a0-ab88-20f7382dd24c"
+
+# Sweepers are tagged with the scope they sweep, so `self-destruct arm --sweeper` can tell if one covers a resource
+SWEEPER_TAG = "self-destruct-sweeper"
+# Swept resources carry the api-version to delete them with, since the sweeper can't look it up
+API_VERSION_TAG = "self-destruct-api-version"
+SWEEPER_NAMES = {
+    "group": "self-destruct-sweeper",
+    "subscription": "self-destruct-sweeper-subscription",
+}
+DELETE_WORKERS = 16
+
+
+def load_command_table(self, _):
+    custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
+
+    with self.command_group("self-destruct sweeper", custom_command_type=custom) as g:
+        g.custom_command("deploy", "deploy_sweeper")
+        g.custom_command("run", "run_sweeper")
+
+
+def load_arguments(self, _):
+    with self.argument_context("self-destruct sweeper") as c:
+        c.argument("resource_group_name", options_list=["--resource-group", "-g"])
+        c.argument("scope", arg_type=get_enum_type(["group", "subscription"]))
+
+    with self.argument_context("self-destruct sweeper deploy") as c:
+        c.argument("interval", options_list=["--interval", "-i"], type=int)
+
+    with self.argument_context("self-destruct sweeper run") as c:
+        c.argument("dry_run", options_list=["--dry-run"], action="store_true")
+
+
+def get_expired_query(resource_group_name=None):
+    """Resource Graph query for swept resources whose self-destruct-date has passed
+
+    The sweeper Logic App and `az self-destruct sweeper run` use the same query.
+    A group sweeper can't delete its own resource group, so only a subscription sweeper looks for groups
+    """
+    clauses = ["resources"]
+    if not resource_group_name:
+        clauses.append("union resourcecontainers")
+    clauses += [
+        "where isnotempty(tags['{}'])".format(API_VERSION_TAG),
+        "where todatetime(tags['self-destruct-date']) <= now()",
+    ]
+    if resource_group_name:
+        clauses.append("where resourceGroup =~ '{}'".format(resource_group_name))
+    clauses.append(
+        "project id, type, apiVersion = tostring(tags['{}'])".format(API_VERSION_TAG)
+    )
+    return " | ".join(clauses)
+
+
+def get_scope_id(cli_ctx, scope, resource_group_name):
+    if scope == "subscription":
+        return "/subscriptions/{}".format(arm_client.get_subscription_id(cli_ctx))
+    return arm_client.get_resource_group_id(cli_ctx, resource_group_name)
+
+
+def deploy_sweeper(cmd, resource_group_name, scope="group", interval=15):
+    """One Logic App that deletes every expired resource in a resource group or subscription on a schedule"""
+    cli_ctx = cmd.cli_ctx
+    scope_id = get_scope_id(cli_ctx, scope, resource_group_name)
+    name = SWEEPER_NAMES[scope]
+
+    template = get_file_json(
+        os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            "self_destruct_sweeper_template.json",
+        )
+    )
+    parameters = arm_client.get_cloud_parameters(cli_ctx)
+    parameters.update(
+        {
+            "name": {"value": name},
+            "scope": {"value": scope_id},
+            "intervalMinutes": {"value": interval},
+            "query": {
+                "value": get_expired_query(
+                    resource_group_name if scope == "group" else None
+                )
+            },
+        }
+    )
+    arm_client.deploy_template(
+        cli_ctx, resource_group_name, "self_destruct_sweeper", template, parameters
+    )
+
+    workflow = arm_client.show_resource(
+        cli_ctx,
+        "{}/providers/Microsoft.Logic/workflows/{}".format(
+            arm_client.get_resource_group_id(cli_ctx, resource_group_name), name
+        ),
+        api_version=LOGIC_API_VERSION,
+    )
+    principal_id = workflow["identity"]["principalId"]
+
+    # The sweeper deletes anything in its scope, so it needs Contributor there
+    # Adding a role assignment blows up if it already exists
+    role_id = arm_client.get_role_definition_id(cli_ctx, scope_id, CONTRIBUTOR_ROLE_ID)
+    if not arm_client.list_role_assignments(
+        cli_ctx, scope_id, principal_id=principal_id, role_definition_id=role_id
+    ):
+        arm_client.create_role_assignment(
+            cli_ctx, scope_id, role_id, principal_id, principal_type="ServicePrincipal"
+        )
+
+    LOGGER.warning(
+        "Expired resources in %s will be deleted every %d minutes", scope_id, interval
+    )
+    return workflow
+
+
+def run_sweeper(cmd, resource_group_name=None, scope="group", dry_run=False):
+    """Do what the sweeper does, from here: find expired resources and delete them"""
+    cli_ctx = cmd.cli_ctx
+    if scope == "group" and not resource_group_name:
+        raise CLIError(
+            "You must specify a resource group name, or --scope subscription"
+        )
+
+    expired = list(
+        arm_client.query_resources(
+            cli_ctx,
+            get_expired_query(resource_group_name if scope == "group" else None),
+        )
+    )
+    if dry_run:
+        return expired
+
+    results = run_many(
+        [
+            partial(
+                arm_client.delete_resource,
+                cli_ctx,
+                r["id"],
+                api_version=r["apiVersion"],
+            )
+            for r in expired
+        ],
+        max_workers=DELETE_WORKERS,
+    )
+    for (resource, result) in zip(expired, results):
+        resource["status"] = "Deleted" if result.error is None else str(result.error)
+    return expired
+
+
+def get_sweeper_scopes(cli_ctx):
+    """The (lowercased) ids of every resource group or subscription that a sweeper covers"""
+    sweepers = arm_client.iter_resources(
+        cli_ctx,
+        "/subscriptions/{}/resources".format(arm_client.get_subscription_id(cli_ctx)),
+        arm_client.RESOURCES_API_VERSION,
+        params={"$filter": "tagName eq '{}'".format(SWEEPER_TAG)},
+    )
+    return {s["tags"][SWEEPER_TAG].lower() for s in sweepers}
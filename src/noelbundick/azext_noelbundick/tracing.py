@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from knack.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+# Set AZEXT_NOELBUNDICK_TRACE=true to record a span for every nested az call, HTTP request, token fetch and deployment
+# Spans are written as a Chrome trace (chrome://tracing, Perfetto) to the given path, or a temp file for true/1
+TRACE = {
+    "enabled": False,
+    "path": None,
+    "spans": [],
+    "pid": os.getpid(),
+}
+TRACE_LOCK = threading.Lock()
+
+
+def enable(path=None):
+    if TRACE["enabled"]:
+        return
+    if not path:
+        import tempfile
+
+        path = os.path.join(
+            tempfile.gettempdir(),
+            "noelbundick-trace-{}-{}.json".format(int(time.time()), os.getpid()),
+        )
+    TRACE["enabled"] = True
+    TRACE["path"] = path
+    atexit.register(write_trace)
+
+
+@contextmanager
+def span(name, category, **args):
+    """Time the enclosed block. Callers can set `status` and `size` on the yielded dict"""
+    record = dict(args)
+    if not TRACE["enabled"]:
+        yield record
+        return
+
+    start = time.time()
+    record.setdefault("status", "ok")
+    try:
+        yield record
+    except BaseException as ex:
+        record["status"] = type(ex).__name__
+        raise
+    finally:
+        add_span(name, category, start, time.time() - start, record)
+
+
+def add_span(name, category, start, duration, args):
+    if not TRACE["enabled"]:
+        return
+    with TRACE_LOCK:
+        TRACE["spans"].append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int(start * 1000000),
+                "dur": int(duration * 1000000),
+                "pid": TRACE["pid"],
+                "tid": threading.current_thread().ident,
+                "args": args,
+            }
+        )
+
+
+def trace_response(response, *_, **__):
+    """requests response hook that records a span per HTTP request"""
+    if not TRACE["enabled"]:
+        return
+    # elapsed covers sending the request until the headers arrive
+    duration = response.elapsed.total_seconds()
+    size = response.headers.get("Content-Length")
+    add_span(
+        "{} {}".format(response.request.method, response.url.split("?")[0]),
+        "http",
+        time.time() - duration,
+        duration,
+        {"status": response.status_code, "size": int(size) if size else None},
+    )
+
+
+def get_summary():
+    summary = {}
+    for s in TRACE["spans"]:
+        item = summary.setdefault(
+            s["cat"], {"count": 0, "total": 0, "max": 0, "errors": 0, "size": 0}
+        )
+        item["count"] += 1
+        item["total"] += s["dur"]
+        item["max"] = max(item["max"], s["dur"])
+        item["size"] += s["args"].get("size") or 0
+        status = s["args"].get("status")
+        if status not in ("ok", "cached") and not (
+            isinstance(status, int) and status < 400
+        ):
+            item["errors"] += 1
+    return summary
+
+
+def write_trace():
+    with TRACE_LOCK:
+        spans = list(TRACE["spans"])
+    if not spans:
+        return
+
+    with open(TRACE["path"], "w") as trace_file:
+        json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, trace_file)
+
+    lines = [
+        "{:<12} {:>6} {:>10} {:>10} {:>7} {:>12}".format(
+            "category", "count", "total ms", "max ms", "errors", "bytes"
+        )
+    ]
+    for category, item in sorted(get_summary().items()):
+        lines.append(
+            "{:<12} {:>6} {:>10.1f} {:>10.1f} {:>7} {:>12}".format(
+                category,
+                item["count"],
+                item["total"] / 1000.0,
+                item["max"] / 1000.0,
+                item["errors"],
+                item["size"],
+            )
+        )
+    lines.append("trace written to {}".format(TRACE["path"]))
+    sys.stderr.write("\n".join(lines) + "\n")
+
+
+if os.environ.get("AZEXT_NOELBUNDICK_TRACE", "").lower() not in ("", "0", "false"):
+    _VALUE = os.environ["AZEXT_NOELBUNDICK_TRACE"]
+    enable(None if _VALUE.lower() in ("1", "true") else _VALUE)
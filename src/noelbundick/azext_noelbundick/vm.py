@@ -1,8 +1,9 @@
-import json
+import itertools
 import re
-import requests
 from azure.cli.core.commands import CliCommandType
-from .cli_utils import az_cli
+from . import arm
+
+DEVTESTLAB_API_VERSION = "2016-05-15"
 
 
 def load_command_table(self, _):
@@ -22,54 +23,73 @@ def load_arguments(self, _):
         c.argument("time", options_list=["--time", "-t"])
         c.argument("timezone_id", options_list=["--timezone-id", "-tz"])
 
+    with self.argument_context("vm auto-shutdown show") as c:
+        c.argument("subscriptions", options_list=["--subscriptions"], nargs="+")
+
+
+def get_schedule_id(cli_ctx, vm_name, resource_group_name):
+    return "{}/providers/Microsoft.DevTestLab/schedules/shutdown-computevm-{}".format(
+        arm.get_resource_group_id(cli_ctx, resource_group_name), vm_name
+    )
+
 
-def enable_vm_autoshutdown(vm_name, resource_group_name, time, timezone_id="UTC"):
-    _, subscription_id = get_access_token()
+def enable_vm_autoshutdown(cmd, vm_name, resource_group_name, time, timezone_id="UTC"):
+    cli_ctx = cmd.cli_ctx
+    vm_id = "{}/providers/Microsoft.Compute/virtualMachines/{}".format(
+        arm.get_resource_group_id(cli_ctx, resource_group_name), vm_name
+    )
     properties = {}
     properties["status"] = "Enabled"
     properties["dailyRecurrence"] = {}
     properties["dailyRecurrence"]["time"] = time
-    properties[
-        "targetResourceId"
-    ] = "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}".format(
-        subscription_id, resource_group_name, vm_name
-    )
+    properties["targetResourceId"] = vm_id
     properties["taskType"] = "ComputeVmShutdownTask"
     properties["timeZoneId"] = timezone_id
 
-    schedule = az_cli(
-        [
-            "resource",
-            "create",
-            "-g",
-            resource_group_name,
-            "-n",
-            "shutdown-computevm-{}".format(vm_name),
-            "--resource-type",
-            "Microsoft.DevTestLab/schedules",
-            "-p",
-            json.dumps(properties),
-        ]
+    schedule = arm.create_resource(
+        cli_ctx,
+        get_schedule_id(cli_ctx, vm_name, resource_group_name),
+        {"properties": properties},
+        api_version=DEVTESTLAB_API_VERSION,
     )
     return schedule
 
 
-def disable_vm_autoshutdown(vm_name, resource_group_name):
-    _, subscription_id = get_access_token()
-    resource_id = "/subscriptions/{}/resourcegroups/{}/providers/microsoft.devtestlab/schedules/shutdown-computevm-{}".format(
-        subscription_id, resource_group_name, vm_name
+def disable_vm_autoshutdown(cmd, vm_name, resource_group_name):
+    cli_ctx = cmd.cli_ctx
+    return arm.delete_resource(
+        cli_ctx,
+        get_schedule_id(cli_ctx, vm_name, resource_group_name),
+        api_version=DEVTESTLAB_API_VERSION,
     )
-    return az_cli(["resource", "delete", "--ids", resource_id])
 
 
-def show_vm_autoshutdown(_, vm_name, resource_group_name):
-    access_token, subscription_id = get_access_token()
+def show_vm_autoshutdown(cmd, vm_name, resource_group_name, subscriptions=None):
+    cli_ctx = cmd.cli_ctx
+    if subscriptions:
+        # The same VM name and resource group, looked up in each subscription
+        return list(
+            arm.iter_subscription_rows(
+                arm.resolve_subscriptions(cli_ctx, subscriptions),
+                lambda s: find_vm_schedules(cli_ctx, s, vm_name, resource_group_name),
+            )
+        )
+
+    return next(
+        find_vm_schedules(
+            cli_ctx, arm.get_subscription_id(cli_ctx), vm_name, resource_group_name
+        ),
+        None,
+    )
+
+
+def find_vm_schedules(cli_ctx, subscription_id, vm_name, resource_group_name):
     schedules = get_resources(
+        cli_ctx,
         "Microsoft.DevTestLab",
         "schedules",
-        access_token=access_token,
+        api_version=DEVTESTLAB_API_VERSION,
         subscription_id=subscription_id,
-        api_version="2016-05-15",
     )
 
     search_string = "^/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}$".format(
@@ -77,48 +97,28 @@ def show_vm_autoshutdown(_, vm_name, resource_group_name):
     )
     regexp = re.compile(search_string)
 
-    active_schedules = [
+    # schedules are streamed, so only the match is kept in memory
+    active_schedules = (
         x
         for x in schedules
         if x["properties"]["taskType"] == "ComputeVmShutdownTask"
         and regexp.search(x["properties"]["targetResourceId"])
-    ]
-
-    return active_schedules[0] if active_schedules else None
-
-
-def get_access_token():
-    from azure.cli.core._profile import Profile
+    )
 
-    profile = Profile()
-    creds, subscription, _ = profile.get_raw_token()
-    return (creds[1], subscription)
+    return itertools.islice(active_schedules, 1)
 
 
 def get_resources(
-    namespace, resource_type, access_token=None, subscription_id=None, api_version=None
+    cli_ctx, namespace, resource_type, api_version=None, subscription_id=None
 ):
-
     if api_version is None:
-        api_version = get_latest_api_version(namespace, resource_type)
-
-    if subscription_id is None:
-        _, subscription_id = get_access_token()
-
-    if access_token is None:
-        access_token, _ = get_access_token()
+        api_version = get_latest_api_version(cli_ctx, namespace, resource_type)
 
-    url = "https://management.azure.com/subscriptions/{}/providers/{}/{}?api-version={}".format(
-        subscription_id, namespace, resource_type, api_version
+    path = "/subscriptions/{}/providers/{}/{}".format(
+        subscription_id or arm.get_subscription_id(cli_ctx), namespace, resource_type
     )
-    headers = {"Authorization": "Bearer {}".format(access_token)}
+    return arm.iter_resources(cli_ctx, path, api_version)
 
-    resources = requests.get(url, headers=headers).json()["value"]
-    return resources
 
-
-def get_latest_api_version(namespace, resource_type):
-    query = "resourceTypes[?resourceType=='{}'].apiVersions[0] | [0]".format(
-        resource_type
-    )
-    return az_cli(["provider", "show", "-n", namespace, "--query", query])
+def get_latest_api_version(cli_ctx, namespace, resource_type):
+    return arm.get_api_version(cli_ctx, namespace, resource_type)
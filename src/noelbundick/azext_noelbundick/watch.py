@@ -0,0 +1,376 @@
+import heapq
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from functools import partial
+
+from azure.cli.core.commands import CliCommandType
+from knack.log import get_logger
+from knack.util import CLIError
+from six.moves.urllib.parse import urlsplit
+
+from . import arm as arm_client
+from . import ledger
+from .cli_utils import raise_for_errors, run_many
+from .self_destruct import (
+    ARMED_COLUMNS,
+    BULK_WORKERS,
+    LOGIC_API_VERSION,
+    get_logic_app_parts,
+    get_resource_type,
+    get_self_destruct_query,
+    parse_date,
+)
+
+LOGGER = get_logger(__name__)
+
+# `self-destruct watch` re-reads the soonest items this often (seconds), and shows this many of them
+WATCH_INTERVAL = 30
+WATCH_TOP = 20
+# Deletions and disarms shown under the countdown
+WATCH_EVENTS = 10
+# Self-destruct Logic Apps (not sweepers), with when they fire and what they delete
+WATCH_LOGIC_APPS_QUERY = (
+    "resources | where type =~ 'microsoft.logic/workflows'"
+    " | where name startswith 'self-destruct-'"
+    " | where isnotempty(tags['self-destruct-time'])"
+)
+WATCH_LOGIC_APPS_COLUMNS = (
+    "project id, date = tostring(tags['self-destruct-time']),"
+    " uri = tostring(properties.definition.actions.DeleteResource.inputs.uri)"
+)
+
+
+def load_command_table(self, _):
+    custom = CliCommandType(operations_tmpl="{}#{{}}".format(__name__))
+
+    with self.command_group("self-destruct", custom_command_type=custom) as g:
+        g.custom_command("watch", "watch")
+
+
+def load_arguments(self, _):
+    with self.argument_context("self-destruct watch") as c:
+        c.argument("resource_group_name", options_list=["--resource-group", "-g"])
+        c.argument("interval", options_list=["--interval", "-i"], type=int)
+        c.argument("top", options_list=["--top"], type=int)
+
+
+def watch(cmd, resource_group_name=None, interval=WATCH_INTERVAL, top=WATCH_TOP):
+    """Count down to the next self-destructs, soonest first, until Ctrl+C
+
+    Everything armed is listed once, then kept in a heap keyed on its date. Each poll after that only asks for
+    Logic Apps that changed, and re-reads the items on screen with If-None-Match, so an idle watch costs a query
+    and a handful of 304s per interval however much is armed
+    """
+    cli_ctx = cmd.cli_ctx
+    interactive = sys.stdout.isatty()
+    state = start_watch(cli_ctx, resource_group_name)
+    try:
+        while True:
+            soonest = poll_watch(cli_ctx, state, top)
+            next_poll = time.time() + interval
+            # The countdown ticks every second on a terminal. Anywhere else, it's written once per poll
+            while True:
+                sys.stdout.write(
+                    format_watch(state, soonest, next_poll - time.time(), interactive)
+                )
+                sys.stdout.flush()
+                if not interactive or time.time() >= next_poll:
+                    break
+                time.sleep(1)
+            time.sleep(max(0, next_poll - time.time()))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_watch(cli_ctx, resource_group_name=None):
+    """The watch's state, from one query for self-destruct tags and one for self-destruct Logic Apps"""
+    started = datetime.utcnow()
+    tagged, logic_apps = raise_for_errors(
+        run_many(
+            [
+                partial(
+                    list,
+                    arm_client.query_resources(
+                        cli_ctx,
+                        get_self_destruct_query(
+                            resource_group_name=resource_group_name,
+                            columns=ARMED_COLUMNS,
+                        ),
+                    ),
+                ),
+                partial(
+                    list,
+                    arm_client.query_resources(
+                        cli_ctx, get_watch_logic_apps_query(resource_group_name)
+                    ),
+                ),
+            ]
+        )
+    )
+    state = {
+        "resourceGroup": resource_group_name,
+        # {lowercased id: item}, and a heap of (date, lowercased id) with stale entries left in until they surface
+        "items": {},
+        "heap": [],
+        # {lowercased id: date} for items that went away, so a lagging Resource Graph doesn't bring them back
+        "gone": {},
+        "since": started,
+        "events": deque(maxlen=WATCH_EVENTS),
+        "requests": 2,
+        "unchanged": 0,
+    }
+    for row in tagged:
+        date = parse_date(row["date"])
+        if date is None:
+            continue
+        if row["apiVersion"]:
+            # Swept resources have no Logic App, so the resource itself is polled
+            set_watch_item(
+                state,
+                row["id"],
+                date,
+                apiVersion=row["apiVersion"],
+                watching=row["id"],
+                status="Sweeper",
+            )
+        else:
+            set_watch_item(state, row["id"], date, status="Tagged")
+    for row in logic_apps:
+        set_watch_logic_app(state, row)
+    return state
+
+
+def get_watch_logic_apps_query(resource_group_name=None, since=None):
+    clauses = [WATCH_LOGIC_APPS_QUERY]
+    if resource_group_name:
+        clauses.append("where resourceGroup =~ '{}'".format(resource_group_name))
+    if since:
+        clauses.append(
+            "where todatetime(properties.changedTime) > datetime({})".format(
+                since.strftime("%Y-%m-%d %H:%M:%S")
+            )
+        )
+    clauses.append(WATCH_LOGIC_APPS_COLUMNS)
+    return " | ".join(clauses)
+
+
+def set_watch_item(state, resource_id, date, **changes):
+    """Add an item to the watch, or update one. It goes on the heap again only if its date moved"""
+    key = resource_id.lower()
+    item = state["items"].get(key)
+    if item is None:
+        resource_group, name, logic_app = get_logic_app_parts(resource_id)
+        item = state["items"][key] = {
+            "id": resource_id,
+            "name": name,
+            "resourceGroup": resource_group,
+            "type": get_resource_type(resource_id),
+            "date": None,
+            "apiVersion": None,
+            # What's polled: the Logic App until it's gone, then the resource itself
+            "watching": "{}/providers/Microsoft.Logic/workflows/{}".format(
+                "/".join(resource_id.split("/")[:5]), logic_app
+            ),
+            "etag": None,
+            "status": None,
+        }
+        state["gone"].pop(key, None)
+    if changes.get("watching", item["watching"]) != item["watching"]:
+        item["etag"] = None
+    item.update(changes)
+    if item["date"] != date:
+        item["date"] = date
+        heapq.heappush(state["heap"], (date, key))
+    return item
+
+
+def set_watch_logic_app(state, row):
+    resource_id = urlsplit(row["uri"]).path
+    date = parse_date(row["date"])
+    if not resource_id or date is None:
+        return
+    if state["gone"].get(resource_id.lower()) == date:
+        return
+    set_watch_item(state, resource_id, date, watching=row["id"], status="Armed")
+
+
+def remove_watch_item(state, item, status):
+    key = item["id"].lower()
+    state["items"].pop(key, None)
+    state["gone"][key] = item["date"]
+    state["events"].append(
+        "{}  {}  {}/{}".format(
+            datetime.utcnow().strftime("%H:%M:%S"),
+            status,
+            item["resourceGroup"],
+            item["name"],
+        )
+    )
+
+
+def peek_watch(state, count):
+    """The soonest `count` items. Heap entries for items that moved or went away are dropped on the way"""
+    heap, items = state["heap"], state["items"]
+    if len(heap) > 2 * len(items) + count:
+        heap[:] = [(i["date"], k) for (k, i) in items.items()]
+        heapq.heapify(heap)
+
+    soonest, seen = [], set()
+    while heap and len(soonest) < count:
+        date, key = heapq.heappop(heap)
+        item = items.get(key)
+        if item is not None and item["date"] == date and key not in seen:
+            soonest.append((date, key))
+            seen.add(key)
+    for entry in soonest:
+        heapq.heappush(heap, entry)
+    return [items[key] for (_, key) in soonest]
+
+
+def poll_watch(cli_ctx, state, top=WATCH_TOP):
+    """Catch up with what changed since the last poll. Returns the soonest `top` items
+
+    Logic Apps changed since then come from one Resource Graph query. The soonest items, which are the ones on screen
+    and the ones falling due, are read again with If-None-Match, so each one that hasn't changed is a 304
+    """
+    polled = datetime.utcnow()
+    # Resource Graph takes a while to see changes, so each query looks back further than the last poll
+    since = state["since"] - timedelta(seconds=ledger.GRAPH_LAG)
+    try:
+        for row in arm_client.query_resources(
+            cli_ctx, get_watch_logic_apps_query(state["resourceGroup"], since=since)
+        ):
+            set_watch_logic_app(state, row)
+        state["since"] = polled
+    except CLIError as ex:
+        LOGGER.warning("Could not look for changed Logic Apps: %s", ex)
+
+    soonest = peek_watch(state, top)
+    results = run_many(
+        [partial(check_watch_item, cli_ctx, i) for i in soonest],
+        max_workers=BULK_WORKERS,
+    )
+    state["requests"], state["unchanged"] = 1, 0
+    for (item, result) in zip(soonest, results):
+        state["requests"] += 1
+        if result.error is not None:
+            LOGGER.debug("Could not check %s: %s", item["watching"], result.error)
+        elif result.result is None:
+            state["unchanged"] += 1
+        elif "gone" in result.result:
+            remove_watch_item(state, item, result.result["gone"])
+        else:
+            # Reading the resource after its Logic App went away is a second request
+            state["requests"] += result.result.pop("requests", 0)
+            set_watch_item(
+                state, item["id"], result.result.pop("date"), **result.result
+            )
+
+    # Dates may have moved, and items that went away make room on screen
+    return peek_watch(state, top)
+
+
+def check_watch_item(cli_ctx, item):
+    """Read an item's Logic App again (or the resource, once there's no Logic App), unless it hasn't changed
+
+    Returns None if nothing changed, {"gone": status} if it isn't armed anymore, or the item's new fields
+    """
+    if item["watching"] != item["id"]:
+        workflow, etag = arm_client.show_resource_if_changed(
+            cli_ctx, item["watching"], item["etag"], api_version=LOGIC_API_VERSION
+        )
+        if workflow is arm_client.NOT_MODIFIED:
+            return None
+        if workflow is not None:
+            date = parse_date(
+                (workflow.get("tags") or {}).get("self-destruct-time", "")
+            )
+            return {"date": date or item["date"], "etag": etag, "status": "Armed"}
+
+        # The Logic App deletes itself once the resource is gone, and disarm deletes it too.
+        # Or there never was one, ex: the tags were written by hand. The resource says which
+        resource, etag = arm_client.show_resource_if_changed(
+            cli_ctx, item["id"], api_version=item["apiVersion"]
+        )
+        changes = check_watch_resource(item, resource, etag)
+        if changes and "gone" not in changes:
+            changes["requests"] = 1
+        return changes
+
+    resource, etag = arm_client.show_resource_if_changed(
+        cli_ctx, item["id"], item["etag"], api_version=item["apiVersion"]
+    )
+    if resource is arm_client.NOT_MODIFIED:
+        return None
+    return check_watch_resource(item, resource, etag)
+
+
+def check_watch_resource(item, resource, etag):
+    from .sweeper import API_VERSION_TAG
+
+    if resource is None:
+        return {"gone": "Deleted"}
+    tags = resource.get("tags") or {}
+    date = parse_date(tags.get("self-destruct-date", ""))
+    if date is None:
+        return {"gone": "Disarmed"}
+    return {
+        "date": date,
+        "etag": etag,
+        "watching": item["id"],
+        "status": "Sweeper" if API_VERSION_TAG in tags else "No Logic App",
+    }
+
+
+def format_watch(state, soonest, next_poll, interactive=False):
+    """The countdown, as a screenful of text"""
+    now = datetime.utcnow()
+    rows = [("DUE IN", "DATE (UTC)", "STATUS", "RESOURCE GROUP", "NAME", "TYPE")]
+    for item in soonest:
+        rows.append(
+            (
+                format_countdown(item["date"] - now),
+                item["date"].strftime("%Y-%m-%d %H:%M:%S"),
+                item["status"] or "",
+                item["resourceGroup"],
+                item["name"],
+                item["type"],
+            )
+        )
+    widths = [max(len(r[c]) for r in rows) for c in range(len(rows[0]))]
+
+    lines = [
+        "{} armed{}. Last poll: {} requests, {} unchanged. Next in {}s, Ctrl+C to stop".format(
+            len(state["items"]),
+            " in {}".format(state["resourceGroup"]) if state["resourceGroup"] else "",
+            state["requests"],
+            state["unchanged"],
+            max(0, int(next_poll)),
+        ),
+        "",
+    ]
+    lines.extend(
+        "  ".join(v.ljust(w) for (v, w) in zip(row, widths)).rstrip() for row in rows
+    )
+    if state["events"]:
+        lines.append("")
+        lines.extend(state["events"])
+    text = "\n".join(lines) + "\n"
+    # Redraw in place on a terminal
+    return "\x1b[H\x1b[2J" + text if interactive else text + "\n"
+
+
+def format_countdown(delta):
+    """Ex: 2d 03h, 1h 05m, 4m 09s. Overdue items count up from -0m 00s"""
+    seconds = int(delta.total_seconds())
+    sign = "-" if seconds < 0 else ""
+    minutes, seconds = divmod(abs(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return "{}{}d {:02d}h".format(sign, days, hours)
+    if hours:
+        return "{}{}h {:02d}m".format(sign, hours, minutes)
+    return "{}{}m {:02d}s".format(sign, minutes, seconds)